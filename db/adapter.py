@@ -1,45 +1,661 @@
+import json
+import os
+import queue
 import sqlite3
-from typing import Any
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Iterable, Iterator, Sequence
+
+import numpy as np
+
+from db.filters import SearchFilter
+
+DEFAULT_DB_PATH = Path(__file__).parent / "functions.db"
+
+# Ограничение SQLite на число параметров в одном запросе
+MAX_QUERY_PARAMS = 900
+# Сколько функций класса или модулей репозитория отдавать вместе с группой
+GROUP_MEMBERS_LIMIT = 20
 
 
 class DBAdapter:
-    def __init__(self):
-        self.functions_db = sqlite3.connect("../db/functions.db")
+    """
+    Хранилище функций, ключ таблицы - номер строки (label) вектора в индексе FAISS.
+
+    Записи идут через одно соединение, чтения - через пул соединений только для чтения,
+    которые можно использовать из разных потоков.
+    """
+
+    def __init__(
+        self,
+        db_path: Path | str | None = None,
+        read_pool_size: int | None = None,
+        vector_dtype: str = "float32",
+    ):
+        self.db_path = Path(db_path or os.getenv("FUNCTIONS_DB_PATH", DEFAULT_DB_PATH))
+        self.vector_dtype = np.dtype(vector_dtype)
+        self.functions_db = sqlite3.connect(self.db_path, check_same_thread=False)
+
+        self._read_pool_size = read_pool_size or int(os.getenv("DB_READ_POOL_SIZE", "4"))
+        self._readers: queue.Queue[sqlite3.Connection] = queue.Queue()
+        self._readers_opened = 0
+        self._readers_lock = threading.Lock()
 
     def init_db(self):
         cursor = self.functions_db.cursor()
+        if self._has_legacy_schema():
+            self._migrate_legacy_schema()
         # Создаем таблицу, если ее нет
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS functions (
+                id INTEGER PRIMARY KEY,  -- номер строки в индексе FAISS
+                fn_id TEXT,
+                url TEXT,
+                code TEXT,
+                vector BLOB              -- необязательный вектор в бинарном виде
+            )
+        """)
+        # Все места, где встречается функция с этим содержимым
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS occurrences (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                vector TEXT NOT NULL,  
-                url TEXT,              
-                code TEXT              
+                vector_id INTEGER NOT NULL,  -- id строки в таблице functions
+                fn_id TEXT,
+                url TEXT,
+                start_line INTEGER,
+                end_line INTEGER,
+                repo TEXT,                   -- имя репозитория, как у шарда индекса
+                source TEXT,                 -- bitbucket, jira, confluence
+                kind TEXT,                   -- function, issue, document, ...
+                path TEXT,                   -- путь внутри репозитория
+                language TEXT,
+                parent_id TEXT,              -- функция, частью которой является вектор
+                chunk INTEGER,               -- номер части внутри функции
+                module TEXT,                 -- модуль, в котором объявлена функция
+                class_name TEXT              -- объемлющий класс
+            )
+        """)
+        for column in ("repo", "source", "kind", "path", "language", "parent_id", "module", "class_name"):
+            self._ensure_column("occurrences", column, "TEXT")
+        self._ensure_column("occurrences", "chunk", "INTEGER")
+        # Полный текст функций, которые разбиты на несколько векторов
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS parents (
+                parent_id TEXT PRIMARY KEY,
+                url TEXT,
+                code TEXT,
+                start_line INTEGER,
+                end_line INTEGER
+            )
+        """)
+        # Классы, модули и репозитории с векторами в своих индексах, label - номер вектора в индексе уровня
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS code_groups (
+                kind TEXT NOT NULL,      -- class, module, repository
+                label INTEGER NOT NULL,
+                repo TEXT,
+                source TEXT,
+                path TEXT,
+                url TEXT,
+                language TEXT,
+                name TEXT,
+                class_name TEXT,
+                size INTEGER,            -- число векторов функций в группе
+                PRIMARY KEY (kind, label)
+            )
+        """)
+        # Полнотекстовый индекс по функциям, rowid - id строки в таблице functions
+        cursor.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS functions_fts USING fts5(
+                name, parameters, path, content
             )
         """)
         self.functions_db.commit()
+        self.create_indexes()
 
-    def get_by_vectors(self, vectors: list[str]) -> list[dict[str, Any]]:
-        vectors = [str(v) for v in vectors]
-        # Получение кодов из SQLite
-        cursor = self.functions_db.cursor()
-        cursor.execute(
-            "SELECT code, url FROM functions WHERE vector IN (%s)"
-            % ",".join("?" * len(vectors)),
-            vectors,
+    def _ensure_column(self, table: str, column: str, column_type: str) -> None:
+        # Новые колонки в базах, созданных до их появления
+        columns = {row[1] for row in self.functions_db.execute(f"PRAGMA table_info({table})")}
+        if column not in columns:
+            self.functions_db.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+    def _has_legacy_schema(self) -> bool:
+        columns = {
+            row[1]: row[2]
+            for row in self.functions_db.execute("PRAGMA table_info(functions)")
+        }
+        return columns.get("vector") == "TEXT"
+
+    def _migrate_legacy_schema(self) -> None:
+        # Старая таблица заполнялась в порядке embeddings.jsonl с AUTOINCREMENT от 1,
+        # поэтому номер строки в индексе FAISS равен id - 1
+        print("Миграция таблицы functions на хранение по номеру строки индекса")
+        db = self.functions_db
+        db.execute("ALTER TABLE functions RENAME TO functions_legacy")
+        db.execute("""
+            CREATE TABLE functions (
+                id INTEGER PRIMARY KEY,
+                fn_id TEXT,
+                url TEXT,
+                code TEXT,
+                vector BLOB
+            )
+        """)
+        rows = db.execute("SELECT id, vector, url, code FROM functions_legacy ORDER BY id").fetchall()
+        db.executemany(
+            "INSERT INTO functions (id, url, code, vector) VALUES (?, ?, ?, ?)",
+            (
+                (row_id - 1, url, code, self._pack_vector(json.loads(vector)))
+                for row_id, vector, url, code in rows
+            ),
+        )
+        db.execute("DROP TABLE functions_legacy")
+        db.commit()
+
+    def _pack_vector(self, vector) -> bytes | None:
+        if vector is None:
+            return None
+        return np.asarray(vector, dtype=self.vector_dtype).tobytes()
+
+    def _unpack_vector(self, blob: bytes | None) -> np.ndarray | None:
+        if blob is None:
+            return None
+        return np.frombuffer(blob, dtype=self.vector_dtype).astype("float32")
+
+    @contextmanager
+    def _reader(self):
+        try:
+            conn = self._readers.get_nowait()
+        except queue.Empty:
+            with self._readers_lock:
+                can_open = self._readers_opened < self._read_pool_size
+                if can_open:
+                    self._readers_opened += 1
+            if can_open:
+                conn = sqlite3.connect(
+                    f"{self.db_path.resolve().as_uri()}?mode=ro", uri=True, check_same_thread=False
+                )
+                conn.row_factory = sqlite3.Row
+            else:
+                conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+
+    def _fetch_by_ids(self, columns: str, ids: Sequence[int]) -> dict[int, sqlite3.Row]:
+        rows = {}
+        with self._reader() as conn:
+            for start in range(0, len(ids), MAX_QUERY_PARAMS):
+                chunk = ids[start:start + MAX_QUERY_PARAMS]
+                cursor = conn.execute(
+                    f"SELECT id, {columns} FROM functions WHERE id IN (%s)"
+                    % ",".join("?" * len(chunk)),
+                    chunk,
+                )
+                for row in cursor:
+                    rows[row["id"]] = row
+        return rows
+
+    def get_by_ids(self, ids: Iterable[int]) -> list[dict[str, Any]]:
+        """
+        Возвращает функции по номерам строк индекса в том же порядке.
+        Отрицательные номера (FAISS дополняет ими выдачу) пропускаются.
+        """
+        ids = [int(i) for i in ids if i >= 0]
+        unique_ids = list(dict.fromkeys(ids))
+        rows = self._fetch_by_ids("fn_id, url, code", unique_ids)
+        occurrences, parent_codes = self._fetch_occurrences(unique_ids)
+        result = []
+        for i in ids:
+            if i not in rows:
+                continue
+            occ = occurrences.get(i) or [
+                {"url": rows[i]["url"], "start_line": None, "end_line": None, "parent_id": None}
+            ]
+            # Для части функции отдается вся функция, в которую она входит первой
+            parent_id = occ[0]["parent_id"]
+            result.append({
+                "id": i,
+                "fn_id": rows[i]["fn_id"],
+                "parent_id": parent_id,
+                "url": rows[i]["url"],
+                "code": parent_codes.get(parent_id) or rows[i]["code"],
+                "occurrences": occ,
+            })
+        return result
+
+    def _fetch_occurrences(self, ids: Sequence[int]) -> tuple[dict[int, list[dict[str, Any]]], dict[str, str]]:
+        """
+        Вхождения векторов и полный текст их функций. У части функции вхождение - вся функция:
+        строки берутся из parents, одна функция попадает в список один раз.
+        """
+        occurrences, parent_codes, seen = {}, {}, set()
+        with self._reader() as conn:
+            for start in range(0, len(ids), MAX_QUERY_PARAMS):
+                chunk = ids[start:start + MAX_QUERY_PARAMS]
+                cursor = conn.execute(
+                    "SELECT o.vector_id, o.url, o.parent_id, p.code AS parent_code, "
+                    "coalesce(p.start_line, o.start_line) AS start_line, "
+                    "coalesce(p.end_line, o.end_line) AS end_line "
+                    "FROM occurrences o LEFT JOIN parents p ON p.parent_id = o.parent_id "
+                    "WHERE o.vector_id IN (%s) ORDER BY o.vector_id, o.id" % ",".join("?" * len(chunk)),
+                    chunk,
+                )
+                for row in cursor:
+                    key = (row["vector_id"], row["parent_id"])
+                    if row["parent_id"] is not None and key in seen:
+                        continue
+                    seen.add(key)
+                    if row["parent_code"] is not None:
+                        parent_codes[row["parent_id"]] = row["parent_code"]
+                    occurrences.setdefault(row["vector_id"], []).append({
+                        "url": row["url"],
+                        "start_line": row["start_line"],
+                        "end_line": row["end_line"],
+                        "parent_id": row["parent_id"],
+                    })
+        return occurrences, parent_codes
+
+    def parents_of(self, ids: Iterable[int]) -> dict[int, str | None]:
+        """Функция первого вхождения каждого вектора; None в базах без разбиения на части"""
+        ids = list(dict.fromkeys(int(i) for i in ids if i >= 0))
+        parents = {}
+        with self._reader() as conn:
+            for start in range(0, len(ids), MAX_QUERY_PARAMS):
+                chunk = ids[start:start + MAX_QUERY_PARAMS]
+                cursor = conn.execute(
+                    "SELECT vector_id, parent_id FROM occurrences WHERE vector_id IN (%s) "
+                    "ORDER BY vector_id, id" % ",".join("?" * len(chunk)),
+                    chunk,
+                )
+                for row in cursor:
+                    parents.setdefault(row["vector_id"], row["parent_id"])
+        return parents
+
+    def chunks_per_parent(self) -> float:
+        """Среднее число векторов на функцию, по нему выбирается запас выдачи при поиске"""
+        with self._reader() as conn:
+            n_vectors, n_parents = conn.execute(
+                "SELECT count(DISTINCT vector_id), count(DISTINCT parent_id) FROM occurrences"
+            ).fetchone()
+        if not n_parents:
+            return 1.0
+        return max(1.0, n_vectors / n_parents)
+
+    def search_lexical(
+        self, match_query: str, k: int, filters: SearchFilter | None = None
+    ) -> list[tuple[int, float]]:
+        """
+        BM25 поиск по FTS5, возвращает пары (id, score), чем больше score, тем лучше.
+        Совпадение в имени функции весит больше, чем в параметрах, пути и коде.
+        filters ограничивает выдачу функциями, у которых есть подходящее вхождение.
+        """
+        query = (
+            "SELECT rowid, bm25(functions_fts, 10.0, 2.0, 2.0, 1.0) AS rank FROM functions_fts "
+            "WHERE functions_fts MATCH ?"
         )
-        return cursor.fetchall()
+        params = [match_query]
+        if filters is not None and not filters.is_empty():
+            where, filter_params = filters.sql()
+            query += f" AND rowid IN (SELECT vector_id FROM occurrences WHERE {where})"
+            params.extend(filter_params)
+        with self._reader() as conn:
+            rows = conn.execute(query + " ORDER BY rank LIMIT ?", (*params, k)).fetchall()
+        # bm25 в SQLite отрицательный, меньше - лучше
+        return [(row["rowid"], -row["rank"]) for row in rows]
+
+    def labels_matching(self, filters: SearchFilter) -> np.ndarray:
+        """Номера векторов, у которых есть вхождение под фильтр, по возрастанию"""
+        where, params = filters.sql()
+        with self._reader() as conn:
+            rows = conn.execute(
+                f"SELECT DISTINCT vector_id FROM occurrences WHERE {where} ORDER BY vector_id", params
+            ).fetchall()
+        return np.array([row[0] for row in rows], dtype="int64")
+
+    def iter_code_members(self, repos: Sequence[str] | None = None) -> Iterator[sqlite3.Row]:
+        """
+        Векторы функций с репозиторием, путем, модулем и классом, по порядку репозиториев и путей.
+        В базах без колонок repo и path они заменяются на default и url.
+        """
+        query = (
+            "SELECT DISTINCT coalesce(repo, 'default') AS repo, coalesce(path, url) AS path, url, module, "
+            "class_name, coalesce(source, 'bitbucket') AS source, language, vector_id FROM occurrences "
+            "WHERE coalesce(kind, 'function') = 'function'"
+        )
+        params = list(repos or ())
+        if params:
+            query += f" AND repo IN ({','.join('?' * len(params))})"
+        with self._reader() as conn:
+            yield from conn.execute(query + " ORDER BY 1, 2", params)
+
+    @staticmethod
+    def _groups_where(kind: str, repos: Sequence[str] | None) -> tuple[str, list]:
+        where, params = "kind = ?", [kind, *(repos or ())]
+        if repos:
+            where += f" AND repo IN ({','.join('?' * len(repos))})"
+        return where, params
+
+    def group_labels(self, kind: str, repos: Sequence[str] | None = None) -> np.ndarray:
+        """Номера групп уровня, только этих репозиториев, если они заданы"""
+        where, params = self._groups_where(kind, repos)
+        rows = self.functions_db.execute(f"SELECT label FROM code_groups WHERE {where}", params).fetchall()
+        return np.array([row[0] for row in rows], dtype="int64")
+
+    def replace_groups(self, kind: str, rows: Iterable[dict[str, Any]], repos: Sequence[str] | None = None) -> None:
+        """Заменяет группы уровня (только этих репозиториев, если заданы) одной транзакцией"""
+        columns = ("kind", "label", "repo", "source", "path", "url", "language", "name", "class_name", "size")
+        where, params = self._groups_where(kind, repos)
+        with self.functions_db:
+            self.functions_db.execute(f"DELETE FROM code_groups WHERE {where}", params)
+            self.functions_db.executemany(
+                f"INSERT INTO code_groups ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})",
+                (tuple(row.get(column) for column in columns) for row in rows),
+            )
+
+    def next_group_label(self, kind: str) -> int:
+        row = self.functions_db.execute("SELECT max(label) FROM code_groups WHERE kind = ?", (kind,)).fetchone()
+        return 0 if row[0] is None else row[0] + 1
 
-    def add_entity(self, vector: str, code: str, url: str):
-        if not isinstance(vector, str):
-            vector = str(vector)
+    def group_labels_matching(self, filters: SearchFilter) -> np.ndarray:
+        """Номера групп под фильтр, вид группы задается filters.kinds"""
+        where, params = filters.sql()
+        with self._reader() as conn:
+            rows = conn.execute(f"SELECT label FROM code_groups WHERE {where} ORDER BY label", params).fetchall()
+        return np.array([row[0] for row in rows], dtype="int64")
+
+    def get_groups(self, kind: str, ids: Iterable[int], members_limit: int = GROUP_MEMBERS_LIMIT) -> list[dict[str, Any]]:
+        """
+        Классы, модули или репозитории по номерам в индексе уровня, в том же порядке.
+        У класса и модуля в members - их функции, у репозитория - самые крупные модули.
+        """
+        ids = [int(i) for i in ids if i >= 0]
+        unique_ids = list(dict.fromkeys(ids))
+        groups = {}
+        with self._reader() as conn:
+            for start in range(0, len(unique_ids), MAX_QUERY_PARAMS):
+                chunk = unique_ids[start:start + MAX_QUERY_PARAMS]
+                cursor = conn.execute(
+                    "SELECT * FROM code_groups WHERE kind = ? AND label IN (%s)" % ",".join("?" * len(chunk)),
+                    (kind, *chunk),
+                )
+                for row in cursor:
+                    groups[row["label"]] = dict(row)
+            for group in groups.values():
+                group["members"] = self._group_members(conn, group, members_limit)
+        return [{"id": i, **groups[i]} for i in ids if i in groups]
+
+    @staticmethod
+    def _group_members(conn: sqlite3.Connection, group: dict[str, Any], limit: int) -> list[dict[str, Any]]:
+        if group["kind"] == "repository":
+            rows = conn.execute(
+                "SELECT name, path, size FROM code_groups WHERE kind = 'module' AND repo = ? "
+                "ORDER BY size DESC, path LIMIT ?",
+                (group["repo"], limit),
+            )
+            return [dict(row) for row in rows]
+        query = (
+            "SELECT f.name AS name, o.url AS url, min(coalesce(p.start_line, o.start_line)) AS start_line, "
+            "max(coalesce(p.end_line, o.end_line)) AS end_line FROM occurrences o "
+            "LEFT JOIN parents p ON p.parent_id = o.parent_id "
+            "LEFT JOIN functions_fts f ON f.rowid = o.vector_id "
+            "WHERE o.url = ? AND coalesce(o.kind, 'function') = 'function'"
+        )
+        params = [group["url"]]
+        if group["kind"] == "class":
+            query += " AND o.class_name = ?"
+            params.append(group["class_name"])
+        query += " GROUP BY coalesce(o.parent_id, o.id) ORDER BY start_line LIMIT ?"
+        return [dict(row) for row in conn.execute(query, (*params, limit))]
+
+    def get_vectors(self, ids: Iterable[int]) -> np.ndarray:
+        ids = [int(i) for i in ids if i >= 0]
+        rows = self._fetch_by_ids("vector", list(dict.fromkeys(ids)))
+        return np.array([self._unpack_vector(rows[i]["vector"]) for i in ids if i in rows])
+
+    def add_entity(self, row_id: int, code: str, url: str, fn_id: str | None = None, vector=None):
         # Добавляем в SQLite
         cursor = self.functions_db.cursor()
         cursor.execute(
-            "INSERT INTO functions (vector, code, url) VALUES (?, ?, ?)",
-            (vector, code, url),
+            "INSERT OR REPLACE INTO functions (id, fn_id, code, url, vector) VALUES (?, ?, ?, ?, ?)",
+            (row_id, fn_id, code, url, self._pack_vector(vector)),
         )
         self.functions_db.commit()
 
+    def add_many(self, records: Iterable[dict[str, Any]], batch_size: int = 50_000) -> int:
+        """
+        Потоковая загрузка записей вида
+        {"id", "fn_id", "code", "url", "name", "parameters", "start_line", "end_line", "vector"}
+        и метаданными для фильтров "repo", "source", "kind", "path", "language"
+        и группировки "module", "class_name".
+        Если функция разбита на части, запись - одна часть: "parent_id" и "chunk" связывают
+        ее с функцией, а "parent_code" со строками "parent_start_line", "parent_end_line"
+        (достаточно в одной части) сохраняются в parents.
+
+        Каждая запись - одно вхождение функции, id - номер вектора в индексе. Строка
+        в functions пишется по первому вхождению, остальные попадают только в occurrences.
+        Вместе со строкой в functions заполняется полнотекстовый индекс functions_fts.
+        Записи пишутся пачками через executemany, каждая пачка - одна транзакция.
+        На время загрузки отключается fsync, индексы строятся после загрузки.
+        """
+        db = self.functions_db
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=OFF")
+        db.execute("DROP INDEX IF EXISTS functions_fn_id")
+        db.execute("DROP INDEX IF EXISTS occurrences_vector_id")
+        db.execute("DROP INDEX IF EXISTS occurrences_url")
+        db.execute("DROP INDEX IF EXISTS occurrences_repo")
+
+        total = 0
+        started = time.perf_counter()
+        seen, seen_parents = set(), set()
+        functions_batch, occurrences_batch, parents_batch = [], [], []
+        try:
+            for record in records:
+                parent_id = record.get("parent_id")
+                if record.get("parent_code") is not None and parent_id not in seen_parents:
+                    seen_parents.add(parent_id)
+                    parents_batch.append((
+                        parent_id,
+                        record["url"],
+                        record["parent_code"],
+                        record.get("parent_start_line"),
+                        record.get("parent_end_line"),
+                    ))
+                if record["id"] not in seen:
+                    seen.add(record["id"])
+                    functions_batch.append((
+                        record["id"],
+                        record.get("fn_id"),
+                        record["code"],
+                        record["url"],
+                        self._pack_vector(record.get("vector")),
+                        record.get("name"),
+                        record.get("parameters"),
+                    ))
+                occurrences_batch.append((
+                    record["id"],
+                    record.get("fn_id"),
+                    record["url"],
+                    record.get("start_line"),
+                    record.get("end_line"),
+                    record.get("repo"),
+                    record.get("source"),
+                    record.get("kind"),
+                    record.get("path"),
+                    record.get("language"),
+                    parent_id,
+                    record.get("chunk"),
+                    record.get("module"),
+                    record.get("class_name"),
+                ))
+                if len(occurrences_batch) >= batch_size:
+                    total += self._write_batch(functions_batch, occurrences_batch, parents_batch)
+                    functions_batch, occurrences_batch, parents_batch = [], [], []
+                    elapsed = time.perf_counter() - started
+                    print(f"Загружено {total} строк, {total / elapsed:.0f} строк/с")
+            if occurrences_batch:
+                total += self._write_batch(functions_batch, occurrences_batch, parents_batch)
+        finally:
+            db.execute("PRAGMA synchronous=NORMAL")
+            # Индексы возвращаются и после ошибки: записанные пачки остаются в базе
+            self.create_indexes()
+
+        db.execute("INSERT INTO functions_fts (functions_fts) VALUES ('optimize')")
+        db.commit()
+        elapsed = time.perf_counter() - started
+        print(f"Загрузка завершена: {total} строк за {elapsed:.2f} с, {total / max(elapsed, 1e-9):.0f} строк/с")
+        return total
+
+    def replace_all(self, records: Iterable[dict[str, Any]], batch_size: int = 50_000) -> int:
+        """
+        Полная загрузка без окна с пустой или неполной базой. Записи add_many пишутся в соседнюю
+        staging базу, и только после успешной загрузки функции, вхождения и части переносятся
+        в рабочую базу одной транзакцией. При ошибке рабочая база не меняется.
+        Группы (code_groups) не трогаются, их пересобирает mcp_apps.groups.
+        """
+        staging_path = self.db_path.with_name(self.db_path.name + ".staging")
+        self._remove_db_files(staging_path)
+        try:
+            staging = DBAdapter(staging_path, read_pool_size=1, vector_dtype=self.vector_dtype.name)
+            try:
+                staging.init_db()
+                total = staging.add_many(records, batch_size=batch_size)
+            finally:
+                staging.close_db()
+
+            started = time.perf_counter()
+            db = self.functions_db
+            db.execute("ATTACH DATABASE ? AS staging", (str(staging_path),))
+            try:
+                with db:
+                    db.execute("DELETE FROM functions")
+                    db.execute("DELETE FROM occurrences")
+                    db.execute("DELETE FROM functions_fts")
+                    db.execute("DELETE FROM parents")
+                    db.execute(
+                        "INSERT INTO functions (id, fn_id, url, code, vector) "
+                        "SELECT id, fn_id, url, code, vector FROM staging.functions"
+                    )
+                    columns = (
+                        "vector_id, fn_id, url, start_line, end_line, repo, source, kind, path, "
+                        "language, parent_id, chunk, module, class_name"
+                    )
+                    db.execute(f"INSERT INTO occurrences ({columns}) SELECT {columns} FROM staging.occurrences")
+                    db.execute(
+                        "INSERT INTO functions_fts (rowid, name, parameters, path, content) "
+                        "SELECT rowid, name, parameters, path, content FROM staging.functions_fts"
+                    )
+                    db.execute(
+                        "INSERT INTO parents (parent_id, url, code, start_line, end_line) "
+                        "SELECT parent_id, url, code, start_line, end_line FROM staging.parents"
+                    )
+            finally:
+                db.execute("DETACH DATABASE staging")
+            print(f"База заменена загруженной за {time.perf_counter() - started:.2f} с")
+        finally:
+            self._remove_db_files(staging_path)
+        return total
+
+    @staticmethod
+    def _remove_db_files(path: Path) -> None:
+        for suffix in ("", "-wal", "-shm", "-journal"):
+            Path(f"{path}{suffix}").unlink(missing_ok=True)
+
+    def clear(self) -> None:
+        with self.functions_db:
+            self.functions_db.execute("DELETE FROM functions")
+            self.functions_db.execute("DELETE FROM occurrences")
+            self.functions_db.execute("DELETE FROM functions_fts")
+            self.functions_db.execute("DELETE FROM parents")
+
+    def delete_occurrences_by_urls(self, urls: Iterable[str]) -> int:
+        urls = list(urls)
+        deleted = 0
+        with self.functions_db:
+            for start in range(0, len(urls), MAX_QUERY_PARAMS):
+                chunk = urls[start:start + MAX_QUERY_PARAMS]
+                cursor = self.functions_db.execute(
+                    "DELETE FROM occurrences WHERE url IN (%s)" % ",".join("?" * len(chunk)),
+                    chunk,
+                )
+                self.functions_db.execute(
+                    "DELETE FROM parents WHERE url IN (%s)" % ",".join("?" * len(chunk)),
+                    chunk,
+                )
+                deleted += cursor.rowcount
+        return deleted
+
+    def unreferenced_ids(self, ids: Iterable[int]) -> list[int]:
+        """Номера векторов из ids, у которых в базе не осталось ни одного вхождения"""
+        ids = sorted({int(i) for i in ids})
+        referenced = set()
+        # Читается соединением записи: проверка идет сразу после удаления вхождений
+        for start in range(0, len(ids), MAX_QUERY_PARAMS):
+            chunk = ids[start:start + MAX_QUERY_PARAMS]
+            cursor = self.functions_db.execute(
+                "SELECT DISTINCT vector_id FROM occurrences WHERE vector_id IN (%s)" % ",".join("?" * len(chunk)),
+                chunk,
+            )
+            referenced.update(row[0] for row in cursor)
+        return [i for i in ids if i not in referenced]
+
+    def delete_ids(self, ids: Iterable[int]) -> int:
+        """
+        Удаляет строки functions и functions_fts. Вхождения не трогаются: тот же вектор может
+        встречаться в других репозиториях и источниках, удалять стоит только unreferenced_ids.
+        """
+        ids = [int(i) for i in ids]
+        deleted = 0
+        with self.functions_db:
+            for start in range(0, len(ids), MAX_QUERY_PARAMS):
+                chunk = ids[start:start + MAX_QUERY_PARAMS]
+                placeholders = ",".join("?" * len(chunk))
+                cursor = self.functions_db.execute(
+                    "DELETE FROM functions WHERE id IN (%s)" % placeholders,
+                    chunk,
+                )
+                self.functions_db.execute(
+                    "DELETE FROM functions_fts WHERE rowid IN (%s)" % placeholders,
+                    chunk,
+                )
+                deleted += cursor.rowcount
+        return deleted
+
+    def _write_batch(
+        self, functions_batch: list[tuple], occurrences_batch: list[tuple], parents_batch: list[tuple] = ()
+    ) -> int:
+        with self.functions_db:
+            self.functions_db.executemany(
+                "INSERT OR REPLACE INTO functions (id, fn_id, code, url, vector) VALUES (?, ?, ?, ?, ?)",
+                (row[:5] for row in functions_batch),
+            )
+            self.functions_db.executemany(
+                "INSERT OR REPLACE INTO functions_fts (rowid, name, parameters, path, content) VALUES (?, ?, ?, ?, ?)",
+                ((row[0], row[5], row[6], row[3], row[2]) for row in functions_batch),
+            )
+            self.functions_db.executemany(
+                "INSERT INTO occurrences (vector_id, fn_id, url, start_line, end_line, repo, source, kind, path, "
+                "language, parent_id, chunk, module, class_name) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                occurrences_batch,
+            )
+            self.functions_db.executemany(
+                "INSERT OR REPLACE INTO parents (parent_id, url, code, start_line, end_line) VALUES (?, ?, ?, ?, ?)",
+                parents_batch,
+            )
+        return len(occurrences_batch)
+
+    def create_indexes(self) -> None:
+        self.functions_db.execute("CREATE INDEX IF NOT EXISTS functions_fn_id ON functions (fn_id)")
+        self.functions_db.execute("CREATE INDEX IF NOT EXISTS occurrences_vector_id ON occurrences (vector_id)")
+        self.functions_db.execute("CREATE INDEX IF NOT EXISTS occurrences_url ON occurrences (url)")
+        self.functions_db.execute("CREATE INDEX IF NOT EXISTS occurrences_repo ON occurrences (repo)")
+        self.functions_db.commit()
+
     def close_db(self):
         self.functions_db.close()
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
@@ -0,0 +1,50 @@
+from dataclasses import dataclass, replace
+
+# Базы, заполненные до появления метаданных, хранят в source и kind NULL: это функции из Bitbucket
+COLUMN_DEFAULTS = {"source": "bitbucket", "kind": "function"}
+
+
+@dataclass(frozen=True)
+class SearchFilter:
+    """
+    Фильтр поиска по метаданным вхождений: источник (bitbucket, jira, confluence),
+    вид (function, issue, document, ...), репозиторий, префикс пути внутри репозитория и язык.
+
+    Пустое поле не ограничивает выдачу. Вектор подходит, если под фильтр подходит
+    хотя бы одно из его вхождений.
+    """
+
+    sources: tuple[str, ...] = ()
+    kinds: tuple[str, ...] = ()
+    repos: tuple[str, ...] = ()
+    languages: tuple[str, ...] = ()
+    path_prefix: str | None = None
+
+    def is_empty(self) -> bool:
+        return not (self.sources or self.kinds or self.repos or self.languages or self.path_prefix)
+
+    def without_repos(self) -> "SearchFilter":
+        return replace(self, repos=())
+
+    def without_kinds(self) -> "SearchFilter":
+        return replace(self, kinds=())
+
+    def sql(self) -> tuple[str, list]:
+        """Условие на таблицу occurrences (или code_groups с теми же колонками) и его параметры"""
+        conditions, params = [], []
+        for column, values in (
+            ("source", self.sources),
+            ("kind", self.kinds),
+            ("repo", self.repos),
+            ("language", self.languages),
+        ):
+            if values:
+                if column in COLUMN_DEFAULTS:
+                    column = f"coalesce({column}, '{COLUMN_DEFAULTS[column]}')"
+                conditions.append(f"{column} IN ({','.join('?' * len(values))})")
+                params.extend(values)
+        if self.path_prefix:
+            # LIKE в SQLite не различает регистр, префикс сравнивается точно
+            conditions.append("substr(path, 1, ?) = ?")
+            params.extend([len(self.path_prefix), self.path_prefix])
+        return " AND ".join(conditions) or "1", params
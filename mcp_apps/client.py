@@ -1,14 +1,42 @@
+import asyncio
+import json
+import os
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, List, Optional
+
 from fastapi import FastAPI, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import Response, StreamingResponse
 from gigachat import GigaChat
+from gigachat.api import stream_chat
+from gigachat.api.utils import build_x_headers, parse_chunk
+from gigachat.client import _parse_chat
+from gigachat.exceptions import AuthenticationError
 import gigachat.models
-from gigachat.models import Chat, Function, Messages, MessagesRole
+from gigachat.models import Chat, ChatCompletionChunk, ChoicesChunk, Function, Messages, MessagesChunk, MessagesRole
 import mcp
 from mcp import ClientSession, StdioServerParameters
 from mcp.client.stdio import stdio_client
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
+from mcp_apps.metrics import (
+    CHAT_SECONDS,
+    LLM_ROUNDS,
+    TOOL_CALLS,
+    Timings,
+    observe,
+    record_server_metrics,
+    record_stage,
+)
 from repo_funcs_crawler import GIGA_CREDS
 
-app = FastAPI()
+MCP_POOL_SIZE = int(os.getenv("MCP_POOL_SIZE", "4"))
+# Через сколько секунд простоя сессию нужно пинговать перед выдачей
+MCP_POOL_HEALTHCHECK_INTERVAL = float(os.getenv("MCP_POOL_HEALTHCHECK_INTERVAL", "30"))
+MCP_POOL_PING_TIMEOUT = float(os.getenv("MCP_POOL_PING_TIMEOUT", "5"))
+# Максимальное число одновременных запросов к GigaChat со всего воркера
+GIGA_MAX_CONCURRENCY = int(os.getenv("GIGA_MAX_CONCURRENCY", "16"))
 
 server_params = StdioServerParameters(
     command="python",
@@ -16,7 +44,198 @@ server_params = StdioServerParameters(
     env=None,
 )
 
-giga = GigaChat(credentials=GIGA_CREDS, verify_ssl_certs=False)
+
+# В моделях части потокового ответа gigachat 0.1.39 нет functions_state_id, и при разборе оно
+# отбрасывается. Свои модели с этим полем используются только клиентом ниже
+class StateMessagesChunk(MessagesChunk):
+    functions_state_id: Optional[str] = None
+
+
+class StateChoicesChunk(ChoicesChunk):
+    delta: StateMessagesChunk
+
+
+class StateChatCompletionChunk(ChatCompletionChunk):
+    choices: List[StateChoicesChunk]
+
+
+class StreamingGigaChat(GigaChat):
+    """GigaChat, у которого части потокового ответа сохраняют functions_state_id"""
+
+    async def astream(self, payload: Chat) -> AsyncIterator[StateChatCompletionChunk]:
+        # Тот же порядок авторизации, что у GigaChat.astream
+        chat = _parse_chat(payload, self._settings)
+        if self._use_auth:
+            if self._check_validity_token():
+                try:
+                    async for chunk in self._astream_chunks(chat):
+                        yield chunk
+                    return
+                except AuthenticationError:
+                    self._reset_token()
+            await self._aupdate_token()
+        async for chunk in self._astream_chunks(chat):
+            yield chunk
+
+    async def _astream_chunks(self, chat: Chat) -> AsyncIterator[StateChatCompletionChunk]:
+        # stream_chat.asyncio, но части разбираются моделью с functions_state_id
+        kwargs = stream_chat._get_kwargs(chat=chat, access_token=self.token)
+        async with self._aclient.stream(**kwargs) as response:
+            await stream_chat._acheck_response(response)
+            x_headers = build_x_headers(response)
+            async for line in response.aiter_lines():
+                if chunk := parse_chunk(line, StateChatCompletionChunk):
+                    chunk.x_headers = x_headers
+                    yield chunk
+
+
+giga = StreamingGigaChat(credentials=GIGA_CREDS, verify_ssl_certs=False)
+giga_semaphore = asyncio.Semaphore(GIGA_MAX_CONCURRENCY)
+
+
+async def chat_completion(payload: Chat) -> gigachat.models.ChatCompletion:
+    # Асинхронный вызов не блокирует event loop, семафор ограничивает нагрузку на API
+    async with giga_semaphore:
+        return await giga.achat(payload)
+
+
+class PooledSession:
+    """
+    Долгоживущая сессия с подпроцессом server.py.
+
+    stdio_client и ClientSession открываются в отдельной задаче, потому что
+    их контекстные менеджеры должны входить и выходить в одной и той же задаче.
+    """
+
+    def __init__(self, params: StdioServerParameters):
+        self.params = params
+        self.session: ClientSession | None = None
+        self.last_used = 0.0
+        self.needs_check = False
+        self._task: asyncio.Task | None = None
+        self._ready = asyncio.Event()
+        self._stop = asyncio.Event()
+        self._error: BaseException | None = None
+
+    async def start(self) -> None:
+        self._ready.clear()
+        self._stop.clear()
+        self._error = None
+        with observe("mcp_session_start"):
+            self._task = asyncio.create_task(self._run())
+            await self._ready.wait()
+        if self.session is None:
+            raise RuntimeError(f"Не удалось запустить MCP сервер: {self._error!r}")
+        self.last_used = time.monotonic()
+        self.needs_check = False
+
+    async def _run(self) -> None:
+        try:
+            async with stdio_client(self.params) as (read, write):
+                async with ClientSession(read, write) as session:
+                    await session.initialize()
+                    self.session = session
+                    self._ready.set()
+                    await self._stop.wait()
+        except Exception as e:
+            self._error = e
+        finally:
+            self.session = None
+            self._ready.set()
+
+    async def stop(self) -> None:
+        self._stop.set()
+        if self._task is not None:
+            await self._task
+            self._task = None
+
+    async def restart(self) -> None:
+        await self.stop()
+        await self.start()
+
+    @property
+    def alive(self) -> bool:
+        return self.session is not None and self._task is not None and not self._task.done()
+
+    async def is_healthy(self) -> bool:
+        if not self.alive:
+            return False
+        try:
+            await asyncio.wait_for(self.session.send_ping(), timeout=MCP_POOL_PING_TIMEOUT)
+        except Exception:
+            return False
+        return True
+
+
+class MCPSessionPool:
+    """
+    Пул прогретых MCP сессий на всё время жизни приложения.
+
+    Свободные сессии лежат в FIFO очереди, поэтому ожидающие запросы
+    получают сессии в порядке поступления.
+    """
+
+    def __init__(self, params: StdioServerParameters, size: int = MCP_POOL_SIZE):
+        self.params = params
+        self.size = size
+        self._sessions: list[PooledSession] = []
+        self._idle: asyncio.Queue[PooledSession] = asyncio.Queue()
+
+    async def start(self) -> None:
+        self._sessions = [PooledSession(self.params) for _ in range(self.size)]
+        results = await asyncio.gather(*(s.start() for s in self._sessions), return_exceptions=True)
+        for s, res in zip(self._sessions, results):
+            if isinstance(res, Exception):
+                # Упавшая сессия будет перезапущена при первой выдаче
+                print("Ошибка запуска MCP сессии:", res)
+            self._idle.put_nowait(s)
+
+    async def close(self) -> None:
+        await asyncio.gather(*(s.stop() for s in self._sessions), return_exceptions=True)
+        self._sessions = []
+
+    async def _ensure_healthy(self, pooled: PooledSession) -> None:
+        idle_for = time.monotonic() - pooled.last_used
+        if not pooled.alive:
+            print("MCP сессия упала, перезапуск")
+            await pooled.restart()
+        elif pooled.needs_check or idle_for > MCP_POOL_HEALTHCHECK_INTERVAL:
+            if not await pooled.is_healthy():
+                print("MCP сессия не отвечает на ping, перезапуск")
+                await pooled.restart()
+        pooled.needs_check = False
+
+    @asynccontextmanager
+    async def session(self, timings: Timings | None = None):
+        # Ожидание свободной сессии и ее проверка (с возможным перезапуском)
+        started = time.perf_counter()
+        pooled = await self._idle.get()
+        try:
+            await self._ensure_healthy(pooled)
+            record_stage("mcp_session_acquire", time.perf_counter() - started, timings)
+            yield pooled.session
+        except Exception:
+            # Состояние сессии после ошибки неизвестно - проверим при следующей выдаче
+            pooled.needs_check = True
+            raise
+        finally:
+            pooled.last_used = time.monotonic()
+            self._idle.put_nowait(pooled)
+
+
+session_pool = MCPSessionPool(server_params)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await session_pool.start()
+    try:
+        yield
+    finally:
+        await session_pool.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 def convert_tool_to_function(t: mcp.Tool) -> gigachat.models.Function:
@@ -26,73 +245,192 @@ def convert_tool_to_function(t: mcp.Tool) -> gigachat.models.Function:
         "parameters": t.inputSchema,
     })
 
-@app.post("/api/chat")
-async def chat(req: Request):
-    async with stdio_client(server_params) as (read, write):
-        async with ClientSession(read, write) as session:
-            # Initialize the connection
-            await session.initialize()
+async def stream_completion(payload: Chat) -> AsyncIterator[StateChatCompletionChunk]:
+    async with giga_semaphore:
+        async for chunk in giga.astream(payload):
+            yield chunk
 
-            req_d = await req.json()
-            messages = [Messages(**m) for m in req_d["messages"]]
 
-            prompts = await session.list_prompts()
-            print("prompts", prompts)
-            system_prompt = [p for p in prompts.prompts if p.name == "system"][0]
+def split_server_metrics(text: str) -> tuple[str, dict]:
+    # Метрики сервера нужны только клиенту, в контекст GigaChat они не попадают
+    try:
+        result = json.loads(text)
+    except json.JSONDecodeError:
+        return text, {}
+    if not isinstance(result, dict) or "metrics" not in result:
+        return text, {}
+    server_metrics = result.pop("metrics")
+    return json.dumps(result, ensure_ascii=False), server_metrics
+
 
-            messages = [Messages(
-                role=MessagesRole.SYSTEM,
-                content=system_prompt.description,
-            )] + messages
+async def run_conversation(
+    messages: list[Messages], stream: bool, timings: Timings | None = None
+) -> AsyncIterator[tuple[str, dict]]:
+    """
+    Диалог с GigaChat с вызовом MCP инструментов.
 
+    Отдает события по мере выполнения: tool_call, tool_result, token (только при stream=True)
+    и в конце done с полным ответом в прежнем формате {"answer": [...]}.
+    Длительности стадий пишутся в /metrics и в timings, если он передан.
+    """
+    # Сессия берется из пула только на время MCP вызовов,
+    # чтобы не держать ее во время ответов GigaChat
+    async with session_pool.session(timings) as session:
+        with observe("list_prompts", timings):
+            prompts = await session.list_prompts()
+        with observe("list_tools", timings):
             tools = await session.list_tools()
-            available_functions = [convert_tool_to_function(t) for t in tools.tools]
+    print("prompts", prompts)
+    system_prompt = [p for p in prompts.prompts if p.name == "system"][0]
 
-            payload = Chat(
-                model="GigaChat-2-Max",
-                messages=messages,
-                functions=available_functions,
-            )
-            response = giga.chat(payload)
-            choice = response.choices[0]
-
-            answer = []
-
-            # Process response and handle tool calls
-            while True:
-                if choice.finish_reason == "stop":
-                    answer.append({
-                        "role": "assistant",
-                        "content": choice.message.content,
-                    })
-                    return {"answer": answer}
-                elif choice.finish_reason == "function_call":
-                    tool_name = choice.message.function_call.name
-                    tool_args = choice.message.function_call.arguments
-                    print("Execute tool call", tool_name, tool_args)
+    messages = [Messages(
+        role=MessagesRole.SYSTEM,
+        content=system_prompt.description,
+    )] + messages
+
+    available_functions = [convert_tool_to_function(t) for t in tools.tools]
+
+    payload = Chat(
+        model="GigaChat-2-Max",
+        messages=messages,
+        functions=available_functions,
+    )
+
+    answer = []
+    llm_rounds = 0
+
+    # Process response and handle tool calls
+    while True:
+        llm_rounds += 1
+        # В потоковом режиме раунд включает и отдачу токенов клиенту
+        with observe("llm_round", timings):
+            if stream:
+                content_parts = []
+                function_call = None
+                functions_state_id = None
+                finish_reason = None
+                async for chunk in stream_completion(payload):
+                    choice = chunk.choices[0]
+                    if choice.delta.content:
+                        content_parts.append(choice.delta.content)
+                        yield "token", {"content": choice.delta.content}
+                    if choice.delta.function_call:
+                        function_call = choice.delta.function_call
+                    # Состояние вызова нужно вернуть вместе с сообщением, иначе GigaChat его не свяжет с результатом
+                    functions_state_id = choice.delta.functions_state_id or functions_state_id
+                    finish_reason = choice.finish_reason or finish_reason
+                message = Messages(
+                    role=MessagesRole.ASSISTANT,
+                    content="".join(content_parts),
+                    function_call=function_call,
+                    functions_state_id=functions_state_id,
+                )
+            else:
+                response = await chat_completion(payload)
+                message = response.choices[0].message
+                finish_reason = response.choices[0].finish_reason
+
+        if finish_reason != "function_call":
+            LLM_ROUNDS.observe(llm_rounds)
+            answer.append({
+                "role": "assistant",
+                "content": message.content,
+            })
+            yield "done", {"answer": answer}
+            return
+
+        tool_name = message.function_call.name
+        tool_args = message.function_call.arguments
+        print("Execute tool call", tool_name, tool_args)
+        yield "tool_call", {"name": tool_name, "arguments": tool_args}
+        try:
+            with observe("tool_call", timings):
+                async with session_pool.session(timings) as session:
                     func_result = await session.call_tool(tool_name, tool_args)
-                    print("func_result", func_result)
-                    func_result_content = func_result.content[0].text
-                    payload.messages.extend([
-                        choice.message,
-                        Messages(
-                            role=MessagesRole.FUNCTION,
-                            name=tool_name,
-                            content=func_result_content,
-                        )
-                    ])
-                    answer.extend([
-                        {
-                            "role": "assistant",
-                            "content": choice.message.content,
-                            "function_call": choice.message.function_call,
-                        },
-                        {
-                            "role": "function",
-                            "name": tool_name,
-                            "content": func_result_content,
-                        }
-                    ])
-                    # Get next response
-                    response = giga.chat(payload)
-                    choice = response.choices[0]
+        except Exception:
+            TOOL_CALLS.labels(tool_name, "error").inc()
+            raise
+        TOOL_CALLS.labels(tool_name, "error" if func_result.isError else "success").inc()
+        print("func_result", func_result)
+        func_result_content, server_metrics = split_server_metrics(func_result.content[0].text)
+        record_server_metrics(server_metrics, timings)
+        yield "tool_result", {"name": tool_name, "content": func_result_content}
+
+        payload.messages.extend([
+            message,
+            Messages(
+                role=MessagesRole.FUNCTION,
+                name=tool_name,
+                content=func_result_content,
+            )
+        ])
+        answer.extend([
+            {
+                "role": "assistant",
+                "content": message.content,
+                "function_call": message.function_call.dict(),
+            },
+            {
+                "role": "function",
+                "name": tool_name,
+                "content": func_result_content,
+            }
+        ])
+
+
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(jsonable_encoder(data), ensure_ascii=False)}\n\n"
+
+
+def finish_timings(timings: Timings, started: float, stream: bool) -> dict[str, float]:
+    elapsed = time.perf_counter() - started
+    CHAT_SECONDS.labels(str(stream).lower()).observe(elapsed)
+    timings.add("total", elapsed)
+    return timings.to_dict()
+
+
+async def sse_stream(messages: list[Messages], include_timings: bool) -> AsyncIterator[str]:
+    started = time.perf_counter()
+    timings = Timings()
+    # Первое событие уходит сразу, до обращения к MCP и GigaChat
+    yield sse_event("start", {})
+    try:
+        async for event, data in run_conversation(messages, stream=True, timings=timings):
+            if event == "done":
+                breakdown = finish_timings(timings, started, stream=True)
+                if include_timings:
+                    data["timings"] = breakdown
+            yield sse_event(event, data)
+    except Exception as e:
+        yield sse_event("error", {"message": str(e)})
+
+
+@app.post("/api/chat")
+async def chat(req: Request):
+    req_d = await req.json()
+    messages = [Messages(**m) for m in req_d["messages"]]
+    # Разбивка времени по стадиям в ответе - по флагу timings
+    include_timings = bool(req_d.get("timings"))
+
+    # Потоковый режим включается полем stream или заголовком Accept: text/event-stream,
+    # без них ответ остается прежним JSON
+    if req_d.get("stream") or "text/event-stream" in req.headers.get("accept", ""):
+        return StreamingResponse(
+            sse_stream(messages, include_timings),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    started = time.perf_counter()
+    timings = Timings()
+    async for event, data in run_conversation(messages, stream=False, timings=timings):
+        if event == "done":
+            breakdown = finish_timings(timings, started, stream=False)
+            if include_timings:
+                data["timings"] = breakdown
+            return data
+
+
+@app.get("/metrics")
+async def metrics():
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -0,0 +1,128 @@
+import os
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator
+
+import httpx
+from gigachat import GigaChat
+from gigachat.exceptions import AuthenticationError, ResponseError
+
+EMBED_BATCH_SIZE = int(os.getenv("EMBED_BATCH_SIZE", "16"))
+EMBED_CONCURRENCY = int(os.getenv("EMBED_CONCURRENCY", "8"))
+# Запросов в секунду к API эмбеддингов, 0 - без ограничения
+EMBED_RATE_LIMIT = float(os.getenv("EMBED_RATE_LIMIT", "0"))
+EMBED_MAX_RETRIES = int(os.getenv("EMBED_MAX_RETRIES", "5"))
+
+
+class TokenBucket:
+    """Ограничение частоты запросов, общее для всех потоков"""
+
+    def __init__(self, rate: float, capacity: float | None = None):
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self) -> None:
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+def is_transient(e: Exception) -> bool:
+    if isinstance(e, AuthenticationError):
+        return False
+    if isinstance(e, ResponseError) and len(e.args) > 1:
+        status = e.args[1]
+        return status == 429 or status >= 500
+    return isinstance(e, (httpx.TransportError, ResponseError))
+
+
+class Embedder:
+    """
+    Пакетный расчет эмбеддингов пулом потоков с ограничением частоты и повторами.
+
+    Пачки отправляются параллельно, а результаты отдаются в исходном порядке.
+    """
+
+    def __init__(
+        self,
+        giga_creds: str,
+        model: str,
+        batch_size: int = EMBED_BATCH_SIZE,
+        concurrency: int = EMBED_CONCURRENCY,
+        rate_limit: float = EMBED_RATE_LIMIT,
+        max_retries: int = EMBED_MAX_RETRIES,
+    ):
+        self.giga_creds = giga_creds
+        self.model = model
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self._bucket = TokenBucket(rate_limit)
+
+    def client(self) -> GigaChat:
+        return GigaChat(credentials=self.giga_creds, verify_ssl_certs=False)
+
+    def embed_batch(self, giga: GigaChat, texts: list[str]) -> list[list[float]]:
+        """Одна пачка через переданный клиент: с ограничением частоты и повторами"""
+        for attempt in range(self.max_retries + 1):
+            self._bucket.acquire()
+            try:
+                embs = giga.embeddings(texts=texts, model=self.model)
+                return [e.embedding for e in embs.data]
+            except Exception as e:
+                if attempt == self.max_retries or not is_transient(e):
+                    raise
+                delay = min(60.0, 2 ** attempt) * (0.5 + random.random())
+                print(f"Ошибка эмбеддингов ({e!r}), повтор через {delay:.1f} с")
+                time.sleep(delay)
+
+    def embed_batches(self, items: Iterable[dict], text_key: str = "content") -> Iterator[tuple[list[dict], list[list[float]]]]:
+        """
+        Отдает пары (пачка элементов, их эмбеддинги) в порядке входа.
+        Одновременно в работе не больше 2 * concurrency пачек, поэтому вход читается лениво.
+        """
+        def batches() -> Iterator[list[dict]]:
+            batch = []
+            for item in items:
+                batch.append(item)
+                if len(batch) == self.batch_size:
+                    yield batch
+                    batch = []
+            if batch:
+                yield batch
+
+        with (
+            self.client() as giga,
+            ThreadPoolExecutor(max_workers=self.concurrency) as executor,
+        ):
+            in_flight = deque()
+            for batch in batches():
+                texts = [item[text_key] for item in batch]
+                in_flight.append((batch, executor.submit(self.embed_batch, giga, texts)))
+                if len(in_flight) >= 2 * self.concurrency:
+                    batch, future = in_flight.popleft()
+                    yield batch, future.result()
+            while in_flight:
+                batch, future = in_flight.popleft()
+                yield batch, future.result()
+
+    def embed(self, texts: list[str]) -> list[list[float]]:
+        vectors = []
+        for _, batch_vectors in self.embed_batches({"content": t} for t in texts):
+            vectors.extend(batch_vectors)
+        return vectors
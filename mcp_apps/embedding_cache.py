@@ -0,0 +1,164 @@
+import hashlib
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+
+
+def normalize_query(text: str) -> str:
+    # Запросы, отличающиеся только пробелами и переводами строк, считаем одинаковыми
+    return " ".join(text.split())
+
+
+class EmbeddingCache:
+    """
+    Двухуровневый кэш эмбеддингов запросов: LRU в памяти процесса и SQLite на диске.
+
+    Ключ - нормализованный текст запроса вместе с названием модели эмбеддингов.
+    Векторы на диске хранятся как float32 BLOB.
+    """
+
+    def __init__(
+        self,
+        db_path: Path,
+        max_memory_items: int = 10_000,
+        max_disk_items: int = 1_000_000,
+        ttl_seconds: float = 30 * 24 * 3600,
+    ):
+        self.db_path = Path(db_path)
+        self.max_memory_items = max_memory_items
+        self.max_disk_items = max_disk_items
+        self.ttl_seconds = ttl_seconds
+        self.stats = {"memory_hits": 0, "disk_hits": 0, "misses": 0}
+
+        self._memory: OrderedDict[str, tuple[float, np.ndarray]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._db: sqlite3.Connection | None = None
+        self._puts_since_evict = 0
+
+    @staticmethod
+    def make_key(text: str, model: str) -> str:
+        return hashlib.sha1(f"{model}\0{normalize_query(text)}".encode()).hexdigest()
+
+    def _connection(self) -> sqlite3.Connection:
+        # Файл создается при первом обращении, а не при импорте модуля
+        if self._db is None:
+            self.db_path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS query_embeddings (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    vector BLOB NOT NULL,
+                    created_at REAL NOT NULL,
+                    last_used REAL NOT NULL
+                )
+            """)
+            self._db.execute(
+                "CREATE INDEX IF NOT EXISTS query_embeddings_last_used ON query_embeddings (last_used)"
+            )
+            self._db.commit()
+        return self._db
+
+    def _remember(self, key: str, created_at: float, vector: np.ndarray) -> None:
+        self._memory[key] = (created_at, vector)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_items:
+            self._memory.popitem(last=False)
+
+    def get(self, text: str, model: str) -> np.ndarray | None:
+        key = self.make_key(text, model)
+        now = time.time()
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None:
+                created_at, vector = item
+                if now - created_at <= self.ttl_seconds:
+                    self._memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return vector
+                del self._memory[key]
+
+            db = self._connection()
+            row = db.execute(
+                "SELECT vector, created_at FROM query_embeddings WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and now - row[1] <= self.ttl_seconds:
+                vector = np.frombuffer(row[0], dtype="float32")
+                db.execute("UPDATE query_embeddings SET last_used = ? WHERE key = ?", (now, key))
+                db.commit()
+                self._remember(key, row[1], vector)
+                self.stats["disk_hits"] += 1
+                return vector
+
+            self.stats["misses"] += 1
+            return None
+
+    def put(self, text: str, model: str, vector) -> np.ndarray:
+        key = self.make_key(text, model)
+        vector = np.asarray(vector, dtype="float32")
+        now = time.time()
+        with self._lock:
+            self._remember(key, now, vector)
+            db = self._connection()
+            db.execute(
+                "INSERT OR REPLACE INTO query_embeddings (key, model, vector, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, model, vector.tobytes(), now, now),
+            )
+            db.commit()
+            self._puts_since_evict += 1
+            if self._puts_since_evict >= 1000:
+                self._evict_disk(now)
+        return vector
+
+    def _evict_disk(self, now: float) -> None:
+        db = self._connection()
+        db.execute("DELETE FROM query_embeddings WHERE created_at < ?", (now - self.ttl_seconds,))
+        db.execute(
+            """
+            DELETE FROM query_embeddings WHERE key IN (
+                SELECT key FROM query_embeddings ORDER BY last_used DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (self.max_disk_items,),
+        )
+        db.commit()
+        self._puts_since_evict = 0
+
+    def get_or_compute(
+        self,
+        texts: list[str],
+        model: str,
+        compute: Callable[[list[str]], list[list[float]]],
+    ) -> list[np.ndarray]:
+        """
+        Возвращает эмбеддинги для texts, вызывая compute только для отсутствующих в кэше.
+        Одинаковые тексты внутри одного вызова считаются один раз.
+        """
+        result: list[np.ndarray | None] = [self.get(t, model) for t in texts]
+
+        missing: dict[str, list[int]] = {}
+        for i, (text, vector) in enumerate(zip(texts, result)):
+            if vector is None:
+                missing.setdefault(normalize_query(text), []).append(i)
+
+        if missing:
+            missing_texts = list(missing)
+            for text, vector in zip(missing_texts, compute(missing_texts)):
+                vector = self.put(text, model, vector)
+                for i in missing[text]:
+                    result[i] = vector
+
+        return result
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,183 @@
+import json
+import os
+from pathlib import Path
+from typing import Iterator, Sequence
+
+import numpy as np
+
+# Ширина ячейки в таблице id: хватает для uuid и для hex-хэша sha256
+DEFAULT_ID_WIDTH = 64
+
+
+def store_path_for(embeddings_file_path: Path) -> Path:
+    # embeddings/<repo>.jsonl -> embeddings/<repo>.{vectors,ids,meta.json}
+    return Path(embeddings_file_path).with_suffix("")
+
+
+def _files(store_path: Path) -> tuple[Path, Path, Path]:
+    store_path = Path(store_path)
+    return (
+        store_path.with_name(store_path.name + ".vectors"),
+        store_path.with_name(store_path.name + ".ids"),
+        store_path.with_name(store_path.name + ".meta.json"),
+    )
+
+
+class EmbeddingStoreWriter:
+    """
+    Потоковая запись бинарного хранилища эмбеддингов.
+
+    Векторы пишутся подряд одной матрицей float32/float16 без заголовка,
+    id - таблицей строк фиксированной ширины. Файл meta.json пишется последним
+    и при каждой контрольной точке, в нем число зафиксированных строк.
+    """
+
+    def __init__(
+        self,
+        store_path: Path,
+        dtype: str = "float32",
+        id_width: int = DEFAULT_ID_WIDTH,
+        append: bool = False,
+    ):
+        self.vectors_path, self.ids_path, self.meta_path = _files(store_path)
+        self.dtype = np.dtype(dtype)
+        self.id_width = id_width
+        self.dim = None
+        self.count = 0
+
+        if append and self.meta_path.exists():
+            meta = json.loads(self.meta_path.read_text())
+            self.dtype = np.dtype(meta["dtype"])
+            self.id_width = meta["id_width"]
+            self.dim = meta["dim"]
+            self.count = meta["count"]
+        else:
+            append = False
+            self.meta_path.unlink(missing_ok=True)
+
+        if append:
+            # Отбрасываем то, что было записано после последней контрольной точки
+            os.truncate(self.vectors_path, self.count * (self.dim or 0) * self.dtype.itemsize)
+            os.truncate(self.ids_path, self.count * self.id_width)
+        mode = "ab" if append else "wb"
+        self._vectors_fd = open(self.vectors_path, mode)
+        self._ids_fd = open(self.ids_path, mode)
+
+    def add(self, ids: Sequence[str], vectors) -> None:
+        vectors = np.asarray(vectors, dtype=self.dtype)
+        if vectors.ndim != 2 or len(ids) != vectors.shape[0]:
+            raise ValueError("ids и vectors должны иметь одинаковую длину")
+        if self.dim is None:
+            self.dim = vectors.shape[1]
+        elif vectors.shape[1] != self.dim:
+            raise ValueError(f"Размерность {vectors.shape[1]} не совпадает с {self.dim}")
+
+        encoded = [i.encode() for i in ids]
+        if any(len(i) > self.id_width for i in encoded):
+            raise ValueError(f"id длиннее {self.id_width} байт")
+
+        self._vectors_fd.write(np.ascontiguousarray(vectors).tobytes())
+        self._ids_fd.write(np.array(encoded, dtype=f"S{self.id_width}").tobytes())
+        self.count += len(ids)
+
+    def checkpoint(self) -> None:
+        """Сбрасывает данные на диск и фиксирует их в meta.json, чтобы после падения продолжить с этого места"""
+        self._vectors_fd.flush()
+        self._ids_fd.flush()
+        self._write_meta()
+
+    def _write_meta(self) -> None:
+        tmp_path = self.meta_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps({
+            "dim": self.dim,
+            "dtype": self.dtype.name,
+            "id_width": self.id_width,
+            "count": self.count,
+        }))
+        tmp_path.replace(self.meta_path)
+
+    def close(self) -> None:
+        self._vectors_fd.close()
+        self._ids_fd.close()
+        self._write_meta()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+class IdTable:
+    """Таблица id поверх memmap, отдает строки по номеру строки индекса"""
+
+    def __init__(self, raw: np.ndarray):
+        self.raw = raw
+
+    def __len__(self) -> int:
+        return len(self.raw)
+
+    def __getitem__(self, i: int) -> str:
+        return self.raw[i].decode()
+
+    def __iter__(self) -> Iterator[str]:
+        for i in range(len(self.raw)):
+            yield self.raw[i].decode()
+
+
+class EmbeddingStore:
+    def __init__(self, store_path: Path):
+        self.vectors_path, self.ids_path, self.meta_path = _files(store_path)
+        meta = json.loads(self.meta_path.read_text())
+        self.dim = meta["dim"]
+        self.count = meta["count"]
+        self.dtype = np.dtype(meta["dtype"])
+
+        if self.count:
+            self.vectors = np.memmap(self.vectors_path, dtype=self.dtype, mode="r", shape=(self.count, self.dim))
+            raw_ids = np.memmap(self.ids_path, dtype=f"S{meta['id_width']}", mode="r", shape=(self.count,))
+        else:
+            self.vectors = np.empty((0, self.dim or 0), dtype=self.dtype)
+            raw_ids = np.empty((0,), dtype=f"S{meta['id_width']}")
+        self.ids = IdTable(raw_ids)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def iter_batches(self, batch_size: int = 65536) -> Iterator[np.ndarray]:
+        # Пачки float32 без копирования всего файла в память
+        for start in range(0, self.count, batch_size):
+            yield np.array(self.vectors[start:start + batch_size], dtype="float32")
+
+
+def convert_jsonl_to_store(embeddings_file_path: Path, store_path: Path, dtype: str = "float32") -> Path:
+    batch_ids, batch_vectors = [], []
+    with open(embeddings_file_path, "r") as fd, EmbeddingStoreWriter(store_path, dtype=dtype) as writer:
+        for line in fd:
+            e = json.loads(line)
+            batch_ids.append(e["id"])
+            batch_vectors.append(e["embedding"])
+            if len(batch_ids) == 10_000:
+                writer.add(batch_ids, batch_vectors)
+                batch_ids, batch_vectors = [], []
+        if batch_ids:
+            writer.add(batch_ids, batch_vectors)
+    return store_path
+
+
+def open_embedding_store(embeddings_file_path: Path, dtype: str = "float32") -> EmbeddingStore:
+    """
+    Открывает бинарное хранилище рядом с embeddings.jsonl.
+    Если его еще нет, один раз конвертирует JSONL.
+    """
+    store_path = store_path_for(embeddings_file_path)
+    meta_path = _files(store_path)[2]
+    stale = (
+        meta_path.exists()
+        and Path(embeddings_file_path).exists()
+        and Path(embeddings_file_path).stat().st_mtime > meta_path.stat().st_mtime
+    )
+    if stale or not meta_path.exists():
+        print(f"Конвертация {embeddings_file_path} в бинарный формат")
+        convert_jsonl_to_store(embeddings_file_path, store_path, dtype=dtype)
+    return EmbeddingStore(store_path)
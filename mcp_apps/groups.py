@@ -0,0 +1,170 @@
+import argparse
+import os
+import time
+from itertools import groupby
+from pathlib import Path
+from typing import Sequence
+
+import faiss
+import numpy as np
+
+from db.adapter import DBAdapter
+from mcp_apps.embedding_store import EmbeddingStore, open_embedding_store
+from mcp_apps.index_factory import load_index, save_index
+from mcp_apps.repo_funcs_crawler import EMBEDDINGS_STORE_DTYPE
+
+INDEX_GROUPS_DIR = Path(os.getenv("INDEX_GROUPS_DIR", Path(__file__).parent / "indexes" / "groups"))
+# Уровни крупнее функции: class - TargetEnum.object, repository - TargetEnum.repository
+GROUP_KINDS = ("class", "module", "repository")
+# Сколько групп копится перед добавлением в индекс
+GROUP_BATCH_SIZE = 4096
+
+
+def group_index_path(kind: str, groups_dir: Path = INDEX_GROUPS_DIR) -> Path:
+    return Path(groups_dir) / f"{kind}.faiss"
+
+
+def load_group_indexes(groups_dir: Path = INDEX_GROUPS_DIR) -> dict[str, faiss.Index]:
+    """Собранные индексы уровней, отсутствующие уровни пропускаются"""
+    return {
+        kind: load_index(group_index_path(kind, groups_dir))
+        for kind in GROUP_KINDS
+        if group_index_path(kind, groups_dir).exists()
+    }
+
+
+def pooled_vector(total: np.ndarray) -> np.ndarray:
+    # Сумма нормированных векторов функций, нормированная: косинус с запросом - близость к "среднему" члену группы
+    norm = np.linalg.norm(total)
+    return (total / norm if norm > 0 else total).astype("float32")
+
+
+class GroupIndexBuilder:
+    """Копит векторы и строки групп одного уровня, label - следующий свободный номер в индексе уровня"""
+
+    def __init__(self, kind: str, index: faiss.Index, next_label: int):
+        self.kind = kind
+        self.index = index
+        self.next_label = next_label
+        self.rows: list[dict] = []
+        self._vectors: list[np.ndarray] = []
+        self._labels: list[int] = []
+
+    def add(self, row: dict, total: np.ndarray, size: int) -> None:
+        self.rows.append({**row, "kind": self.kind, "label": self.next_label, "size": size})
+        self._vectors.append(pooled_vector(total))
+        self._labels.append(self.next_label)
+        self.next_label += 1
+        if len(self._vectors) >= GROUP_BATCH_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        if self._vectors:
+            self.index.add_with_ids(np.stack(self._vectors), np.array(self._labels, dtype="int64"))
+            self._vectors, self._labels = [], []
+
+
+def build_group_indexes(
+    db_adapter: DBAdapter,
+    store: EmbeddingStore,
+    groups_dir: Path = INDEX_GROUPS_DIR,
+    repos: Sequence[str] | None = None,
+) -> dict[str, int]:
+    """
+    Строит индексы классов, модулей и репозиториев по уже заполненной базе и хранилищу эмбеддингов.
+
+    Вектор группы - нормированная сумма нормированных векторов ее функций (вместе с частями
+    длинных функций). Групп на порядки меньше, чем функций, поэтому индексы уровней - Flat.
+    Вхождения читаются из базы по модулям, векторы модуля поднимаются из хранилища одной выборкой,
+    так что в памяти одновременно только один модуль и сумма его репозитория.
+    repos пересобирает группы только этих репозиториев, остальные остаются в индексах как есть.
+    """
+    groups_dir = Path(groups_dir)
+    groups_dir.mkdir(parents=True, exist_ok=True)
+    started = time.perf_counter()
+
+    if repos and not all(group_index_path(kind, groups_dir).exists() for kind in GROUP_KINDS):
+        print("Индексы групп еще не собраны, собираются для всех репозиториев")
+        repos = None
+
+    builders = {}
+    for kind in GROUP_KINDS:
+        if repos:
+            index = load_index(group_index_path(kind, groups_dir))
+            index.remove_ids(db_adapter.group_labels(kind, repos))
+        else:
+            index = faiss.IndexIDMap2(faiss.IndexFlatIP(store.dim))
+        # При частичной сборке новые группы получают номера после всех существующих
+        builders[kind] = GroupIndexBuilder(kind, index, db_adapter.next_group_label(kind) if repos else 0)
+
+    members = db_adapter.iter_code_members(repos)
+    for repo, repo_members in groupby(members, key=lambda row: row["repo"]):
+        repo_total, repo_size = np.zeros(store.dim, dtype="float64"), 0
+        for path, module_members in groupby(repo_members, key=lambda row: row["path"]):
+            module_members = [row for row in module_members if row["vector_id"] < store.count]
+            if not module_members:
+                continue
+            labels = np.unique([row["vector_id"] for row in module_members])
+            vectors = np.array(store.vectors[labels], dtype="float32")
+            faiss.normalize_L2(vectors)
+            position = {int(label): i for i, label in enumerate(labels)}
+
+            first = module_members[0]
+            module = first["module"] or path
+            base = {
+                "repo": repo,
+                "source": first["source"],
+                "path": path,
+                "url": first["url"],
+                "language": first["language"],
+            }
+            module_total = vectors.sum(axis=0)
+            builders["module"].add({**base, "name": module}, module_total, len(labels))
+
+            classes = {}
+            for row in module_members:
+                if row["class_name"]:
+                    classes.setdefault(row["class_name"], set()).add(position[row["vector_id"]])
+            for class_name, rows in sorted(classes.items()):
+                rows = sorted(rows)
+                builders["class"].add(
+                    {**base, "name": f"{module}.{class_name}", "class_name": class_name},
+                    vectors[rows].sum(axis=0),
+                    len(rows),
+                )
+
+            repo_total += module_total
+            repo_size += len(labels)
+        if repo_size:
+            builders["repository"].add({"repo": repo, "source": base["source"], "name": repo}, repo_total, repo_size)
+
+    # Строки пишутся после чтения вхождений, чтобы запись не ждала открытое чтение
+    sizes = {}
+    for kind, builder in builders.items():
+        builder.flush()
+        db_adapter.replace_groups(kind, builder.rows, repos)
+        save_index(builder.index, group_index_path(kind, groups_dir), {"factory": "Flat"})
+        sizes[kind] = builder.index.ntotal
+    print(f"Индексы групп {sizes} за {time.perf_counter() - started:.2f} с")
+    return sizes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сборка индексов классов, модулей и репозиториев.")
+    parser.add_argument("--embeddings", default=os.getenv("EMBEDDINGS_PATH"), help="Путь к JSONL с эмбеддингами")
+    parser.add_argument("--groups-dir", default=INDEX_GROUPS_DIR, help="Папка с индексами групп")
+    parser.add_argument("--repo", action="append", dest="repos",
+                        help="Пересобрать группы только этого репозитория, можно указать несколько раз")
+    args = parser.parse_args()
+
+    db_adapter = DBAdapter()
+    db_adapter.init_db()
+    try:
+        build_group_indexes(
+            db_adapter,
+            open_embedding_store(Path(args.embeddings), dtype=EMBEDDINGS_STORE_DTYPE),
+            groups_dir=Path(args.groups_dir),
+            repos=args.repos,
+        )
+    finally:
+        db_adapter.close_db()
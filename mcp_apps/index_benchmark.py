@@ -0,0 +1,91 @@
+import argparse
+import time
+from pathlib import Path
+
+import faiss
+import numpy as np
+
+from mcp_apps.embedding_store import open_embedding_store
+from mcp_apps.index_factory import apply_search_params, build_index
+
+
+def make_queries(vectors: np.ndarray, n_queries: int, noise: float, seed: int = 0) -> np.ndarray:
+    # Запросы - случайные векторы корпуса с шумом, чтобы ближайший сосед не был тривиальным
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(vectors), size=min(n_queries, len(vectors)), replace=False)
+    queries = np.array(vectors[rows], dtype="float32")
+    queries += rng.normal(scale=noise, size=queries.shape).astype("float32") * np.abs(queries).mean()
+    faiss.normalize_L2(queries)
+    return queries
+
+
+def recall_at_k(found: np.ndarray, truth: np.ndarray) -> float:
+    hits = sum(len(set(f[f >= 0]) & set(t)) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def measure(index: faiss.Index, queries: np.ndarray, k: int) -> tuple[np.ndarray, float]:
+    started = time.perf_counter()
+    _, found = index.search(queries, k)
+    elapsed = time.perf_counter() - started
+    return found, len(queries) / elapsed
+
+
+def main(embeddings_path: Path, factories: list[str], n_queries: int, k: int, noise: float,
+         nprobes: list[int], ef_searches: list[int]):
+    store = open_embedding_store(embeddings_path)
+    print(f"Корпус: {store.count} векторов, размерность {store.dim}")
+
+    flat, _ = build_index(store, factory="Flat")
+    queries = make_queries(store.vectors, n_queries, noise)
+    truth, flat_qps = measure(flat, queries, k)
+    flat_mb = len(faiss.serialize_index(flat)) / 2 ** 20
+
+    print(f"{'index':<24} {'params':<14} {'recall@' + str(k):>10} {'QPS':>10} {'MB':>9} {'build s':>8}")
+    print(f"{'Flat':<24} {'':<14} {1.0:>10.4f} {flat_qps:>10.0f} {flat_mb:>9.1f} {'':>8}")
+
+    for factory in factories:
+        started = time.perf_counter()
+        index, params = build_index(store, factory=factory)
+        build_time = time.perf_counter() - started
+        size_mb = len(faiss.serialize_index(index)) / 2 ** 20
+
+        variants = [{}]
+        if "IVF" in params["factory"]:
+            variants = [{"nprobe": n} for n in nprobes]
+        elif "HNSW" in params["factory"]:
+            variants = [{"efSearch": ef} for ef in ef_searches]
+
+        for variant in variants:
+            apply_search_params(index, variant)
+            found, qps = measure(index, queries, k)
+            label = ",".join(f"{key}={value}" for key, value in variant.items())
+            print(
+                f"{params['factory']:<24} {label:<14} {recall_at_k(found, truth):>10.4f} "
+                f"{qps:>10.0f} {size_mb:>9.1f} {build_time:>8.2f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Сравнение типов индексов FAISS: recall@k относительно Flat, QPS и размер."
+    )
+    parser.add_argument("--embeddings", required=True, help="Путь к embeddings.jsonl или бинарному хранилищу")
+    parser.add_argument("--factory", action="append", dest="factories",
+                        help="Строка faiss.index_factory, можно указать несколько раз")
+    parser.add_argument("--queries", type=int, default=1000, help="Количество запросов")
+    parser.add_argument("--k", type=int, default=10, help="Размер выдачи")
+    parser.add_argument("--noise", type=float, default=0.1, help="Доля шума в запросах")
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 16, 64], help="Значения nprobe для IVF")
+    parser.add_argument("--ef-search", type=int, nargs="+", default=[16, 64, 256], help="Значения efSearch для HNSW")
+    args = parser.parse_args()
+
+    main(
+        Path(args.embeddings),
+        args.factories or ["IVF1024,Flat", "IVF1024,PQ32", "HNSW32"],
+        args.queries,
+        args.k,
+        args.noise,
+        args.nprobe,
+        args.ef_search,
+    )
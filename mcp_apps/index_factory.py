@@ -0,0 +1,204 @@
+import json
+import os
+import re
+from pathlib import Path
+
+import faiss
+import numpy as np
+
+from mcp_apps.embedding_store import EmbeddingStore
+
+# Строка faiss.index_factory: Flat, IVF1024,Flat, IVF1024,PQ32, HNSW32 и т.д.
+INDEX_FACTORY = os.getenv("INDEX_FACTORY", "Flat")
+INDEX_NPROBE = int(os.getenv("INDEX_NPROBE", "16"))
+INDEX_EF_SEARCH = int(os.getenv("INDEX_EF_SEARCH", "64"))
+INDEX_TRAIN_SAMPLE = int(os.getenv("INDEX_TRAIN_SAMPLE", "100000"))
+# До скольких подходящих под фильтр векторов HNSW может добрать выдачу точным поиском
+FILTER_EXACT_MAX = int(os.getenv("FILTER_EXACT_MAX", "50000"))
+
+
+def params_path_for(index_file_path: Path) -> Path:
+    index_file_path = Path(index_file_path)
+    return index_file_path.with_name(index_file_path.name + ".params.json")
+
+
+def default_search_params(factory: str) -> dict:
+    params = {}
+    if "IVF" in factory:
+        params["nprobe"] = INDEX_NPROBE
+    if "HNSW" in factory:
+        params["efSearch"] = INDEX_EF_SEARCH
+    return params
+
+
+def apply_search_params(index: faiss.Index, params: dict) -> None:
+    if params:
+        # ParameterSpace сам находит вложенные IVF/HNSW индексы, например внутри IDMap
+        faiss.ParameterSpace().set_index_parameters(
+            index, ",".join(f"{k}={v}" for k, v in params.items())
+        )
+
+
+def _search_only(params: dict) -> dict:
+    return {k: v for k, v in params.items() if k != "factory"}
+
+
+def sample_for_training(
+    store: EmbeddingStore, sample_size: int, seed: int = 0, labels: np.ndarray | None = None
+) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    if labels is None:
+        labels = np.arange(store.count)
+    if len(labels) <= sample_size:
+        rows = labels
+    else:
+        rows = np.sort(rng.choice(labels, size=sample_size, replace=False))
+    sample = np.array(store.vectors[rows], dtype="float32")
+    faiss.normalize_L2(sample)
+    return sample
+
+
+def _min_train_size(factory: str) -> int:
+    match = re.search(r"IVF(\d+)", factory)
+    return int(match.group(1)) if match else 0
+
+
+def build_index(
+    store: EmbeddingStore,
+    factory: str = INDEX_FACTORY,
+    search_params: dict | None = None,
+    train_sample: int = INDEX_TRAIN_SAMPLE,
+    labels: np.ndarray | None = None,
+) -> tuple[faiss.Index, dict]:
+    """
+    Строит индекс по строке faiss.index_factory с метрикой скалярного произведения.
+
+    Индексы, требующие обучения, обучаются на случайной выборке из хранилища.
+    Индекс оборачивается в IDMap2, label вектора - номер строки в хранилище.
+    labels ограничивает индекс частью строк хранилища (шард одного репозитория).
+    Возвращает индекс и параметры поиска, которые нужно сохранить рядом с ним.
+    """
+    count = store.count if labels is None else len(labels)
+    if count < _min_train_size(factory):
+        print(f"Корпус из {count} векторов слишком мал для {factory}, используется Flat")
+        factory = "Flat"
+
+    # IDMap2 позволяет добавлять и удалять векторы по label при инкрементальной переиндексации.
+    # Label равен номеру строки в хранилище эмбеддингов
+    index = faiss.IndexIDMap2(faiss.index_factory(store.dim, factory, faiss.METRIC_INNER_PRODUCT))
+    if not index.is_trained:
+        index.train(sample_for_training(store, train_sample, labels=labels))
+
+    if labels is None:
+        start = 0
+        for batch in store.iter_batches():
+            faiss.normalize_L2(batch)
+            index.add_with_ids(batch, np.arange(start, start + len(batch), dtype="int64"))
+            start += len(batch)
+    else:
+        labels = np.asarray(labels, dtype="int64")
+        for start in range(0, len(labels), 65536):
+            rows = labels[start:start + 65536]
+            batch = np.array(store.vectors[rows], dtype="float32")
+            faiss.normalize_L2(batch)
+            index.add_with_ids(batch, rows)
+
+    params = {"factory": factory, **default_search_params(factory), **(search_params or {})}
+    apply_search_params(index, _search_only(params))
+    return index, params
+
+
+def save_index(index: faiss.Index, index_file_path: Path, params: dict) -> None:
+    faiss.write_index(index, str(index_file_path))
+    params_path_for(index_file_path).write_text(json.dumps(params, indent=2))
+
+
+def load_index_params(index_file_path: Path) -> dict:
+    params_path = params_path_for(index_file_path)
+    if params_path.exists():
+        return json.loads(params_path.read_text())
+    return {}
+
+
+def load_index(index_file_path: Path) -> faiss.Index:
+    index = faiss.read_index(str(index_file_path))
+    apply_search_params(index, _search_only(load_index_params(index_file_path)))
+    return index
+
+
+class LabelSelector:
+    """
+    Множество label, подходящих под фильтр, в виде битовой маски для faiss.IDSelectorBitmap.
+    Проверка принадлежности внутри index.search - O(1), маска строится один раз на фильтр.
+    """
+
+    def __init__(self, labels: np.ndarray):
+        self.labels = np.asarray(labels, dtype="int64")
+        self.mask = np.zeros(int(self.labels.max()) + 1 if len(self.labels) else 1, dtype=bool)
+        self.mask[self.labels] = True
+        # Маска должна жить, пока жив селектор: FAISS хранит только указатель
+        self.bitmap = np.packbits(self.mask, bitorder="little")
+        self.selector = faiss.IDSelectorBitmap(len(self.bitmap), faiss.swig_ptr(self.bitmap))
+        self._in_index: dict[int, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self.labels)
+
+    def labels_in(self, index: faiss.Index) -> np.ndarray:
+        """Подходящие label, которые есть в этом индексе (для шарда - только его часть)"""
+        key = id(index)
+        if key not in self._in_index:
+            ids = faiss.vector_to_array(index.id_map)
+            ids = ids[ids < len(self.mask)]
+            self._in_index[key] = ids[self.mask[ids]]
+        return self._in_index[key]
+
+
+def search_parameters(index: faiss.Index, selector: LabelSelector, exhaustive: bool = False) -> faiss.SearchParameters:
+    # SearchParameters заменяют параметры, заданные через ParameterSpace, поэтому переносим их.
+    # IDMap2 сам переводит внутренние номера в label перед проверкой селектором
+    inner = faiss.downcast_index(index.index)
+    ivf = faiss.try_extract_index_ivf(inner)
+    if ivf is not None:
+        return faiss.SearchParametersIVF(sel=selector.selector, nprobe=ivf.nlist if exhaustive else ivf.nprobe)
+    if isinstance(inner, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(sel=selector.selector, efSearch=inner.hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector.selector)
+
+
+def exact_search(index: faiss.Index, x: np.ndarray, k: int, labels: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    vectors = index.reconstruct_batch(labels)
+    scores = x @ vectors.T
+    top = np.argsort(-scores, axis=1, kind="stable")[:, :k]
+    distances = np.full((len(x), k), -np.inf, dtype="float32")
+    found = np.full((len(x), k), -1, dtype="int64")
+    distances[:, :top.shape[1]] = np.take_along_axis(scores, top, axis=1)
+    found[:, :top.shape[1]] = labels[top]
+    return distances, found
+
+
+def filtered_search(
+    index: faiss.Index, x: np.ndarray, k: int, selector: LabelSelector
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Поиск только среди векторов из selector, фильтр проверяется внутри FAISS.
+
+    Flat с фильтром точен. IVF с малым nprobe и HNSW при редком фильтре могут вернуть
+    меньше k, тогда IVF повторяется по всем спискам, а HNSW добирается точным
+    поиском по подходящим векторам.
+    """
+    expected = min(k, len(selector.labels_in(index)))
+    if expected == 0:
+        return np.full((len(x), k), -np.inf, dtype="float32"), np.full((len(x), k), -1, dtype="int64")
+
+    distances, found = index.search(x, k, params=search_parameters(index, selector))
+    if (found >= 0).sum(axis=1).min() >= expected:
+        return distances, found
+
+    if faiss.try_extract_index_ivf(index.index) is not None:
+        return index.search(x, k, params=search_parameters(index, selector, exhaustive=True))
+    labels = selector.labels_in(index)
+    if len(labels) <= FILTER_EXACT_MAX:
+        return exact_search(index, x, k, labels)
+    return distances, found
+
@@ -0,0 +1,83 @@
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+from prometheus_client import Counter, Histogram
+
+STAGE_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+STAGE_SECONDS = Histogram(
+    "agent_stage_seconds",
+    "Длительность стадий обработки запроса",
+    ["stage"],
+    buckets=STAGE_BUCKETS,
+)
+CHAT_SECONDS = Histogram(
+    "agent_chat_seconds",
+    "Полное время ответа /api/chat",
+    ["stream"],
+    buckets=STAGE_BUCKETS,
+)
+TOOL_CALLS = Counter("agent_tool_calls_total", "Вызовы MCP инструментов", ["tool", "status"])
+LLM_ROUNDS = Histogram(
+    "agent_llm_rounds_per_conversation",
+    "Число запросов к GigaChat за один диалог",
+    buckets=(1, 2, 3, 4, 5, 6, 8, 10, 15),
+)
+EMBEDDING_CACHE = Counter(
+    "agent_embedding_cache_requests_total",
+    "Обращения к кэшу эмбеддингов запросов",
+    ["result"],
+)
+
+
+class Timings:
+    """
+    Длительности стадий одного запроса в секундах.
+
+    Повторяющиеся стадии (несколько раундов GigaChat) суммируются.
+    Работает и в процессе MCP сервера, где Prometheus не опрашивается:
+    там длительности возвращаются клиенту вместе с результатом инструмента.
+    """
+
+    def __init__(self):
+        self.stages: dict[str, float] = {}
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - started)
+
+    def to_dict(self) -> dict[str, float]:
+        return {stage: round(seconds, 6) for stage, seconds in self.stages.items()}
+
+
+def record_stage(stage: str, seconds: float, timings: Timings | None = None) -> None:
+    """Записывает длительность в гистограмму и, если передан, в разбивку запроса"""
+    STAGE_SECONDS.labels(stage).observe(seconds)
+    if timings is not None:
+        timings.add(stage, seconds)
+
+
+@contextmanager
+def observe(stage: str, timings: Timings | None = None) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started, timings)
+
+
+def record_server_metrics(server_metrics: dict, timings: Timings | None = None) -> None:
+    """Переносит метрики, которые MCP сервер вернул вместе с результатом инструмента"""
+    for stage, seconds in server_metrics.get("timings", {}).items():
+        record_stage(stage, seconds, timings)
+    for result, count in server_metrics.get("cache", {}).items():
+        if count:
+            EMBEDDING_CACHE.labels(result).inc(count)
@@ -0,0 +1,617 @@
+import argparse
+import gzip
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from html import unescape
+from html.parser import HTMLParser
+from pathlib import Path
+from typing import Callable, Iterable, Iterator
+
+import numpy as np
+
+from db.adapter import DBAdapter
+from mcp_apps.embedder import EMBED_BATCH_SIZE, EMBED_CONCURRENCY, Embedder
+from mcp_apps.embedding_store import EmbeddingStore, EmbeddingStoreWriter, store_path_for
+from mcp_apps.groups import INDEX_GROUPS_DIR, build_group_indexes
+from mcp_apps.index_factory import INDEX_FACTORY, build_index, save_index
+from mcp_apps.repo_funcs_crawler import (
+    EMBEDDINGS_MODEL,
+    EMBEDDINGS_STORE_DTYPE,
+    GIGA_CREDS,
+    CHUNK_OVERLAP_CHARS,
+    MAX_CONTENT_CHARS,
+    OUTPUT_EMBEDDINGS_PATH,
+    PARSE_WORKERS,
+    REPOS_PATH,
+    content_hash,
+    extract_functions,
+    fn_metadata,
+    is_indexable_file,
+    make_parse_executor,
+    parent_fields,
+    repo_of,
+    vector_key,
+    walk_all_python_files,
+)
+from mcp_apps.shards import INDEX_SHARDS_DIR, ShardRegistry
+
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "64"))
+
+_DONE = object()
+
+
+class PipelineStopped(Exception):
+    pass
+
+
+class StageStats:
+    """
+    Счетчики стадии: сколько элементов пришло и ушло и сколько времени воркеры
+    ждали вход (стадия простаивает) и выход (следующая стадия не успевает).
+    """
+
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self.workers = workers
+        self.items_in = 0
+        self.items_out = 0
+        self.wait_in = 0.0
+        self.wait_out = 0.0
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+
+    def add(self, items_in: int = 0, items_out: int = 0, wait_in: float = 0.0, wait_out: float = 0.0) -> None:
+        with self._lock:
+            self.items_in += items_in
+            self.items_out += items_out
+            self.wait_in += wait_in
+            self.wait_out += wait_out
+
+    @property
+    def seconds(self) -> float:
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.perf_counter()) - self.started
+
+    def to_dict(self) -> dict:
+        total = max(self.seconds * self.workers, 1e-9)
+        return {
+            "workers": self.workers,
+            "items_in": self.items_in,
+            "items_out": self.items_out,
+            "seconds": self.seconds,
+            "throughput": self.items_out / max(self.seconds, 1e-9),
+            # Доля времени в работе; остальное - ожидание входа или места в очереди дальше
+            "busy": max(0.0, 1 - (self.wait_in + self.wait_out) / total),
+            "blocked_on_output": self.wait_out / total,
+        }
+
+
+class Stage:
+    """
+    Стадия конвейера: transform получает итератор входных элементов и отдает выходные.
+
+    С workers > 1 несколько потоков читают общую очередь, каждый со своим вызовом transform,
+    поэтому порядок на выходе не сохраняется. transform может объединять элементы в пачки,
+    размножать или отбрасывать их и держать состояние (при workers=1).
+    """
+
+    def __init__(self, name: str, transform: Callable[[Iterator], Iterable], workers: int = 1):
+        self.name = name
+        self.transform = transform
+        self.workers = workers
+
+
+class Pipeline:
+    """
+    Стадии в потоках, соединенные ограниченными очередями.
+
+    Полная очередь блокирует предыдущую стадию, поэтому в памяти одновременно не больше
+    queue_size элементов между каждой парой стадий, как бы ни был велик корпус.
+    Ошибка в любой стадии останавливает весь конвейер и пробрасывается из run.
+    """
+
+    def __init__(self, source: Iterable, stages: list[Stage], queue_size: int = PIPELINE_QUEUE_SIZE):
+        self.source = source
+        self.stages = stages
+        self.queue_size = queue_size
+        self.stats = {"source": StageStats("source", 1)}
+        self.stats.update({stage.name: StageStats(stage.name, stage.workers) for stage in stages})
+        self._stop = threading.Event()
+        self._error: BaseException | None = None
+
+    def _put(self, q: queue.Queue, item) -> float:
+        started = time.perf_counter()
+        while True:
+            if self._stop.is_set():
+                raise PipelineStopped
+            try:
+                q.put(item, timeout=0.1)
+                return time.perf_counter() - started
+            except queue.Full:
+                continue
+
+    def _get(self, q: queue.Queue) -> tuple[object, float]:
+        started = time.perf_counter()
+        while True:
+            if self._stop.is_set():
+                raise PipelineStopped
+            try:
+                return q.get(timeout=0.1), time.perf_counter() - started
+            except queue.Empty:
+                continue
+
+    def _fail(self, e: BaseException) -> None:
+        if not isinstance(e, PipelineStopped) and self._error is None:
+            self._error = e
+        self._stop.set()
+
+    def _run_source(self, q_out: queue.Queue) -> None:
+        stats = self.stats["source"]
+        stats.started = time.perf_counter()
+        try:
+            for item in self.source:
+                stats.add(items_out=1, wait_out=self._put(q_out, item))
+            self._put(q_out, _DONE)
+        except BaseException as e:
+            self._fail(e)
+        finally:
+            stats.finished = time.perf_counter()
+
+    def _run_stage(self, stage: Stage, q_in: queue.Queue, q_out: queue.Queue, remaining: list[int], lock) -> None:
+        stats = self.stats[stage.name]
+
+        def inputs() -> Iterator:
+            while True:
+                item, waited = self._get(q_in)
+                if item is _DONE:
+                    # Маркер конца возвращается в очередь для остальных воркеров стадии
+                    q_in.put(_DONE)
+                    return
+                stats.add(items_in=1, wait_in=waited)
+                yield item
+
+        try:
+            for out in stage.transform(inputs()):
+                stats.add(items_out=1, wait_out=self._put(q_out, out))
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                stats.finished = time.perf_counter()
+                self._put(q_out, _DONE)
+        except BaseException as e:
+            self._fail(e)
+
+    def run(self) -> Iterator:
+        """Запускает стадии и отдает выход последней стадии"""
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in range(len(self.stages) + 1)]
+        threads = [threading.Thread(target=self._run_source, args=(queues[0],), daemon=True)]
+        for i, stage in enumerate(self.stages):
+            self.stats[stage.name].started = time.perf_counter()
+            remaining, lock = [stage.workers], threading.Lock()
+            for _ in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=self._run_stage,
+                    args=(stage, queues[i], queues[i + 1], remaining, lock),
+                    daemon=True,
+                ))
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                try:
+                    item, _ = self._get(queues[-1])
+                except PipelineStopped:
+                    break
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+        if self._error is not None:
+            raise self._error
+
+    def report(self, extra: dict[str, dict] | None = None) -> dict[str, dict]:
+        stats = {name: s.to_dict() for name, s in self.stats.items()}
+        stats.update(extra or {})
+        print(f"  {'stage':<12} {'workers':>7} {'in':>9} {'out':>9} {'seconds':>9} {'items/s':>9} {'busy':>6} {'blocked':>8}")
+        for name, s in stats.items():
+            print(
+                f"  {name:<12} {s.get('workers', 1):>7} {s.get('items_in', 0):>9} {s.get('items_out', 0):>9} "
+                f"{s['seconds']:>9.2f} {s.get('throughput', 0):>9.0f} {s.get('busy', 1):>6.0%} "
+                f"{s.get('blocked_on_output', 0):>8.0%}"
+            )
+        return stats
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+
+    def handle_data(self, data: str) -> None:
+        if data.strip():
+            self.parts.append(data.strip())
+
+
+def html_to_text(html: str) -> str:
+    extractor = _TextExtractor()
+    extractor.feed(html or "")
+    return unescape(" ".join(extractor.parts))
+
+
+def adf_to_text(node) -> str:
+    # Описание задачи в API v3 приходит в Atlassian Document Format, в v2 - строкой
+    if isinstance(node, str):
+        return node
+    if isinstance(node, dict):
+        if node.get("type") == "text":
+            return node.get("text", "")
+        return " ".join(filter(None, (adf_to_text(child) for child in node.get("content", []))))
+    return ""
+
+
+def split_text(text: str) -> list[str]:
+    """
+    Части текста не длиннее MAX_CONTENT_CHARS, разрезанные по пробелам,
+    соседние части перекрываются на CHUNK_OVERLAP_CHARS.
+    """
+    if len(text) <= MAX_CONTENT_CHARS:
+        return [text]
+    pieces = []
+    start = 0
+    while start < len(text):
+        end = min(len(text), start + MAX_CONTENT_CHARS)
+        if end < len(text):
+            cut = text.rfind(" ", start + MAX_CONTENT_CHARS // 2, end)
+            end = cut if cut > 0 else end
+        pieces.append(text[start:end])
+        if end >= len(text):
+            break
+        start = max(start + 1, end - CHUNK_OVERLAP_CHARS)
+    return pieces
+
+
+def _document(name: str, content: str, path: str, repo: str, source: str, kind: str, url: str | None) -> list[dict]:
+    # Задачи и страницы в том же формате, что функции из extract_functions, длинные - частями
+    doc_id = str(uuid.uuid4())
+    pieces = split_text(content)
+    records = []
+    for n, text in enumerate(pieces):
+        record = {
+            "id": doc_id if len(pieces) == 1 else f"{doc_id}#{n}",
+            "name": name,
+            "parameters": "",
+            "start_line": None,
+            "end_line": None,
+            "content": text,
+            "path": path,
+            "url": url,
+            "repo": repo,
+            "source": source,
+            "kind": kind,
+            "hash": content_hash(text),
+        }
+        if len(pieces) > 1:
+            record.update({"parent_id": doc_id, "chunk": n})
+            if n == 0:
+                record["parent_content"] = content
+        records.append(record)
+    return records
+
+
+def issue_to_document(issue: dict) -> list[dict]:
+    fields = issue.get("fields", {})
+    key = issue["key"]
+    project = fields.get("project", {}).get("key") or key.rsplit("-", 1)[0]
+    text = f"{key}: {fields.get('summary') or ''}\n{adf_to_text(fields.get('description'))}"
+    return _document(key, text, f"{project}/{key}", project, "jira", "issue", issue.get("self"))
+
+
+def page_to_document(page: dict) -> list[dict]:
+    text = f"{page.get('title') or ''}\n{html_to_text(page.get('body', ''))}"
+    return _document(
+        page.get("title") or page["id"],
+        text,
+        f"{page['space']}/{page['id']}",
+        page["space"],
+        "confluence",
+        "document",
+        page.get("url"),
+    )
+
+
+def iter_latest_jsonl_gz(path: Path, key: str) -> Iterator[dict]:
+    """
+    Записи сжатого JSONL скраперов, из повторяющихся по key - только последняя.
+    Первый проход запоминает номер последней строки каждого ключа, второй отдает записи,
+    поэтому в памяти только ключи, а не содержимое.
+    """
+    last_line = {}
+    with gzip.open(path, "rt", encoding="utf-8") as fd:
+        for line_no, line in enumerate(fd):
+            last_line[json.loads(line)[key]] = line_no
+    keep = set(last_line.values())
+    with gzip.open(path, "rt", encoding="utf-8") as fd:
+        for line_no, line in enumerate(fd):
+            if line_no in keep:
+                yield json.loads(line)
+
+
+def iter_sources(repos: Iterable[str], jira_paths: Iterable[Path], confluence_paths: Iterable[Path]) -> Iterator[dict]:
+    for repo_name in repos:
+        files = sorted(f for f in walk_all_python_files(REPOS_PATH / repo_name) if is_indexable_file(f))
+        for path in files:
+            yield {"type": "code", "repo": repo_name, "path": path}
+    for path in jira_paths:
+        for issue in iter_latest_jsonl_gz(Path(path), "key"):
+            yield {"type": "jira", "issue": issue}
+    for path in confluence_paths:
+        for page in iter_latest_jsonl_gz(Path(path), "id"):
+            yield {"type": "confluence", "page": page}
+
+
+def db_record(fn: dict, label: int, vector) -> dict:
+    # Как в util.fill_the_db.iter_joined_records
+    return {
+        "id": label,
+        "fn_id": fn["id"],
+        "code": fn["content"],
+        "url": fn.get("url") or fn["path"],
+        "name": fn.get("name"),
+        "parameters": fn.get("parameters"),
+        "start_line": fn.get("start_line"),
+        "end_line": fn.get("end_line"),
+        **fn_metadata(fn),
+        **parent_fields(fn),
+        "vector": vector,
+    }
+
+
+class IndexingPipeline:
+    """
+    Индексация кода, задач Jira и страниц Confluence одним конвейером:
+    источники -> разбор -> дедупликация и пачки -> эмбеддинги -> хранилище векторов -> база.
+
+    Промежуточные JSONL не пишутся: функции идут из разбора сразу в эмбеддинги,
+    векторы - в бинарное хранилище, записи - в базу. Индекс строится в конце по хранилищу,
+    из него берутся только векторы, на которые ссылается текущий корпус.
+    Уже посчитанные векторы хранилища переиспользуются, эмбеддинги считаются
+    только для нового содержимого.
+    """
+
+    def __init__(
+        self,
+        embeddings_path: Path,
+        db_adapter: DBAdapter,
+        parse_workers: int = PARSE_WORKERS,
+        embed_workers: int = EMBED_CONCURRENCY,
+        batch_size: int = EMBED_BATCH_SIZE,
+        queue_size: int = PIPELINE_QUEUE_SIZE,
+        fresh: bool = False,
+        store_vectors: bool = True,
+    ):
+        self.embeddings_path = Path(embeddings_path)
+        self.store_path = store_path_for(self.embeddings_path)
+        self.db_adapter = db_adapter
+        self.parse_workers = parse_workers
+        self.embed_workers = embed_workers
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.store_vectors = store_vectors
+        self.embedder = Embedder(GIGA_CREDS, EMBEDDINGS_MODEL, batch_size=batch_size)
+
+        self.existing = None
+        if not fresh:
+            try:
+                self.existing = EmbeddingStore(self.store_path)
+            except FileNotFoundError:
+                pass
+        self.label_by_key = {key: label for label, key in enumerate(self.existing.ids)} if self.existing else {}
+        self.repo_labels: dict[str, set[int]] = {}
+
+    def extract(self, parse_executor) -> Callable[[Iterator[dict]], Iterator[dict]]:
+        def transform(items: Iterator[dict]) -> Iterator[dict]:
+            for item in items:
+                if item["type"] == "code":
+                    # Поток ждет процесс из общего пула, так заняты все parse_workers ядер
+                    for fn in parse_executor.submit(extract_functions, item["path"]).result():
+                        fn["repo"] = item["repo"]
+                        yield fn
+                elif item["type"] == "jira":
+                    yield from issue_to_document(item["issue"])
+                else:
+                    yield from page_to_document(item["page"])
+        return transform
+
+    def batch(self, records: Iterator[dict]) -> Iterator[list[tuple[dict, bool]]]:
+        # Одна копия на содержимое: новый ключ помечается для эмбеддинга, повторы идут без текста в API
+        known = set(self.label_by_key)
+        batch, n_new = [], 0
+        for fn in records:
+            key = vector_key(fn)
+            is_new = key not in known
+            known.add(key)
+            batch.append((fn, is_new))
+            n_new += is_new
+            # Пачка без новых ключей тоже не должна расти бесконечно
+            if n_new >= self.batch_size or len(batch) >= 4 * self.batch_size:
+                yield batch
+                batch, n_new = [], 0
+        if batch:
+            yield batch
+
+    def embed(self, batches: Iterator[list[tuple[dict, bool]]]) -> Iterator[tuple[list, list]]:
+        with self.embedder.client() as giga:
+            for batch in batches:
+                texts = [fn["content"] for fn, is_new in batch if is_new]
+                yield batch, self.embedder.embed_batch(giga, texts) if texts else []
+
+    def store(self, writer: EmbeddingStoreWriter) -> Callable[[Iterator], Iterator[dict]]:
+        def vector_of(label: int, fresh_vectors: dict):
+            if not self.store_vectors:
+                return None
+            if label in fresh_vectors:
+                return fresh_vectors[label]
+            if self.existing is not None and label < self.existing.count:
+                return self.existing.vectors[label]
+            return None
+
+        def transform(items: Iterator[tuple[list, list]]) -> Iterator[dict]:
+            # Пачки приходят от параллельных воркеров не по порядку: повтор может обогнать
+            # вхождение с вектором, такие записи ждут здесь, пока не появится label
+            pending: dict[str, list[dict]] = {}
+            for batch, vectors in items:
+                new = [fn for fn, is_new in batch if is_new]
+                fresh_vectors = {}
+                if new:
+                    base = writer.count
+                    writer.add([vector_key(fn) for fn in new], vectors)
+                    writer.checkpoint()
+                    for i, (fn, vector) in enumerate(zip(new, vectors)):
+                        self.label_by_key[vector_key(fn)] = base + i
+                        fresh_vectors[base + i] = vector
+
+                ready = [fn for fn, is_new in batch if is_new]
+                ready += [fn for fn, is_new in batch if not is_new]
+                for fn in new:
+                    ready += pending.pop(vector_key(fn), [])
+                for fn in ready:
+                    label = self.label_by_key.get(vector_key(fn))
+                    if label is None:
+                        pending.setdefault(vector_key(fn), []).append(fn)
+                        continue
+                    self.repo_labels.setdefault(repo_of(fn), set()).add(label)
+                    yield db_record(fn, label, vector_of(label, fresh_vectors))
+            if pending:
+                raise RuntimeError(f"Нет векторов для {len(pending)} ключей")
+        return transform
+
+    def run(self, source: Iterable[dict]) -> dict[str, dict]:
+        """Прогоняет источники через конвейер в хранилище и базу, возвращает статистику стадий"""
+        parse_executor = make_parse_executor(self.parse_workers)
+        try:
+            with EmbeddingStoreWriter(
+                self.store_path, dtype=EMBEDDINGS_STORE_DTYPE, append=self.existing is not None
+            ) as writer:
+                pipeline = Pipeline(
+                    source,
+                    [
+                        Stage("extract", self.extract(parse_executor), self.parse_workers),
+                        Stage("batch", self.batch),
+                        Stage("embed", self.embed, self.embed_workers),
+                        Stage("store", self.store(writer)),
+                    ],
+                    queue_size=self.queue_size,
+                )
+                # Последняя стадия - загрузка в базу пачками в этом потоке; рабочая база
+                # заменяется только после успешного прогона
+                started = time.perf_counter()
+                n_records = self.db_adapter.replace_all(pipeline.run())
+                elapsed = time.perf_counter() - started
+                db_stats = {"db": {"items_in": n_records, "items_out": n_records, "seconds": elapsed,
+                                   "throughput": n_records / max(elapsed, 1e-9)}}
+        finally:
+            parse_executor.shutdown()
+        self.stats = pipeline.report(db_stats)
+        return self.stats
+
+    def referenced_labels(self) -> np.ndarray:
+        labels = set().union(*self.repo_labels.values()) if self.repo_labels else set()
+        return np.array(sorted(labels), dtype="int64")
+
+    def build_indexes(
+        self,
+        index_file_path: Path | None = None,
+        registry: ShardRegistry | None = None,
+        index_factory: str = INDEX_FACTORY,
+        groups_dir: Path | None = None,
+    ) -> dict[str, dict]:
+        """
+        Общий индекс и/или шарды по репозиториям только из векторов текущего корпуса,
+        groups_dir - индексы классов, модулей и репозиториев
+        """
+        store = EmbeddingStore(self.store_path)
+        stats = {}
+        if index_file_path is not None:
+            started = time.perf_counter()
+            index, params = build_index(store, factory=index_factory, labels=self.referenced_labels())
+            save_index(index, index_file_path, params)
+            stats["index"] = {"items_in": index.ntotal, "seconds": time.perf_counter() - started}
+        if registry is not None:
+            started = time.perf_counter()
+            for stale in set(registry.repos()) - set(self.repo_labels):
+                registry.remove(stale)
+            for repo, labels in sorted(self.repo_labels.items()):
+                index, params = build_index(
+                    store, factory=index_factory, labels=np.array(sorted(labels), dtype="int64")
+                )
+                registry.save_shard(repo, index, params)
+            stats["shards"] = {"items_in": len(self.repo_labels), "seconds": time.perf_counter() - started}
+        if groups_dir is not None:
+            started = time.perf_counter()
+            sizes = build_group_indexes(self.db_adapter, store, groups_dir)
+            stats["groups"] = {"items_in": sum(sizes.values()), "seconds": time.perf_counter() - started}
+        for name, s in stats.items():
+            print(f"  {name:<12} {s['items_in']:>9} {s['seconds']:>9.2f} с")
+        return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Индексация кода, задач Jira и страниц Confluence одним потоковым конвейером."
+    )
+    parser.add_argument("--repo", action="append", dest="repos", default=[],
+                        help="Репозиторий из mcp_apps/repos, можно указать несколько раз")
+    parser.add_argument("--all-repos", action="store_true", help="Все репозитории из mcp_apps/repos")
+    parser.add_argument("--jira", action="append", default=[], help="Выгрузка jira_scraper (*.jsonl.gz)")
+    parser.add_argument("--confluence", action="append", default=[],
+                        help="Выгрузка confluence_scraper (*.jsonl.gz)")
+    parser.add_argument("--name", default="corpus", help="Имя хранилища эмбеддингов в mcp_apps/embeddings")
+    parser.add_argument("--index", default=os.getenv("INDEX_PATH"), help="Путь к общему индексу FAISS")
+    parser.add_argument("--shards", action="store_true", help="Собрать шарды по репозиториям")
+    parser.add_argument("--shards-dir", default=INDEX_SHARDS_DIR, help="Папка с шардами и реестром")
+    parser.add_argument("--factory", default=INDEX_FACTORY, help="Строка faiss.index_factory")
+    parser.add_argument("--groups", action="store_true", help="Собрать индексы классов, модулей и репозиториев")
+    parser.add_argument("--groups-dir", default=INDEX_GROUPS_DIR, help="Папка с индексами групп")
+    parser.add_argument("--parse-workers", type=int, default=PARSE_WORKERS, help="Процессов разбора")
+    parser.add_argument("--embed-workers", type=int, default=EMBED_CONCURRENCY, help="Параллельных запросов к API")
+    parser.add_argument("--queue-size", type=int, default=PIPELINE_QUEUE_SIZE, help="Размер очереди между стадиями")
+    parser.add_argument("--fresh", action="store_true", help="Не переиспользовать посчитанные эмбеддинги")
+    parser.add_argument("--no-vectors", action="store_true", help="Не сохранять векторы в базе")
+    args = parser.parse_args()
+
+    repos = args.repos
+    if args.all_repos:
+        repos = sorted(p.name for p in REPOS_PATH.iterdir() if (p / ".git").exists())
+
+    db_adapter = DBAdapter()
+    db_adapter.init_db()
+    try:
+        indexing = IndexingPipeline(
+            OUTPUT_EMBEDDINGS_PATH / f"{args.name}.jsonl",
+            db_adapter,
+            parse_workers=args.parse_workers,
+            embed_workers=args.embed_workers,
+            queue_size=args.queue_size,
+            fresh=args.fresh,
+            store_vectors=not args.no_vectors,
+        )
+        indexing.run(iter_sources(repos, args.jira, args.confluence))
+        indexing.build_indexes(
+            Path(args.index) if args.index else None,
+            ShardRegistry(Path(args.shards_dir)) if args.shards else None,
+            index_factory=args.factory,
+            groups_dir=Path(args.groups_dir) if args.groups else None,
+        )
+    finally:
+        db_adapter.close_db()
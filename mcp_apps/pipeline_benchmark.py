@@ -0,0 +1,308 @@
+import argparse
+import hashlib
+import json
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable
+
+import numpy as np
+from gigachat.models import ChatCompletion
+
+import mcp_apps.embedder
+from db.adapter import DBAdapter
+from mcp_apps.embedder import Embedder
+from mcp_apps.index_factory import INDEX_FACTORY
+from mcp_apps.repo_funcs_crawler import (
+    EMBEDDINGS_MODEL,
+    PARSE_WORKERS,
+    build_index_from_embeddings,
+    create_embeddings_for_functions,
+    load_statics,
+    parse_files,
+)
+from mcp_apps.search import HybridSearcher
+from util.fill_the_db import iter_joined_records
+
+VERBS = ["get", "set", "load", "save", "parse", "check", "update", "build", "send", "validate", "merge", "retry"]
+NOUNS = ["user", "token", "cache", "session", "request", "config", "order", "payment", "queue", "report", "file", "event"]
+FUNCTIONS_PER_FILE = 100
+
+
+class FakeGigaChat:
+    """
+    Детерминированная замена клиента GigaChat без сети.
+
+    Вектор зависит только от текста, поэтому повторные прогоны дают одинаковые индексы.
+    latency - задержка на один запрос, чтобы имитировать время ответа API.
+    """
+
+    dim = 1024
+    latency = 0.0
+
+    def __init__(self, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    @classmethod
+    def vector(cls, text: str) -> list[float]:
+        seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+        return np.random.default_rng(seed).standard_normal(cls.dim, dtype="float32").tolist()
+
+    def embeddings(self, texts: list[str], model: str | None = None):
+        if self.latency:
+            time.sleep(self.latency)
+        return SimpleNamespace(data=[SimpleNamespace(embedding=self.vector(t)) for t in texts])
+
+    def chat(self, payload) -> ChatCompletion:
+        if self.latency:
+            time.sleep(self.latency)
+        return ChatCompletion.parse_obj({
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "ok"},
+                "finish_reason": "stop",
+            }],
+            "created": 0,
+            "model": "fake",
+            "object": "chat.completion",
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        })
+
+    async def achat(self, payload) -> ChatCompletion:
+        return self.chat(payload)
+
+
+def generate_corpus(root: Path, n_functions: int, duplicate_ratio: float = 0.05, seed: int = 0) -> list[Path]:
+    """
+    Синтетический репозиторий из n_functions функций по FUNCTIONS_PER_FILE в файле.
+    Часть функций - копии уже созданных, чтобы работала дедупликация по содержимому.
+    """
+    rng = random.Random(seed)
+    files = []
+    bodies = []
+    for file_no in range((n_functions + FUNCTIONS_PER_FILE - 1) // FUNCTIONS_PER_FILE):
+        path = root / f"pkg_{file_no // 100}" / f"module_{file_no}.py"
+        path.parent.mkdir(parents=True, exist_ok=True)
+        chunks = []
+        for fn_no in range(file_no * FUNCTIONS_PER_FILE, min(n_functions, (file_no + 1) * FUNCTIONS_PER_FILE)):
+            if bodies and rng.random() < duplicate_ratio:
+                chunks.append(rng.choice(bodies))
+                continue
+            verb, noun, other = rng.choice(VERBS), rng.choice(NOUNS), rng.choice(NOUNS)
+            lines = [f"def {verb}_{noun}_{fn_no}({noun}, {other}=None, timeout={rng.randint(1, 60)}):"]
+            lines.append(f'    """{verb.capitalize()} {noun} using {other}"""')
+            lines.append(f"    result = {{}}")
+            for _ in range(rng.randint(3, 8)):
+                key = rng.choice(NOUNS)
+                lines.append(f"    if {noun}.get('{key}') is not None:")
+                lines.append(f"        result['{key}'] = {rng.choice(VERBS)}_{key}({noun}['{key}'], {rng.randint(0, 1000)})")
+            lines.append("    return result")
+            body = "\n".join(lines) + "\n"
+            bodies.append(body)
+            chunks.append(body)
+        path.write_text("\n\n".join(chunks))
+        files.append(path)
+    return sorted(files)
+
+
+def make_queries(n_queries: int, seed: int = 1) -> list[str]:
+    rng = random.Random(seed)
+    queries = []
+    for i in range(n_queries):
+        verb, noun = rng.choice(VERBS), rng.choice(NOUNS)
+        # Половина запросов на естественном языке, половина с идентификатором
+        if i % 2:
+            queries.append(f"функция которая делает {verb} для {noun} с таймаутом")
+        else:
+            queries.append(f"где используется {verb}_{noun}")
+    return queries
+
+
+def run_stage(name: str, fn: Callable[[], tuple[int, object]], track_memory: bool) -> tuple[dict, object]:
+    """
+    Выполняет стадию, fn возвращает (число обработанных элементов, результат).
+    Пик памяти - по tracemalloc: Python и numpy, без памяти FAISS и дочерних процессов.
+    """
+    if track_memory:
+        tracemalloc.start()
+    started = time.perf_counter()
+    items, result = fn()
+    elapsed = time.perf_counter() - started
+    peak_mb = 0.0
+    if track_memory:
+        peak_mb = tracemalloc.get_traced_memory()[1] / 2 ** 20
+        tracemalloc.stop()
+    stats = {
+        "items": items,
+        "seconds": elapsed,
+        "throughput": items / max(elapsed, 1e-9),
+        "peak_mb": peak_mb,
+    }
+    print(f"  {name:<16} {items:>9} {elapsed:>10.3f} {stats['throughput']:>12.0f} {peak_mb:>9.1f}")
+    return stats, result
+
+
+def bench_size(workdir: Path, n_functions: int, args) -> dict:
+    print(f"\n{n_functions} функций")
+    print(f"  {'stage':<16} {'items':>9} {'seconds':>10} {'items/s':>12} {'peak MB':>9}")
+    files = generate_corpus(workdir / "repo", n_functions)
+    functions_path = workdir / "functions.jsonl"
+    embeddings_dir = workdir / "embeddings"
+    embeddings_dir.mkdir()
+    index_path = workdir / "index.faiss"
+    queries = make_queries(args.queries)
+    track = not args.no_memory
+    results = {}
+
+    def parse():
+        return parse_files(files, functions_path, args.workers), None
+
+    results["parse"], _ = run_stage("parse", parse, track)
+
+    def embed():
+        path = create_embeddings_for_functions(functions_path, resume=False, output_dir=embeddings_dir)
+        with open(path) as fd:
+            return sum(1 for _ in fd), path
+
+    results["embed"], embeddings_path = run_stage("embed", embed, track)
+
+    def build():
+        index, _, _ = build_index_from_embeddings(
+            embeddings_path, functions_path, index_factory=args.factory, index_file_path=index_path
+        )
+        return index.ntotal, None
+
+    results["build_index"], _ = run_stage("build_index", build, track)
+
+    def load():
+        statics = load_statics(index_path, embeddings_path, functions_path)
+        return statics[0].ntotal, statics
+
+    results["load_statics"], (index, _, _) = run_stage("load_statics", load, track)
+
+    db_adapter = DBAdapter(db_path=workdir / "functions.db")
+    db_adapter.init_db()
+
+    def fill_db():
+        return db_adapter.add_many(iter_joined_records(embeddings_path, functions_path)), None
+
+    results["fill_db"], _ = run_stage("fill_db", fill_db, track)
+
+    embedder = Embedder(None, EMBEDDINGS_MODEL)
+    searcher = HybridSearcher(
+        index, db_adapter, lambda qs: np.array(embedder.embed(qs), dtype="float32")
+    )
+    rng = np.random.default_rng(0)
+    label_batches = [rng.integers(0, index.ntotal, size=args.k).tolist() for _ in queries]
+
+    def hydrate():
+        for labels in label_batches:
+            db_adapter.get_by_ids(labels)
+        return len(label_batches), None
+
+    results["hydrate"], _ = run_stage("hydrate", hydrate, track)
+
+    for mode in ("vector", "lexical", "hybrid"):
+        def search():
+            # Как в инструменте search_candidates: поиск и подъем кандидатов из базы
+            for q in queries:
+                hits, _ = searcher.search(q, args.k, mode)
+                db_adapter.get_by_ids([label for label, _ in hits])
+            return len(queries), None
+
+        results[f"search_{mode}"], _ = run_stage(f"search_{mode}", search, track)
+
+    db_adapter.close_db()
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float, min_seconds: float) -> list[str]:
+    """Стадии, ставшие медленнее базовой линии больше чем на tolerance"""
+    regressions = []
+    print(f"\nСравнение с базовой линией (допуск {tolerance:.0%})")
+    for size, stages in results["sizes"].items():
+        base_stages = baseline["sizes"].get(size)
+        if base_stages is None:
+            continue
+        for stage, stats in stages.items():
+            base = base_stages.get(stage)
+            if base is None:
+                continue
+            ratio = stats["seconds"] / max(base["seconds"], 1e-9)
+            slower = ratio > 1 + tolerance and stats["seconds"] - base["seconds"] > min_seconds
+            mark = "REGRESSION" if slower else ""
+            print(
+                f"  {size:>9} {stage:<16} {base['seconds']:>10.3f} -> {stats['seconds']:>10.3f} "
+                f"x{ratio:>5.2f} {mark}"
+            )
+            if slower:
+                regressions.append(f"{size}/{stage}")
+    return regressions
+
+
+def main(args) -> int:
+    # Все обращения к GigaChat из Embedder уходят в детерминированную заглушку
+    FakeGigaChat.dim = args.dim
+    FakeGigaChat.latency = args.embed_latency
+    mcp_apps.embedder.GigaChat = FakeGigaChat
+
+    results = {
+        "config": {"dim": args.dim, "factory": args.factory, "queries": args.queries, "k": args.k},
+        "sizes": {},
+    }
+    for n_functions in args.sizes:
+        with tempfile.TemporaryDirectory(prefix="pipeline_bench_") as tmp:
+            results["sizes"][str(n_functions)] = bench_size(Path(tmp), n_functions, args)
+
+    if args.save_baseline:
+        Path(args.save_baseline).write_text(json.dumps(results, indent=2))
+        print(f"\nБазовая линия сохранена в {args.save_baseline}")
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        if baseline["config"] != results["config"]:
+            print(f"Внимание: конфигурация базовой линии отличается: {baseline['config']}")
+        regressions = compare(results, baseline, args.tolerance, args.min_seconds)
+        if regressions:
+            print(f"Замедлились: {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Офлайн-бенчмарк стадий пайплайна на синтетическом корпусе с заглушкой GigaChat."
+    )
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000],
+                        help="Размеры корпуса в функциях, например 1000 10000 100000 1000000")
+    parser.add_argument("--dim", type=int, default=1024, help="Размерность эмбеддингов заглушки")
+    parser.add_argument("--embed-latency", type=float, default=0.0,
+                        help="Задержка заглушки на один запрос к API, с")
+    parser.add_argument("--factory", default=INDEX_FACTORY, help="Строка faiss.index_factory")
+    parser.add_argument("--workers", type=int, default=PARSE_WORKERS, help="Процессов для разбора файлов")
+    parser.add_argument("--queries", type=int, default=200, help="Запросов для стадий поиска")
+    parser.add_argument("--k", type=int, default=10, help="Размер выдачи")
+    parser.add_argument("--no-memory", action="store_true",
+                        help="Не измерять пик памяти (tracemalloc замедляет Python-код)")
+    parser.add_argument("--save-baseline", help="Сохранить результаты как базовую линию")
+    parser.add_argument("--baseline", help="Сравнить с сохраненной базовой линией")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="Допустимое замедление, доля")
+    parser.add_argument("--min-seconds", type=float, default=0.05,
+                        help="Меньшие абсолютные замедления не считаются регрессией")
+    sys.exit(main(parser.parse_args()))
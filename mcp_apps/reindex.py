@@ -0,0 +1,341 @@
+import argparse
+import json
+import os
+import time
+from pathlib import Path
+
+import faiss
+import numpy as np
+
+from db.adapter import DBAdapter
+from mcp_apps.embedder import Embedder
+from mcp_apps.embedding_store import EmbeddingStoreWriter, open_embedding_store, store_path_for
+from mcp_apps.groups import INDEX_GROUPS_DIR, build_group_indexes
+from mcp_apps.index_factory import (
+    INDEX_FACTORY,
+    build_index,
+    load_index,
+    load_index_params,
+    save_index,
+)
+from mcp_apps.repo_funcs_crawler import (
+    EMBEDDINGS_MODEL,
+    EMBEDDINGS_STORE_DTYPE,
+    GIGA_CREDS,
+    OUTPUT_DIR_PATH,
+    REPOS_PATH,
+    clone_repo,
+    content_hash,
+    extract_functions,
+    fn_metadata,
+    get_repo_name,
+    is_indexable_file,
+    parent_fields,
+    vector_key,
+)
+from mcp_apps.shards import INDEX_SHARDS_DIR, ShardRegistry
+
+
+def manifest_path_for(repo_name: str) -> Path:
+    return OUTPUT_DIR_PATH / f"{repo_name}.manifest.json"
+
+
+def load_manifest(repo_name: str) -> dict | None:
+    path = manifest_path_for(repo_name)
+    if not path.exists():
+        return None
+    return json.loads(path.read_text())
+
+
+def save_manifest(repo_name: str, manifest: dict) -> None:
+    path = manifest_path_for(repo_name)
+    tmp_path = path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(manifest, ensure_ascii=False))
+    tmp_path.replace(path)
+
+
+def build_manifest(repo_url: str, functions_path: Path, embeddings_path: Path) -> dict:
+    """
+    Манифест по результатам полной сборки: коммит и для каждого файла
+    список функций с хэшем содержимого, id и label в индексе.
+    """
+    repo_path = REPOS_PATH / get_repo_name(repo_url)
+    repo = clone_repo(repo_url)
+    store = open_embedding_store(embeddings_path, dtype=EMBEDDINGS_STORE_DTYPE)
+    key2label = {key: label for label, key in enumerate(store.ids)}
+
+    files = {}
+    with open(functions_path, "r") as fd:
+        for line in fd:
+            fn = json.loads(line)
+            label = key2label.get(vector_key(fn))
+            if label is None:
+                continue
+            # Общий JSONL может содержать функции других репозиториев
+            if not Path(fn["path"]).is_relative_to(repo_path):
+                continue
+            rel_path = str(Path(fn["path"]).relative_to(repo_path))
+            files.setdefault(rel_path, []).append({
+                "id": fn["id"],
+                # В старых выгрузках хэша нет, считаем его так же, как при разборе
+                "hash": fn.get("hash") or content_hash(fn["content"]),
+                "label": label,
+            })
+
+    return {"commit": repo.head.commit.hexsha, "files": files}
+
+
+def changed_files(repo, old_commit: str, new_commit: str) -> tuple[set[str], set[str]]:
+    # --name-status -z: статус и пути, разделенные \0; у R/C два пути - старый и новый
+    changed, removed = set(), set()
+    parts = repo.git.diff("--name-status", "-z", old_commit, new_commit).split("\0")
+    i = 0
+    while i < len(parts) and parts[i]:
+        status = parts[i][0]
+        if status in ("R", "C"):
+            old_path, new_path = parts[i + 1], parts[i + 2]
+            if status == "R":
+                removed.add(old_path)
+            changed.add(new_path)
+            i += 3
+        else:
+            path = parts[i + 1]
+            (removed if status == "D" else changed).add(path)
+            i += 2
+
+    def is_python(p: str) -> bool:
+        return p.endswith(".py") and is_indexable_file(Path(p))
+
+    return {p for p in changed if is_python(p)}, {p for p in removed if is_python(p)}
+
+
+def supports_remove_ids(index: faiss.Index) -> bool:
+    # HNSW и часть других индексов не умеют удалять векторы, проверка пустым удалением ничего не меняет
+    try:
+        index.remove_ids(np.array([], dtype="int64"))
+    except RuntimeError:
+        return False
+    return True
+
+
+def index_labels(index: faiss.Index) -> set[int]:
+    # Индексы строятся через IndexIDMap2, label векторов лежат в id_map
+    return set(faiss.vector_to_array(index.id_map).tolist())
+
+
+def rewrite_functions(functions_path: Path, stale_urls: set[str], functions: list[dict]) -> None:
+    """
+    Переписывает JSONL с функциями через временный файл: записи затронутых файлов
+    заменяются только что разобранными, остальные переносятся как есть.
+    """
+    tmp_path = functions_path.with_suffix(".tmp")
+    with open(functions_path, "r") as src, open(tmp_path, "w") as out:
+        for line in src:
+            if json.loads(line)["path"] not in stale_urls:
+                out.write(line)
+        for fn in functions:
+            out.write(json.dumps(fn, ensure_ascii=False) + "\n")
+    tmp_path.replace(functions_path)
+
+
+def updated_index(
+    index: faiss.Index, index_path: Path, store, add_labels: set[int], remove_labels: set[int]
+) -> faiss.Index:
+    """
+    Убирает и добавляет векторы по label. Индекс без remove_ids (HNSW) собирается заново
+    из хранилища по тем же label и параметрам.
+    """
+    add = np.array(sorted(add_labels), dtype="int64")
+    if supports_remove_ids(index):
+        if remove_labels:
+            index.remove_ids(np.array(sorted(remove_labels), dtype="int64"))
+        if len(add):
+            vectors = np.array(store.vectors[add], dtype="float32")
+            faiss.normalize_L2(vectors)
+            index.add_with_ids(vectors, add)
+        return index
+
+    params = load_index_params(index_path)
+    labels = np.array(sorted((index_labels(index) - remove_labels) | add_labels), dtype="int64")
+    print(f"{index_path.name}: индекс не поддерживает удаление, пересборка из {len(labels)} векторов")
+    rebuilt, _ = build_index(
+        store,
+        factory=params.get("factory", INDEX_FACTORY),
+        search_params={k: v for k, v in params.items() if k != "factory"},
+        labels=labels,
+    )
+    return rebuilt
+
+
+def reindex_repo(
+    repo_url: str,
+    index_file_path: Path | None,
+    functions_path: Path,
+    embeddings_path: Path,
+    db_adapter: DBAdapter,
+    registry: ShardRegistry | None = None,
+    groups_dir: Path | None = None,
+) -> dict:
+    """
+    Переиндексация по git diff между последним проиндексированным коммитом и текущим.
+
+    Разбираются только измененные файлы, эмбеддинги считаются только для содержимого,
+    которого еще нет в общем хранилище. Вектор убирается из общего индекса и базы, только
+    если после удаления вхождений измененных файлов у него не осталось вхождений в базе.
+    Новые векторы дописываются в конец хранилища, поэтому label остается номером строки.
+    Обновляются общий индекс (если задан index_file_path) и шард репозитория в registry,
+    шарды других репозиториев не трогаются. Индексы без удаления (HNSW) пересобираются
+    из хранилища; тип индекса проверяется до любых записей. Если задан groups_dir,
+    пересобираются классы, модули и сам репозиторий в индексах групп.
+    """
+    started = time.perf_counter()
+    repo_name = get_repo_name(repo_url)
+    repo_path = REPOS_PATH / repo_name
+    repo = clone_repo(repo_url)
+
+    manifest = load_manifest(repo_name)
+    if manifest is None:
+        print("Манифест не найден, создается по результатам полной сборки")
+        manifest = build_manifest(repo_url, functions_path, embeddings_path)
+
+    old_commit = manifest["commit"]
+    repo.git.fetch("--depth=1", "origin")
+    new_commit = repo.git.rev_parse("FETCH_HEAD")
+    if new_commit == old_commit:
+        print(f"{repo_name}: изменений нет ({old_commit[:8]})")
+        save_manifest(repo_name, manifest)
+        return {"changed_files": 0, "embedded": 0, "removed": 0, "reused": 0}
+
+    # Индексы загружаются до записи в хранилище: ошибка чтения не оставит сборку наполовину примененной
+    index = load_index(index_file_path) if index_file_path is not None else None
+    shard = None
+    if registry is not None:
+        if repo_name in registry:
+            shard = registry.load(repo_name)
+        else:
+            print(f"Шарда {repo_name} нет, соберите его: python -m mcp_apps.shards --repo {repo_name}")
+
+    changed, removed = changed_files(repo, old_commit, new_commit)
+    repo.git.reset("--hard", new_commit)
+
+    labels_before = {entry["label"] for entries in manifest["files"].values() for entry in entries}
+    for rel_path in changed | removed:
+        manifest["files"].pop(rel_path, None)
+
+    # Хэш -> label по всему хранилищу: содержимое, которое уже есть у любого репозитория,
+    # не требует нового эмбеддинга
+    store = open_embedding_store(embeddings_path, dtype=EMBEDDINGS_STORE_DTYPE)
+    label_by_hash = {key: label for label, key in enumerate(store.ids)}
+    next_label = store.count
+
+    to_embed, records, functions = [], [], []
+    for rel_path in sorted(changed):
+        file_path = repo_path / rel_path
+        if not file_path.exists():
+            continue
+        for fn in extract_functions(file_path):
+            fn["repo"] = repo_name
+            label = label_by_hash.get(fn["hash"])
+            if label is None:
+                label = next_label + len(to_embed)
+                label_by_hash[fn["hash"]] = label
+                to_embed.append(fn)
+            functions.append(fn)
+            manifest["files"].setdefault(rel_path, []).append({
+                "id": fn["id"],
+                "hash": fn["hash"],
+                "label": label,
+            })
+            records.append({
+                "id": label,
+                "fn_id": fn["id"],
+                "code": fn["content"],
+                "url": fn["path"],
+                "name": fn["name"],
+                "parameters": fn["parameters"],
+                "start_line": fn["start_line"],
+                "end_line": fn["end_line"],
+                **fn_metadata(fn),
+                **parent_fields(fn),
+            })
+
+    labels_after = {entry["label"] for entries in manifest["files"].values() for entry in entries}
+
+    vectors = Embedder(GIGA_CREDS, EMBEDDINGS_MODEL).embed([fn["content"] for fn in to_embed])
+
+    # Новые векторы дописываются и в JSONL, и в бинарное хранилище в одном порядке,
+    # чтобы номер строки embeddings.jsonl совпадал с label
+    with (
+        EmbeddingStoreWriter(store_path_for(embeddings_path), append=True) as store_writer,
+        open(embeddings_path, "a") as embeddings_fd,
+    ):
+        for fn, vector in zip(to_embed, vectors):
+            embeddings_fd.write(json.dumps({"id": fn["hash"], "embedding": vector}) + "\n")
+        if to_embed:
+            store_writer.add([fn["hash"] for fn in to_embed], vectors)
+    rewrite_functions(functions_path, {str(repo_path / p) for p in changed | removed}, functions)
+
+    # Вектор удаляется, только если в базе у него не осталось вхождений ни в одном репозитории
+    # и источнике; манифесты есть не у всех репозиториев, поэтому проверка идет по базе
+    db_adapter.delete_occurrences_by_urls(str(repo_path / p) for p in changed | removed)
+    removed_labels = set(db_adapter.unreferenced_ids(labels_before - labels_after))
+    db_adapter.delete_ids(sorted(removed_labels))
+    db_adapter.add_many(records)
+
+    store = open_embedding_store(embeddings_path, dtype=EMBEDDINGS_STORE_DTYPE)
+    if index is not None:
+        # В общий индекс добавляются label, которых в нем еще нет: переиспользованный вектор
+        # другого репозитория там уже есть, а удаленный ранее - нет
+        index = updated_index(
+            index, index_file_path, store, labels_after - index_labels(index), removed_labels
+        )
+        save_index(index, index_file_path, load_index_params(index_file_path))
+    if shard is not None:
+        shard_path = registry.shard_path(repo_name)
+        shard = updated_index(
+            shard, shard_path, store, labels_after - index_labels(shard), labels_before - labels_after
+        )
+        registry.save_shard(repo_name, shard, load_index_params(shard_path))
+
+    if groups_dir is not None:
+        build_group_indexes(db_adapter, store, groups_dir, repos=[repo_name])
+
+    manifest["commit"] = new_commit
+    save_manifest(repo_name, manifest)
+
+    stats = {
+        "changed_files": len(changed | removed),
+        "embedded": len(to_embed),
+        "removed": len(removed_labels),
+        "reused": len(records) - len(to_embed),
+    }
+    elapsed = time.perf_counter() - started
+    print(f"{repo_name}: {old_commit[:8]} -> {new_commit[:8]}, {stats}, {elapsed:.2f} с")
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Инкрементальная переиндексация репозитория по git diff.")
+    parser.add_argument("--repo", required=True, help="URL репозитория")
+    parser.add_argument("--index", default=os.getenv("INDEX_PATH"), help="Путь к общему индексу FAISS")
+    parser.add_argument("--shards-dir", default=INDEX_SHARDS_DIR, help="Папка с шардами по репозиториям")
+    parser.add_argument("--groups-dir", default=INDEX_GROUPS_DIR, help="Папка с индексами групп")
+    parser.add_argument("--no-groups", action="store_true", help="Не обновлять индексы групп")
+    parser.add_argument("--functions", default=os.getenv("OUTPUT_FUNCTIONS_PATH"), help="Путь к JSONL с функциями")
+    parser.add_argument("--embeddings", default=os.getenv("EMBEDDINGS_PATH"), help="Путь к JSONL с эмбеддингами")
+    args = parser.parse_args()
+
+    db_adapter = DBAdapter()
+    db_adapter.init_db()
+    try:
+        reindex_repo(
+            args.repo,
+            index_file_path=Path(args.index) if args.index else None,
+            functions_path=Path(args.functions),
+            embeddings_path=Path(args.embeddings),
+            db_adapter=db_adapter,
+            registry=ShardRegistry(Path(args.shards_dir)),
+            groups_dir=None if args.no_groups else Path(args.groups_dir),
+        )
+    finally:
+        db_adapter.close_db()
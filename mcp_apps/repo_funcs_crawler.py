@@ -1,9 +1,11 @@
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
 import json
 import os
 from pathlib import Path
 import sys
+import time
 
-from faiss import read_index
 from gigachat import GigaChat
 from typing import Generator
 import uuid
@@ -11,12 +13,18 @@ from dotenv import load_dotenv
 
 from gigachat.models import Chat, Messages, MessagesRole
 import numpy as np
-import faiss
 
 from git import Repo
 from tree_sitter import Language, Parser
 import tree_sitter_python as tspython
 
+from db.adapter import DBAdapter
+from mcp_apps.embedding_cache import EmbeddingCache
+from mcp_apps.embedder import Embedder
+from mcp_apps.embedding_store import EmbeddingStore, EmbeddingStoreWriter, open_embedding_store, store_path_for
+from mcp_apps.index_factory import INDEX_FACTORY, build_index, load_index, save_index
+from mcp_apps.search import HybridSearcher
+
 load_dotenv(override=True)
 
 PY_LANGUAGE = Language(tspython.language())
@@ -34,6 +42,26 @@ OUTPUT_EMBEDDINGS_PATH = Path(__file__).parent / "embeddings"
 OUTPUT_EMBEDDINGS_PATH.mkdir(exist_ok=True)
 
 GIGA_CREDS = os.getenv("GIGA_CREDS")
+EMBEDDINGS_MODEL = os.getenv("EMBEDDINGS_MODEL", "Embeddings")
+# Тип хранения векторов в бинарном хранилище: float32 или float16
+EMBEDDINGS_STORE_DTYPE = os.getenv("EMBEDDINGS_STORE_DTYPE", "float32")
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", os.cpu_count() or 1))
+LANGUAGE_BY_SUFFIX = {".py": "python"}
+# Длина текста, который уходит в эмбеддинг: длинные функции делятся на части не больше этой длины
+MAX_CONTENT_CHARS = int(os.getenv("MAX_CONTENT_CHARS", "1500"))
+# Перекрытие соседних частей: последний оператор части повторяется в следующей, если он не длиннее
+CHUNK_OVERLAP_CHARS = int(os.getenv("CHUNK_OVERLAP_CHARS", "300"))
+# Заголовок функции повторяется в каждой части, слишком длинный обрезается
+MAX_HEADER_CHARS = 300
+
+query_embeddings_cache = EmbeddingCache(
+    db_path=Path(
+        os.getenv("EMBEDDINGS_CACHE_PATH", Path(__file__).parent.parent / "db" / "embeddings_cache.db")
+    ),
+    max_memory_items=int(os.getenv("EMBEDDINGS_CACHE_MEMORY_SIZE", "10000")),
+    max_disk_items=int(os.getenv("EMBEDDINGS_CACHE_DISK_SIZE", "1000000")),
+    ttl_seconds=float(os.getenv("EMBEDDINGS_CACHE_TTL", str(30 * 24 * 3600))),
+)
 
 
 def get_repo_name(repo_url: str) -> str:
@@ -50,12 +78,37 @@ def clone_repo(repo_url: str) -> Repo:
     return rep
 
 
+def sync_repo(repo_url: str) -> tuple[Repo, str | None, str]:
+    """
+    Клонирует репозиторий или обновляет уже скачанную копию через git fetch.
+    Возвращает репозиторий, прежний коммит (None для нового клона) и текущий коммит.
+    """
+    to_path = REPOS_PATH / get_repo_name(repo_url)
+    if not (to_path / ".git").exists():
+        repo = Repo.clone_from(repo_url, to_path, depth=1)
+        return repo, None, repo.head.commit.hexsha
+
+    repo = Repo(to_path)
+    old_commit = repo.head.commit.hexsha
+    repo.git.fetch("--depth=1", "origin")
+    new_commit = repo.git.rev_parse("FETCH_HEAD")
+    if new_commit != old_commit:
+        repo.git.reset("--hard", new_commit)
+    return repo, old_commit, new_commit
+
+
 def walk_all_python_files(repo_path: Path) -> Generator[Path]:
     for f in repo_path.glob("**/*.py"):
         yield f
 
 
-def walk_ast_tree(node, source_code: bytes, functions: list) -> None:
+def walk_ast_tree(node, source_code: bytes, functions: list, class_name: str | None = None) -> None:
+    # Имя объемлющего класса, у вложенных классов - через точку: Outer.Inner
+    if node.type == "class_definition":
+        name = node.child_by_field_name("name")
+        name = source_code[name.start_byte:name.end_byte].decode()
+        class_name = f"{class_name}.{name}" if class_name else name
+
     if node.type == "function_definition":
         function_name = None
         parameters = None
@@ -69,16 +122,25 @@ def walk_ast_tree(node, source_code: bytes, functions: list) -> None:
             elif child.type == "parameters":
                 parameters = source_code[child.start_byte:child.end_byte]
 
+        # Строки операторов тела - границы, по которым длинная функция делится на части
+        body = node.child_by_field_name("body")
+        statements = [
+            (child.start_point[0] + 1, child.end_point[0] + 1)
+            for child in (body.children if body is not None else [])
+        ]
+
         functions.append({
             "name": function_name.decode(),
             "parameters": parameters.decode(),
             "start_line": start_line,
             "end_line": end_line,
             "content": content,
+            "statements": statements,
+            "class_name": class_name,
         })
 
     for child in node.children:
-        walk_ast_tree(child, source_code, functions)
+        walk_ast_tree(child, source_code, functions, class_name)
 
 
 def get_all_functions_from_file(file_path: Path) -> list[dict]:
@@ -91,63 +153,349 @@ def get_all_functions_from_file(file_path: Path) -> list[dict]:
     return functions
 
 
-def process_repo_and_create_functions(repo_url: str):
-    repo_name = get_repo_name(repo_url)
+def is_indexable_file(file_path: Path) -> bool:
+    if file_path.name == "__init__.py":
+        return False
+    if "test" in file_path.name:
+        return False
+    return True
+
+
+def is_indexable_function(fn: dict) -> bool:
+    if fn["name"] == "__init__":
+        return False
+
+    content_lines = len(fn["content"].split("\n"))
+    parameters_lines = len(fn["parameters"].split("\n"))
+    body_lines = content_lines - parameters_lines
+    if body_lines < 4:
+        return False
+    return True
+
+
+def content_hash(content: str) -> str:
+    # Функции, отличающиеся только пробелами и переносами строк, получают один хэш
+    normalized = " ".join(content.split())
+    return hashlib.sha256(normalized.encode()).hexdigest()
+
+
+def vector_key(fn: dict) -> str:
+    # Один вектор на уникальное содержимое. В старых выгрузках без хэша ключ - id функции
+    return fn.get("hash") or fn["id"]
+
+
+def _parts_in_repos(path: str) -> tuple[str, ...] | None:
+    # Части пути после REPOS_PATH: имя репозитория и путь внутри него
+    path = Path(path)
+    try:
+        return path.relative_to(REPOS_PATH).parts
+    except ValueError:
+        pass
+    if REPOS_PATH.name in path.parts[:-1]:
+        return path.parts[path.parts.index(REPOS_PATH.name) + 1:]
+    return None
+
+
+def repo_of(fn: dict) -> str:
+    # В старых выгрузках поля repo нет, имя берется из пути внутри REPOS_PATH
+    if fn.get("repo"):
+        return fn["repo"]
+    parts = _parts_in_repos(fn["path"])
+    return parts[0] if parts else "default"
+
+
+def module_of(path: str) -> str:
+    # Путь внутри репозитория в имя модуля: pkg/sub/mod.py -> pkg.sub.mod, pkg/__init__.py -> pkg
+    parts = list(Path(path).with_suffix("").parts)
+    if len(parts) > 1 and parts[-1] == "__init__":
+        parts.pop()
+    return ".".join(parts)
+
+
+def fn_metadata(fn: dict) -> dict:
+    """Метаданные вхождения для фильтров поиска и группировки по классам и модулям"""
+    parts = _parts_in_repos(fn["path"])
+    path = "/".join(parts[1:]) if parts else Path(fn["path"]).as_posix()
+    language = fn.get("language") or LANGUAGE_BY_SUFFIX.get(Path(fn["path"]).suffix)
+    return {
+        "repo": repo_of(fn),
+        # Функции берутся из git репозиториев, задачи и страницы документации приходят со своими source/kind
+        "source": fn.get("source", "bitbucket"),
+        "kind": fn.get("kind", "function"),
+        "path": path,
+        "language": language,
+        # Модуль есть только у исходного кода, у задач и страниц его нет
+        "module": module_of(path) if language else None,
+        "class_name": fn.get("class_name"),
+    }
+
+
+def parent_fields(fn: dict) -> dict:
+    """
+    Связь записи с функцией для базы: id функции, номер части и, в первой части разбитой функции,
+    полный текст. У неразбитой функции текст уже лежит в functions.code и в parents не пишется,
+    кроме обрезанной до MAX_CONTENT_CHARS: ее полный текст приходит в parent_content.
+    """
+    chunk = fn.get("chunk", 0)
+    start_line, end_line = fn.get("parent_lines") or (fn.get("start_line"), fn.get("end_line"))
+    return {
+        "parent_id": fn.get("parent_id") or fn["id"],
+        "chunk": chunk,
+        "parent_code": fn.get("parent_content") if chunk == 0 else None,
+        "parent_start_line": start_line,
+        "parent_end_line": end_line,
+    }
+
+
+def split_statements(statements: list[tuple[int, int]], span_len, budget: int) -> list[tuple[int, int]]:
+    # Оператор длиннее бюджета (большой if или цикл) делится по строкам
+    units = []
+    for start, end in statements:
+        if span_len(start, end) <= budget:
+            units.append((start, end))
+            continue
+        line = start
+        while line <= end:
+            last = line
+            while last < end and span_len(line, last + 1) <= budget:
+                last += 1
+            units.append((line, last))
+            line = last + 1
+    return units
+
+
+def chunk_function(fn: dict) -> list[tuple[str, int, int]]:
+    """
+    Делит функцию на части не длиннее MAX_CONTENT_CHARS по границам операторов тела.
+
+    Каждая часть начинается с заголовка функции (def и параметры), соседние части
+    перекрываются последним оператором предыдущей, если он не длиннее CHUNK_OVERLAP_CHARS.
+    Функция, которая помещается целиком, остается одной частью с прежним текстом.
+    Возвращает тройки (текст, первая строка, последняя строка).
+    """
+    content, first_line = fn["content"], fn["start_line"]
+    statements = fn.get("statements") or []
+    if len(content) <= MAX_CONTENT_CHARS or not statements:
+        return [(content[:MAX_CONTENT_CHARS], first_line, fn["end_line"])]
+
+    lines = content.split("\n")
+
+    def span_text(start: int, end: int) -> str:
+        return "\n".join(lines[start - first_line:end - first_line + 1])
+
+    def span_len(start: int, end: int) -> int:
+        return len(span_text(start, end))
+
+    header = span_text(first_line, max(first_line, statements[0][0] - 1))[:MAX_HEADER_CHARS]
+    budget = max(1, MAX_CONTENT_CHARS - len(header) - 1)
+    units = split_statements(statements, span_len, budget)
+
+    chunks = []
+    i = 0
+    while i < len(units):
+        j = i
+        while j + 1 < len(units) and span_len(units[i][0], units[j + 1][1]) <= budget:
+            j += 1
+        start, end = units[i][0], units[j][1]
+        chunks.append(((header + "\n" + span_text(start, end))[:MAX_CONTENT_CHARS], start, end))
+        if j + 1 >= len(units):
+            break
+        overlap = j > i and span_len(*units[j]) <= CHUNK_OVERLAP_CHARS
+        i = j if overlap else j + 1
+    return chunks
+
+
+def chunk_records(fn: dict) -> list[dict]:
+    """
+    Записи для эмбеддинга: функция целиком или ее части. У частей id вида <id функции>#<номер>,
+    parent_id и строки функции; полный текст функции хранится в первой части.
+    """
+    statements = fn.pop("statements", None)
+    pieces = chunk_function({**fn, "statements": statements})
+    if len(pieces) == 1:
+        text, _, _ = pieces[0]
+        # Хэш того текста, который уходит в эмбеддинг
+        record = {**fn, "content": text, "hash": content_hash(text)}
+        if text != fn["content"]:
+            record["parent_content"] = fn["content"]
+        return [record]
+
+    records = []
+    for n, (text, start_line, end_line) in enumerate(pieces):
+        record = {
+            **fn,
+            "id": f"{fn['id']}#{n}",
+            "parent_id": fn["id"],
+            "chunk": n,
+            "parent_lines": [fn["start_line"], fn["end_line"]],
+            "start_line": start_line,
+            "end_line": end_line,
+            "content": text,
+            "hash": content_hash(text),
+        }
+        if n == 0:
+            record["parent_content"] = fn["content"]
+        records.append(record)
+    return records
+
+
+def extract_functions(file_path: Path) -> list[dict]:
+    # Фильтры применяются в воркере, чтобы не передавать лишнее между процессами
+    funcs = []
+    for fn in get_all_functions_from_file(file_path):
+        if not is_indexable_function(fn):
+            continue
+        fn["id"] = str(uuid.uuid4())
+        fn["path"] = str(file_path)
+        funcs.extend(chunk_records(fn))
+    return funcs
+
+
+def init_parse_worker() -> None:
+    # У каждого процесса свой Parser
+    global parser
+    parser = Parser(PY_LANGUAGE)
+
+
+def make_parse_executor(workers: int = PARSE_WORKERS) -> ProcessPoolExecutor:
+    executor = ProcessPoolExecutor(max_workers=workers, initializer=init_parse_worker)
+    # С fork первая задача сразу запускает все процессы пула. Делаем это до потоков с git:
+    # процесс, форкнутый во время Popen в другом потоке, наследует его служебный канал,
+    # и Popen ждет закрытия канала бесконечно
+    executor.submit(int).result()
+    return executor
+
+
+def parse_files(
+    files: list[Path],
+    output_functions_path: Path,
+    workers: int = PARSE_WORKERS,
+    repo_name: str | None = None,
+    executor: ProcessPoolExecutor | None = None,
+) -> int:
+    """
+    Разбирает файлы в JSONL с функциями, возвращает число функций.
+    executor - общий пул процессов, если разбирается несколько репозиториев одновременно;
+    без него пул на workers процессов создается на время вызова.
+    """
+    n_functions = 0
+    own_executor = None
+    if executor is None and workers > 1:
+        executor = own_executor = make_parse_executor(workers)
+    with open(output_functions_path, "w+") as fd:
+        if executor is not None:
+            # map отдает результаты в порядке файлов, даже если воркеры закончили в другом порядке
+            results = executor.map(extract_functions, files, chunksize=max(1, len(files) // (workers * 8)))
+        else:
+            results = map(extract_functions, files)
+
+        try:
+            for funcs in results:
+                for fn in funcs:
+                    if repo_name is not None:
+                        fn["repo"] = repo_name
+                    fd.write(json.dumps(fn, ensure_ascii=False) + "\n")
+                n_functions += len(funcs)
+        finally:
+            if own_executor is not None:
+                own_executor.shutdown()
+    return n_functions
+
+
+def process_repo_and_create_functions(repo_url: str, workers: int = PARSE_WORKERS):
     clone_repo(repo_url)
+    return extract_repo(get_repo_name(repo_url), workers)
+
+
+def extract_repo(
+    repo_name: str,
+    workers: int = PARSE_WORKERS,
+    executor: ProcessPoolExecutor | None = None,
+) -> Path:
+    # Функции уже скачанного репозитория в OUTPUT_DIR_PATH / <repo>.jsonl
     repo_path = REPOS_PATH / repo_name
 
-    output_functions_path = OUTPUT_DIR_PATH / f"{repo_name}.jsonl"
-    with open(output_functions_path, "w+") as fd:
-        for file_path in walk_all_python_files(repo_path):
-            funcs = get_all_functions_from_file(file_path)
-            for fn in funcs:
-                fn["id"] = str(uuid.uuid4())
-                fn["path"] = str(file_path)
-                if file_path.name == "__init__.py":
-                    continue
-                if "test" in file_path.name:
-                    continue
-                if fn["name"] == "__init__":
-                    continue
-
-                content_lines = len(fn["content"].split("\n"))
-                parameters_lines = len(fn["parameters"].split("\n"))
-                body_lines = content_lines - parameters_lines
-                if body_lines < 4:
-                    continue
-
-                content = fn["content"]
-                if len(content) > 1500:
-                    fn["content"] = content[:1500]
-
-                fd.write(json.dumps(fn, ensure_ascii=False) + "\n")
+    # Сортировка делает порядок функций в выходном файле детерминированным
+    files = sorted(f for f in walk_all_python_files(repo_path) if is_indexable_file(f))
 
+    started = time.perf_counter()
+    output_functions_path = OUTPUT_DIR_PATH / f"{repo_name}.jsonl"
+    # Файл прошлого разбора заменяется только целиком: при ошибке он остается в индексе рабочего пространства
+    tmp_path = output_functions_path.with_suffix(".tmp")
+    n_functions = parse_files(files, tmp_path, workers, repo_name=repo_name, executor=executor)
+    tmp_path.replace(output_functions_path)
+
+    elapsed = time.perf_counter() - started
+    print(
+        f"{repo_name}: {len(files)} файлов, {n_functions} функций за {elapsed:.2f} с "
+        f"({len(files) / max(elapsed, 1e-9):.0f} файлов/с, воркеров: {workers})"
+    )
     return output_functions_path
 
 
-def create_embeddings_for_functions(functions_path: Path) -> Path:
-    output_path = OUTPUT_EMBEDDINGS_PATH / functions_path.name
-    window_size = 4
-    cur_window = []
+def truncate_jsonl(path: Path, n_lines: int) -> None:
+    with open(path, "rb+") as fd:
+        for _ in range(n_lines):
+            if not fd.readline():
+                break
+        fd.truncate()
+
+
+def create_embeddings_for_functions(
+    functions_path: Path,
+    resume: bool = True,
+    output_dir: Path = OUTPUT_EMBEDDINGS_PATH,
+) -> Path:
+    output_path = output_dir / functions_path.name
+    store_path = store_path_for(output_path)
+
+    # Контрольная точка - meta.json бинарного хранилища, он обновляется после каждой пачки
+    done_ids = set()
+    resumed = False
+    if resume and output_path.exists():
+        try:
+            store = EmbeddingStore(store_path)
+        except FileNotFoundError:
+            store = None
+        if store is not None:
+            resumed = True
+            done_ids = set(store.ids)
+            # JSONL мог уйти дальше последней контрольной точки
+            truncate_jsonl(output_path, store.count)
+            print(f"Продолжение с контрольной точки: уже посчитано {store.count} эмбеддингов")
+
+    def pending_functions():
+        # Каждое уникальное содержимое эмбеддится один раз, id вектора - хэш содержимого
+        with open(functions_path, "r") as fd_in:
+            for line in fd_in:
+                fn = json.loads(line)
+                key = vector_key(fn)
+                if key not in done_ids:
+                    done_ids.add(key)
+                    yield {"id": key, "content": fn["content"]}
+
+    embedder = Embedder(GIGA_CREDS, EMBEDDINGS_MODEL)
+    started = time.perf_counter()
+    n_embedded = 0
     with (
-        GigaChat(credentials=GIGA_CREDS, verify_ssl_certs=False) as giga,
-        open(functions_path, "r") as fd_in,
-        open(output_path, "w+") as fd_out,
+        # Хранилище закрывается после JSONL, чтобы meta.json не оказался старше него
+        EmbeddingStoreWriter(store_path, dtype=EMBEDDINGS_STORE_DTYPE, append=resumed) as store,
+        open(output_path, "a" if resumed else "w") as fd_out,
     ):
-        for line in fd_in:
-            fn = json.loads(line)
-            cur_window.append(fn)
-            if len(cur_window) == window_size:
-                embs = giga.embeddings(texts=[f["content"] for f in cur_window])
-                for f, e in zip(cur_window, [e.embedding for e in embs.data]):
-                    fd_out.write(json.dumps({"id": f["id"], "embedding": e}) + "\n")
-                cur_window = []
-
-        if cur_window:
-            embs = giga.embeddings(texts=[f["content"] for f in cur_window])
-            for f, e in zip(cur_window, [e.embedding for e in embs.data]):
+        for batch, vectors in embedder.embed_batches(pending_functions()):
+            for f, e in zip(batch, vectors):
                 fd_out.write(json.dumps({"id": f["id"], "embedding": e}) + "\n")
+            fd_out.flush()
+            store.add([f["id"] for f in batch], vectors)
+            store.checkpoint()
+
+            n_embedded += len(batch)
+            if n_embedded // 1000 != (n_embedded - len(batch)) // 1000:
+                elapsed = time.perf_counter() - started
+                print(f"Посчитано {n_embedded} эмбеддингов, {n_embedded / elapsed:.1f} в секунду")
 
+    elapsed = time.perf_counter() - started
+    print(f"Эмбеддинги готовы: {n_embedded} новых за {elapsed:.1f} с")
     return output_path
 
 
@@ -155,65 +503,75 @@ def cosine(a, b):
     return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
 
 
-def load_statics(index_file_path: Path, embeddings_file_path: Path, data_file_path: Path):
-    index = read_index(index_file_path)
-
-    embeddings_ids = []
-    with open(embeddings_file_path, "r") as fd:
-        for line in fd:
-            e = json.loads(line)
-            embeddings_ids.append(e["id"])
-
-    id2fn = {}
+def load_key2fns(data_file_path: Path) -> dict[str, list[dict]]:
+    # Ключ вектора -> все функции с таким содержимым
+    key2fns = {}
     with open(data_file_path, "r") as fd:
         for line in fd:
             fn = json.loads(line)
-            id2fn[fn["id"]] = fn
+            key2fns.setdefault(vector_key(fn), []).append(fn)
+    return key2fns
 
-    return index, embeddings_ids, id2fn
 
-
-def build_index_from_embeddings(embeddings_file_path: Path, data_file_path: Path):
-    embeddings_ids = []
-    embeddings_matrix = []
-    with open(embeddings_file_path, "r") as fd:
-        for line in fd:
-            e = json.loads(line)
-            embeddings_ids.append(e["id"])
-            embeddings_matrix.append(np.array(e["embedding"], dtype="float32"))
-    embeddings_matrix = np.array(embeddings_matrix)
-
-    id2fn = {}
-    with open(data_file_path, "r") as fd:
-        for line in fd:
-            fn = json.loads(line)
-            id2fn[fn["id"]] = fn
-
-    faiss.normalize_L2(embeddings_matrix)
-    index = faiss.IndexFlatIP(embeddings_matrix[0].shape[0])
-    index.add(embeddings_matrix)
-    return index, embeddings_ids, id2fn
-
-
-def process_text_query(q, index, embeddings_ids, id2fn):
-    with GigaChat(credentials=GIGA_CREDS, verify_ssl_certs=False) as giga:
-        embs = giga.embeddings(texts=[q])
-        q_emb = np.array(embs.data[0].embedding)
-
-    # normalize
-    q_emb = q_emb / np.linalg.norm(q_emb)
-
-    candidates = []
-    candidates_dist, candidates_indices = index.search(np.array([q_emb]), k=10)
-    for score, idx in zip(candidates_dist[0], candidates_indices[0]):
-        fn = id2fn[embeddings_ids[idx]]
-        print(score, fn["content"])
-        candidates.append({
-            "score": score,
-            "fn": fn,
-        })
-
-    return
+def load_statics(index_file_path: Path, embeddings_file_path: Path, data_file_path: Path):
+    # Параметры поиска (nprobe/efSearch) читаются из файла рядом с индексом
+    index = load_index(index_file_path)
+
+    # id читаются из бинарного хранилища через memmap, без разбора JSON
+    embeddings_ids = open_embedding_store(embeddings_file_path, dtype=EMBEDDINGS_STORE_DTYPE).ids
+    key2fns = load_key2fns(data_file_path)
+
+    return index, embeddings_ids, key2fns
+
+
+def build_index_from_embeddings(
+    embeddings_file_path: Path,
+    data_file_path: Path,
+    index_factory: str = INDEX_FACTORY,
+    index_file_path: Path | None = None,
+):
+    store = open_embedding_store(embeddings_file_path, dtype=EMBEDDINGS_STORE_DTYPE)
+    key2fns = load_key2fns(data_file_path)
+
+    index, params = build_index(store, factory=index_factory)
+    if index_file_path is not None:
+        save_index(index, index_file_path, params)
+    return index, store.ids, key2fns
+
+
+def embed_queries(queries: list[str]) -> np.ndarray:
+    def compute(texts: list[str]) -> list[list[float]]:
+        # Большие пачки запросов режутся на параллельные запросы к API
+        return Embedder(GIGA_CREDS, EMBEDDINGS_MODEL).embed(texts)
+
+    vectors = query_embeddings_cache.get_or_compute(queries, EMBEDDINGS_MODEL, compute)
+    return np.array(vectors, dtype="float32")
+
+
+def process_text_query(q, index, db_adapter: DBAdapter):
+    for candidate in process_text_queries([q], index, db_adapter)[0]:
+        fn = candidate["fn"]
+        print(candidate["score"], fn["code"], [f"{o['url']}:{o['start_line']}" for o in candidate["occurrences"]])
+
+
+def process_text_queries(queries: list[str], index, db_adapter: DBAdapter, k: int = 10) -> list[list[dict]]:
+    """
+    Пакетный поиск: эмбеддинги всех запросов считаются пачками,
+    поиск по индексу выполняется одним вызовом по матрице запросов,
+    кандидаты всех запросов поднимаются из базы одним get_by_ids.
+    Части длинных функций сводятся к функции с запасом выдачи, как в HybridSearcher,
+    поэтому в ответе k разных функций с полным кодом из parents.
+    """
+    hits_rows = HybridSearcher(index, db_adapter, embed_queries).search_by_vectors(embed_queries(queries), k)
+    rows = {row["id"]: row for row in db_adapter.get_by_ids(label for hits in hits_rows for label, _ in hits)}
+    return [
+        [
+            {"score": score, "fn": rows[label], "occurrences": rows[label]["occurrences"]}
+            for label, score in hits
+            if label in rows
+        ]
+        for hits in hits_rows
+    ]
 
 
 def main():
@@ -221,13 +579,19 @@ def main():
     output_functions_path = Path(os.getenv("OUTPUT_FUNCTIONS_PATH"))
     # embeddings_path = create_embeddings_for_functions(output_functions_path)
     embeddings_path = Path(os.getenv("EMBEDDINGS_PATH"))
-    index, embeddings_ids, id2fn = build_index_from_embeddings(
-        embeddings_file_path=embeddings_path, data_file_path=output_functions_path
+    index_path = os.getenv("INDEX_PATH")
+    index, _, _ = build_index_from_embeddings(
+        embeddings_file_path=embeddings_path,
+        data_file_path=output_functions_path,
+        index_file_path=Path(index_path) if index_path else None,
     )
+    # Кандидаты поднимаются из базы, заполненной по тем же эмбеддингам (util.fill_the_db)
+    db_adapter = DBAdapter()
+    db_adapter.init_db()
 
     while True:
         q = input("Ваш вопрос: ")
-        process_text_query(q=q, index=index, embeddings_ids=embeddings_ids, id2fn=id2fn)
+        process_text_query(q=q, index=index, db_adapter=db_adapter)
         print()
 
 
@@ -0,0 +1,324 @@
+import math
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
+from enum import Enum
+from functools import cached_property, lru_cache
+from typing import Callable, Sequence
+
+import faiss
+import numpy as np
+
+from db.adapter import DBAdapter
+from db.filters import SearchFilter
+from mcp_apps.index_factory import LabelSelector, filtered_search
+from mcp_apps.metrics import Timings
+
+# Идентификаторы в стиле snake_case, camelCase или с вызовом: check_expire, getUser, run()
+IDENTIFIER_RE = re.compile(r"\b(?:[A-Za-z]\w*_\w+|[a-z]+[A-Z]\w*|\w+(?=\())")
+WORD_RE = re.compile(r"\w+")
+
+SEARCH_MODES = ("auto", "hybrid", "vector", "lexical")
+FILTER_CACHE_SIZE = int(os.getenv("FILTER_CACHE_SIZE", "128"))
+# Как складываются оценки частей одной функции: max - лучшая часть, sum - сумма найденных частей
+CHUNK_AGGREGATIONS = ("max", "sum")
+CHUNK_AGGREGATION = os.getenv("CHUNK_AGGREGATION", "max")
+
+# Слоты FindSimilarAgent.fill_slots (query_type, target_type) и TargetEnum из SimilarCodeAgent
+SOURCES_BY_QUERY_TYPE = {
+    "jira": ("jira",),
+    "bitbucket": ("bitbucket",),
+    "confluence": ("confluence",),
+}
+KINDS_BY_TARGET_TYPE = {
+    "issue": ("issue",),
+    "document": ("document",),
+    "code": ("function",),
+    "function": ("function",),
+    "object": ("class",),
+    "module": ("module",),
+    "repository": ("repository",),
+}
+# Виды вхождений в occurrences; class, module и repository есть только в индексах групп
+OCCURRENCE_KINDS = ("function", "issue", "document")
+
+
+def extract_identifiers(query: str) -> list[str]:
+    return list(dict.fromkeys(IDENTIFIER_RE.findall(query)))
+
+
+def to_match_query(terms: list[str]) -> str:
+    # Каждый термин в кавычках: FTS5 разобьет check_expire на фразу "check expire"
+    return " OR ".join('"{}"'.format(t.replace('"', '""')) for t in terms)
+
+
+def reciprocal_rank_fusion(rankings: list[list[int]], k: int = 60) -> list[tuple[int, float]]:
+    scores: dict[int, float] = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda x: x[1], reverse=True)
+
+
+def aggregate_chunks(
+    hits: list[tuple[int, float]], parent_of: dict[int, str | None], aggregation: str = "max"
+) -> list[tuple[int, float]]:
+    """
+    Сводит попадания в части к функциям: одна функция - одна пара (label лучшей части, score).
+    Векторы без функции (базы без разбиения на части) остаются сами по себе.
+    """
+    best: dict[object, list] = {}
+    for label, score in hits:
+        key = parent_of.get(label) or label
+        if key not in best:
+            best[key] = [label, score]
+        elif aggregation == "sum":
+            best[key][1] += score
+        elif score > best[key][1]:
+            best[key] = [label, score]
+    return sorted(((label, score) for label, score in best.values()), key=lambda x: x[1], reverse=True)
+
+
+def filters_from_slots(
+    query_type: str | Enum = "all",
+    target_type: str | Enum = "all",
+    repos: Sequence[str] | None = None,
+    path_prefix: str | None = None,
+    languages: Sequence[str] | None = None,
+) -> SearchFilter:
+    """Фильтр по значениям слотов, "all" и неизвестные значения не ограничивают поиск"""
+    query_type = getattr(query_type, "value", query_type)
+    target_type = getattr(target_type, "value", target_type)
+    return SearchFilter(
+        sources=SOURCES_BY_QUERY_TYPE.get(query_type, ()),
+        kinds=KINDS_BY_TARGET_TYPE.get(target_type, ()),
+        repos=tuple(repos or ()),
+        languages=tuple(languages or ()),
+        path_prefix=path_prefix or None,
+    )
+
+
+class HybridSearcher:
+    """
+    Поиск по векторному индексу FAISS и полнотекстовому индексу FTS5 в базе.
+
+    Режимы:
+    - vector - только эмбеддинг запроса и FAISS
+    - lexical - только BM25, без обращения к GigaChat
+    - hybrid - оба поиска параллельно, результаты объединяются через reciprocal rank fusion
+    - auto - если в запросе есть идентификаторы и BM25 по ним что-то нашел,
+      отвечаем сразу без эмбеддинга, иначе hybrid
+
+    filters ограничивает поиск по метаданным. В векторном поиске фильтр проверяется
+    внутри index.search через IDSelector, для шардов фильтр по репозиторию - выбор шардов.
+    Лексический поиск фильтруется в базе. Выдача в обоих случаях остается полной.
+
+    Длинные функции проиндексированы частями. Попадания в части одной функции сводятся
+    в одно (aggregation: max или sum), поэтому выдача - k разных функций. Поиск запрашивает
+    с запасом по среднему числу частей на функцию и удваивает запас, пока функций не хватает.
+
+    group_indexes - индексы классов, модулей и репозиториев (mcp_apps.groups). Запрос только
+    по одному из этих видов ищется в маленьком индексе уровня, а не по всем функциям.
+    """
+
+    def __init__(
+        self,
+        index: faiss.Index,
+        db_adapter: DBAdapter,
+        embed_queries: Callable[[list[str]], np.ndarray],
+        max_workers: int = 8,
+        aggregation: str = CHUNK_AGGREGATION,
+        group_indexes: dict[str, faiss.Index] | None = None,
+    ):
+        if aggregation not in CHUNK_AGGREGATIONS:
+            raise ValueError(f"Неизвестная агрегация {aggregation}, доступны {CHUNK_AGGREGATIONS}")
+        self.index = index
+        self.db_adapter = db_adapter
+        self.embed_queries = embed_queries
+        self.aggregation = aggregation
+        self.group_indexes = group_indexes or {}
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        # Селекторы повторяющихся фильтров не пересчитываются
+        self._selector = lru_cache(maxsize=FILTER_CACHE_SIZE)(self._build_selector)
+        self._group_selector = lru_cache(maxsize=FILTER_CACHE_SIZE)(self._build_group_selector)
+
+    def _build_selector(self, filters: SearchFilter) -> LabelSelector:
+        return LabelSelector(self.db_adapter.labels_matching(filters))
+
+    def _build_group_selector(self, filters: SearchFilter) -> LabelSelector:
+        return LabelSelector(self.db_adapter.group_labels_matching(filters))
+
+    def group_kind(self, filters: SearchFilter | None) -> str | None:
+        """Вид группы, если фильтр просит только классы, модули или репозитории и их индекс собран"""
+        if filters is not None and len(filters.kinds) == 1 and filters.kinds[0] in self.group_indexes:
+            return filters.kinds[0]
+        return None
+
+    def occurrence_filters(self, filters: SearchFilter | None) -> SearchFilter | None:
+        """
+        Фильтр для поиска по функциям. Класс, модуль или репозиторий без собранного индекса групп
+        ищется по функциям: таких видов в occurrences нет, и фильтр по ним ничего бы не нашел.
+        """
+        if filters is None or all(kind in OCCURRENCE_KINDS for kind in filters.kinds):
+            return filters
+        kinds = ("function" if kind not in OCCURRENCE_KINDS else kind for kind in filters.kinds)
+        return replace(filters, kinds=tuple(dict.fromkeys(kinds)))
+
+    def search_groups(
+        self, query: str, k: int, timings: Timings | None = None, filters: SearchFilter | None = None
+    ) -> list[tuple[int, float]]:
+        return self.search_groups_batch([query], k, timings, filters)[0]
+
+    def search_groups_batch(
+        self, queries: list[str], k: int, timings: Timings | None = None, filters: SearchFilter | None = None
+    ) -> list[list[tuple[int, float]]]:
+        """Поиск по индексу уровня из filters.kinds, label - номер группы в code_groups"""
+        timings = timings or Timings()
+        with timings.span("embedding"):
+            q_embs = self.embed_queries(queries)
+        return self.search_groups_by_vectors(q_embs, k, timings, filters)
+
+    def search_groups_by_vectors(
+        self, q_embs: np.ndarray, k: int, timings: Timings | None = None, filters: SearchFilter | None = None
+    ) -> list[list[tuple[int, float]]]:
+        kind = self.group_kind(filters)
+        if kind is None:
+            raise ValueError(f"Нет индекса групп для фильтра {filters}")
+        q_embs = np.array(q_embs, dtype="float32", ndmin=2)
+        faiss.normalize_L2(q_embs)
+
+        index = self.group_indexes[kind]
+        with (timings or Timings()).span("index_search"):
+            if filters.without_kinds().is_empty():
+                distances, labels = index.search(q_embs, k)
+            else:
+                distances, labels = filtered_search(index, q_embs, k, self._group_selector(filters))
+        return [
+            [(int(label), float(d)) for d, label in zip(row_d, row_l) if label >= 0]
+            for row_d, row_l in zip(distances, labels)
+        ]
+
+    @cached_property
+    def overfetch(self) -> float:
+        return self.db_adapter.chunks_per_parent()
+
+    def fetch_k(self, k: int) -> int:
+        return max(k, math.ceil(k * self.overfetch))
+
+    def _index_search(
+        self, q_embs: np.ndarray, k: int, filters: SearchFilter | None
+    ) -> tuple[np.ndarray, np.ndarray]:
+        filters = self.occurrence_filters(filters)
+        if filters is None or filters.is_empty():
+            return self.index.search(q_embs, k)
+        if hasattr(self.index, "repos"):
+            rest = filters.without_repos()
+            selector = None if rest.is_empty() else self._selector(rest)
+            return self.index.search(q_embs, k, repos=filters.repos, selector=selector)
+        return filtered_search(self.index, q_embs, k, self._selector(filters))
+
+    def search_vector(
+        self, query: str, k: int, timings: Timings | None = None, filters: SearchFilter | None = None
+    ) -> list[tuple[int, float]]:
+        return self.search_vector_batch([query], k, timings, filters)[0]
+
+    def search_vector_batch(
+        self, queries: list[str], k: int, timings: Timings | None = None, filters: SearchFilter | None = None
+    ) -> list[list[tuple[int, float]]]:
+        timings = timings or Timings()
+        with timings.span("embedding"):
+            q_embs = self.embed_queries(queries)
+        return self.search_by_vectors(q_embs, k, timings, filters)
+
+    def search_by_vectors(
+        self, q_embs: np.ndarray, k: int, timings: Timings | None = None, filters: SearchFilter | None = None
+    ) -> list[list[tuple[int, float]]]:
+        """Векторный поиск по готовым эмбеддингам запросов, по строке на запрос"""
+        timings = timings or Timings()
+        q_embs = np.array(q_embs, dtype="float32", ndmin=2)
+        faiss.normalize_L2(q_embs)
+
+        results: list[list[tuple[int, float]] | None] = [None] * len(q_embs)
+        rows = list(range(len(q_embs)))
+        fetch_k = min(self.fetch_k(k), max(k, self.index.ntotal))
+        while rows:
+            # Один вызов index.search по матрице всех запросов, которым еще не хватает функций
+            with timings.span("index_search"):
+                distances, labels = self._index_search(q_embs[rows], fetch_k, filters)
+            hits_rows = [
+                [(int(label), float(d)) for d, label in zip(row_d, row_l) if label >= 0]
+                for row_d, row_l in zip(distances, labels)
+            ]
+            parent_of = self.db_adapter.parents_of(label for hits in hits_rows for label, _ in hits)
+            retry = []
+            for row, hits in zip(rows, hits_rows):
+                functions = aggregate_chunks(hits, parent_of, self.aggregation)
+                # Индекс отдал меньше, чем просили, - больше векторов под фильтр нет
+                if len(functions) >= k or len(hits) < fetch_k or fetch_k >= self.index.ntotal:
+                    results[row] = functions[:k]
+                else:
+                    retry.append(row)
+            rows = retry
+            fetch_k = min(fetch_k * 2, self.index.ntotal)
+        return results
+
+    def search_lexical(
+        self,
+        query: str,
+        k: int,
+        terms: list[str] | None = None,
+        timings: Timings | None = None,
+        filters: SearchFilter | None = None,
+    ) -> list[tuple[int, float]]:
+        terms = terms or WORD_RE.findall(query)
+        if not terms:
+            return []
+        with (timings or Timings()).span("lexical_search"):
+            hits = self.db_adapter.search_lexical(
+                to_match_query(terms), self.fetch_k(k), self.occurrence_filters(filters)
+            )
+            parent_of = self.db_adapter.parents_of(label for label, _ in hits)
+        return aggregate_chunks(hits, parent_of, self.aggregation)[:k]
+
+    def search_hybrid(
+        self, query: str, k: int, timings: Timings | None = None, filters: SearchFilter | None = None
+    ) -> list[tuple[int, float]]:
+        fetch_k = k * 3
+        # Ветки идут параллельно, поэтому сумма их длительностей больше времени поиска
+        vector_future = self._executor.submit(self.search_vector, query, fetch_k, timings, filters)
+        lexical_future = self._executor.submit(self.search_lexical, query, fetch_k, None, timings, filters)
+        vector_hits, lexical_hits = vector_future.result(), lexical_future.result()
+        # Ветки могут выбрать разные части одной функции, объединяем по функции
+        parent_of = self.db_adapter.parents_of(label for label, _ in vector_hits + lexical_hits)
+        representative = {}
+        rankings = []
+        for hits in (vector_hits, lexical_hits):
+            ranking = []
+            for label, _ in hits:
+                key = parent_of.get(label) or label
+                representative.setdefault(key, label)
+                ranking.append(key)
+            rankings.append(ranking)
+        return [(representative[key], score) for key, score in reciprocal_rank_fusion(rankings)[:k]]
+
+    def search(
+        self,
+        query: str,
+        k: int = 10,
+        mode: str = "auto",
+        timings: Timings | None = None,
+        filters: SearchFilter | None = None,
+    ) -> tuple[list[tuple[int, float]], str]:
+        """Возвращает пары (id, score) и режим, которым они найдены"""
+        if mode == "vector":
+            return self.search_vector(query, k, timings, filters), mode
+        if mode == "lexical":
+            return self.search_lexical(query, k, timings=timings, filters=filters), mode
+        if mode == "auto":
+            identifiers = extract_identifiers(query)
+            if identifiers:
+                hits = self.search_lexical(query, k, terms=identifiers, timings=timings, filters=filters)
+                if hits:
+                    return hits, "lexical"
+        return self.search_hybrid(query, k, timings, filters), "hybrid"
@@ -1,11 +1,8 @@
 import json
 import os
-from pathlib import Path
 from typing import Any
 
 import mcp
-import numpy as np
-from gigachat import GigaChat
 from mcp import types
 from mcp.server.fastmcp import FastMCP
 from mcp.server.lowlevel import NotificationOptions, Server
@@ -14,7 +11,19 @@ from mcp.server.models import InitializationOptions
 from dotenv import load_dotenv
 
 from db.adapter import DBAdapter
-from mcp_apps.repo_funcs_crawler import process_text_query, load_statics
+from db.filters import SearchFilter
+from mcp_apps.groups import load_group_indexes
+from mcp_apps.metrics import Timings
+from mcp_apps.repo_funcs_crawler import embed_queries, query_embeddings_cache
+from mcp_apps.search import (
+    KINDS_BY_TARGET_TYPE,
+    OCCURRENCE_KINDS,
+    SEARCH_MODES,
+    SOURCES_BY_QUERY_TYPE,
+    HybridSearcher,
+    filters_from_slots,
+)
+from mcp_apps.shards import ShardRegistry, load_search_index
 
 load_dotenv(override=True)
 
@@ -22,15 +31,17 @@ server = Server("example-server")
 
 GIGA_CREDS = os.getenv("GIGA_CREDS")
 
-index, embeddings_ids, id2fn = load_statics(
-    index_file_path=Path(os.getenv("INDEX_PATH")),
-    embeddings_file_path=Path(os.getenv("EMBEDDINGS_PATH")),
-    data_file_path=Path(os.getenv("OUTPUT_FUNCTIONS_PATH")),
-)
+# Если собраны шарды по репозиториям, поиск идет по ним и поддерживает фильтр по репозиторию,
+# иначе по одному общему индексу. Функции в обоих случаях поднимаются из базы по label
+shard_registry = ShardRegistry()
+index = load_search_index(shard_registry)
 
 db_adapter = DBAdapter()
 db_adapter.init_db()
 
+# Классы, модули и репозитории ищутся по своим маленьким индексам, если они собраны
+searcher = HybridSearcher(index, db_adapter, embed_queries, group_indexes=load_group_indexes())
+
 
 @server.list_prompts()
 async def handle_list_prompts() -> list[types.Prompt]:
@@ -46,6 +57,57 @@ async def handle_list_prompts() -> list[types.Prompt]:
     ]
 
 
+def target_types() -> list[str]:
+    # Классы, модули и репозитории предлагаются, только если их индекс групп собран
+    return [
+        target_type for target_type, kinds in KINDS_BY_TARGET_TYPE.items()
+        if all(kind in OCCURRENCE_KINDS or kind in searcher.group_indexes for kind in kinds)
+    ]
+
+
+def filter_properties() -> dict:
+    # Фильтры по метаданным, значения слотов как у FindSimilarAgent.fill_slots
+    repos_items = {"type": "string"}
+    if shard_registry.repos():
+        repos_items["enum"] = shard_registry.repos()
+    return {
+        "query_type": {
+            "type": "string",
+            "enum": [*SOURCES_BY_QUERY_TYPE, "all"],
+            "description": "Источник: jira, bitbucket, confluence или all (по умолчанию)"
+        },
+        "target_type": {
+            "type": "string",
+            "enum": [*target_types(), "all"],
+            "description": f"Что ищем: {', '.join(target_types())} или all (по умолчанию); "
+                           "object - класс"
+        },
+        "repos": {
+            "type": "array",
+            "items": repos_items,
+            "description": "Искать только в этих репозиториях (по умолчанию во всех)"
+        },
+        "path_prefix": {
+            "type": "string",
+            "description": "Искать только в файлах с этим префиксом пути внутри репозитория"
+        },
+        "language": {
+            "type": "string",
+            "description": "Язык программирования, например python"
+        },
+    }
+
+
+def filters_from_arguments(arguments: dict) -> SearchFilter:
+    return filters_from_slots(
+        query_type=arguments.get("query_type", "all"),
+        target_type=arguments.get("target_type", "all"),
+        repos=arguments.get("repos"),
+        path_prefix=arguments.get("path_prefix"),
+        languages=[arguments["language"]] if arguments.get("language") else None,
+    )
+
+
 @server.list_tools()
 async def handle_list_tools() -> list[types.Tool]:
     return [
@@ -58,37 +120,154 @@ async def handle_list_tools() -> list[types.Tool]:
                     "query": {
                         "type": "string",
                         "description": "Что ищет пользователь"
-                    }
+                    },
+                    "mode": {
+                        "type": "string",
+                        "enum": list(SEARCH_MODES),
+                        "description": "Режим поиска: auto (по умолчанию), hybrid, vector или lexical "
+                                       "(точный поиск по именам функций и коду)"
+                    },
+                    **filter_properties(),
                 },
                 "required": ["query"]
             }
-        )
+        ),
+        types.Tool(
+            name="search_candidates_batch",
+            description="Возвращает кандидатов для каждого из нескольких текстовых запросов",
+            inputSchema={
+                "type": "object",
+                "properties": {
+                    "queries": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "Список запросов"
+                    },
+                    "k": {
+                        "type": "integer",
+                        "description": "Количество кандидатов на запрос (по умолчанию 10)"
+                    },
+                    **filter_properties(),
+                },
+                "required": ["queries"]
+            }
+        ),
     ]
 
 
+def with_metrics(result: dict, timings: Timings, cache_before: dict) -> dict:
+    # Сервер работает в подпроцессе, поэтому длительности стадий и обращения к кэшу
+    # возвращаются клиенту в результате инструмента, а он переносит их в /metrics
+    result["metrics"] = {
+        "timings": timings.to_dict(),
+        "cache": {
+            key: value - cache_before.get(key, 0) for key, value in query_embeddings_cache.stats.items()
+        },
+    }
+    return result
+
+
+def format_candidate(cand: dict, score: float) -> dict:
+    return {
+        "score": round(score, 4),
+        "path": cand["url"],
+        "content": cand["code"],
+        # Все места, где встречается функция с таким же содержимым
+        "occurrences": [
+            {"path": o["url"], "start_line": o["start_line"], "end_line": o["end_line"]}
+            for o in cand["occurrences"]
+        ],
+    }
+
+
+def format_group(group: dict, score: float) -> dict:
+    return {
+        "score": round(score, 4),
+        "kind": group["kind"],
+        "name": group["name"],
+        "repo": group["repo"],
+        "path": group["url"],
+        "size": group["size"],
+        # Функции класса или модуля, у репозитория - его крупнейшие модули
+        "members": group["members"],
+    }
+
+
 @server.call_tool()
 async def handle_call_tool(
         name: str, arguments: dict | None
 ) -> list[types.TextContent | types.ImageContent | types.EmbeddedResource]:
+    timings = Timings()
+    cache_before = dict(query_embeddings_cache.stats)
+
+    filters = filters_from_arguments(arguments)
+    group_kind = searcher.group_kind(filters)
+
+    if name == "search_candidates" and group_kind:
+        hits = searcher.search_groups(arguments["query"], k=10, timings=timings, filters=filters)
+        scores = dict(hits)
+        with timings.span("hydration"):
+            groups = db_adapter.get_groups(group_kind, [label for label, _ in hits])
+        result = {
+            "status": "success",
+            "mode": "vector",
+            "candidates": [format_group(group, scores[group["id"]]) for group in groups]
+        }
+        result = with_metrics(result, timings, cache_before)
+        return [types.TextContent(type="text", text=json.dumps(result, ensure_ascii=False))]
+
     if name == "search_candidates":
-        with GigaChat(credentials=GIGA_CREDS, verify_ssl_certs=False) as giga:
-            embs = giga.embeddings(texts=[arguments["query"]])
-        q_emb = np.array(embs.data[0].embedding)
-        q_emb = q_emb / np.linalg.norm(q_emb)
-        candidates_dist, candidates_indices = index.search(np.array([q_emb]), k=10)
+        hits, mode = searcher.search(
+            arguments["query"],
+            k=10,
+            mode=arguments.get("mode", "auto"),
+            timings=timings,
+            filters=filters,
+        )
+        scores = dict(hits)
+
+        with timings.span("hydration"):
+            candidates = db_adapter.get_by_ids([label for label, _ in hits])
+
+        result = {
+            "status": "success",
+            "mode": mode,
+            "candidates": [format_candidate(cand, scores[cand["id"]]) for cand in candidates]
+        }
+        result = with_metrics(result, timings, cache_before)
+        return [types.TextContent(type="text", text=json.dumps(result, ensure_ascii=False))]
+
+    if name == "search_candidates_batch":
+        search_batch = searcher.search_groups_batch if group_kind else searcher.search_vector_batch
+        hits_per_query = search_batch(
+            arguments["queries"],
+            k=arguments.get("k", 10),
+            timings=timings,
+            filters=filters,
+        )
 
-        candidates = db_adapter.get_by_vectors(candidates_indices[0])
+        # Кандидаты всех запросов поднимаются из базы одним запросом
+        all_labels = list(dict.fromkeys(label for hits in hits_per_query for label, _ in hits))
+        with timings.span("hydration"):
+            if group_kind:
+                by_id = {group["id"]: group for group in db_adapter.get_groups(group_kind, all_labels)}
+            else:
+                by_id = {cand["id"]: cand for cand in db_adapter.get_by_ids(all_labels)}
+        format_hit = format_group if group_kind else format_candidate
 
         result = {
             "status": "success",
-            "candidates": [
+            "results": [
                 {
-                    "path": cand["url"],
-                    "content": cand["code"]
+                    "query": query,
+                    "candidates": [
+                        format_hit(by_id[label], score) for label, score in hits if label in by_id
+                    ],
                 }
-                for cand in candidates
+                for query, hits in zip(arguments["queries"], hits_per_query)
             ]
         }
+        result = with_metrics(result, timings, cache_before)
         return [types.TextContent(type="text", text=json.dumps(result, ensure_ascii=False))]
 
     raise RuntimeError("unknown")
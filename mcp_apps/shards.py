@@ -0,0 +1,215 @@
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Sequence
+
+import faiss
+import numpy as np
+
+from mcp_apps.embedding_store import open_embedding_store
+from mcp_apps.index_factory import (
+    INDEX_FACTORY,
+    LabelSelector,
+    build_index,
+    filtered_search,
+    load_index,
+    params_path_for,
+    save_index,
+)
+from mcp_apps.repo_funcs_crawler import EMBEDDINGS_STORE_DTYPE, repo_of, vector_key
+
+INDEX_SHARDS_DIR = Path(os.getenv("INDEX_SHARDS_DIR", Path(__file__).parent / "indexes"))
+SHARD_SEARCH_WORKERS = int(os.getenv("SHARD_SEARCH_WORKERS", "8"))
+
+
+class ShardRegistry:
+    """
+    Реестр шардов: по одному индексу FAISS на репозиторий (имя из get_repo_name).
+
+    Шарды хранятся в одной папке как <repo>.faiss с параметрами поиска рядом,
+    registry.json описывает, какие репозитории есть, их размер и время сборки.
+    Label в шарде - глобальный номер строки в хранилище эмбеддингов,
+    поэтому база функций остается общей для всех шардов.
+    """
+
+    def __init__(self, shards_dir: Path = INDEX_SHARDS_DIR):
+        self.shards_dir = Path(shards_dir)
+        self.shards_dir.mkdir(parents=True, exist_ok=True)
+        self.registry_path = self.shards_dir / "registry.json"
+        self.entries: dict[str, dict] = {}
+        if self.registry_path.exists():
+            self.entries = json.loads(self.registry_path.read_text())
+
+    def __contains__(self, repo: str) -> bool:
+        return repo in self.entries
+
+    def repos(self) -> list[str]:
+        return sorted(self.entries)
+
+    def shard_path(self, repo: str) -> Path:
+        return self.shards_dir / f"{repo}.faiss"
+
+    def load(self, repo: str) -> faiss.Index:
+        return load_index(self.shard_path(repo))
+
+    def save_shard(self, repo: str, index: faiss.Index, params: dict) -> None:
+        save_index(index, self.shard_path(repo), params)
+        self.entries[repo] = {
+            "count": index.ntotal,
+            "factory": params.get("factory"),
+            "updated": time.time(),
+        }
+        self._save()
+
+    def remove(self, repo: str) -> None:
+        self.entries.pop(repo, None)
+        self.shard_path(repo).unlink(missing_ok=True)
+        params_path_for(self.shard_path(repo)).unlink(missing_ok=True)
+        self._save()
+
+    def _save(self) -> None:
+        tmp_path = self.registry_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(self.entries, ensure_ascii=False, indent=2))
+        tmp_path.replace(self.registry_path)
+
+
+def merge_topk(results: list[tuple[np.ndarray, np.ndarray]], k: int) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Сливает выдачи шардов в общий top-k по score.
+    Одинаковое содержимое в разных репозиториях - один label, он остается один раз.
+    """
+    distances = np.hstack([d for d, _ in results])
+    labels = np.hstack([i for _, i in results])
+    n = len(distances)
+    out_d = np.full((n, k), -np.inf, dtype="float32")
+    out_i = np.full((n, k), -1, dtype="int64")
+    for row in range(n):
+        seen = set()
+        col = 0
+        for j in np.argsort(-distances[row], kind="stable"):
+            label = int(labels[row, j])
+            if label < 0 or label in seen:
+                continue
+            seen.add(label)
+            out_d[row, col] = distances[row, j]
+            out_i[row, col] = label
+            col += 1
+            if col == k:
+                break
+    return out_d, out_i
+
+
+class FederatedIndex:
+    """
+    Набор шардов с тем же интерфейсом search, что у индекса FAISS.
+
+    Выбранные шарды опрашиваются параллельно (FAISS отпускает GIL на время поиска),
+    выдачи сливаются в общий top-k. Без фильтра опрашиваются все шарды.
+    selector дополнительно фильтрует векторы внутри каждого шарда.
+    """
+
+    def __init__(self, shards: dict[str, faiss.Index], max_workers: int = SHARD_SEARCH_WORKERS):
+        self.shards = shards
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    @classmethod
+    def from_registry(cls, registry: ShardRegistry) -> "FederatedIndex":
+        return cls({repo: registry.load(repo) for repo in registry.repos()})
+
+    @property
+    def ntotal(self) -> int:
+        return sum(index.ntotal for index in self.shards.values())
+
+    def repos(self) -> list[str]:
+        return sorted(self.shards)
+
+    def search(
+        self,
+        x: np.ndarray,
+        k: int,
+        repos: Sequence[str] | None = None,
+        selector: LabelSelector | None = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        names = [r for r in repos if r in self.shards] if repos else self.repos()
+        if not names:
+            return np.full((len(x), k), -np.inf, dtype="float32"), np.full((len(x), k), -1, dtype="int64")
+
+        def search_shard(repo: str) -> tuple[np.ndarray, np.ndarray]:
+            if selector is None:
+                return self.shards[repo].search(x, k)
+            return filtered_search(self.shards[repo], x, k, selector)
+
+        if len(names) == 1:
+            return search_shard(names[0])
+        return merge_topk(list(self._executor.map(search_shard, names)), k)
+
+
+def load_search_index(registry: ShardRegistry | None = None) -> faiss.Index | FederatedIndex:
+    """Шарды по репозиториям, если они собраны, иначе общий индекс из INDEX_PATH"""
+    registry = registry or ShardRegistry()
+    if registry.repos():
+        return FederatedIndex.from_registry(registry)
+    return load_index(Path(os.getenv("INDEX_PATH")))
+
+
+def labels_by_repo(embeddings_file_path: Path, data_file_path: Path) -> dict[str, np.ndarray]:
+    # Номера строк хранилища для каждого репозитория по JSONL с функциями
+    store = open_embedding_store(embeddings_file_path, dtype=EMBEDDINGS_STORE_DTYPE)
+    key2label = {key: label for label, key in enumerate(store.ids)}
+    labels = {}
+    with open(data_file_path, "r") as fd:
+        for line in fd:
+            fn = json.loads(line)
+            label = key2label.get(vector_key(fn))
+            if label is not None:
+                labels.setdefault(repo_of(fn), set()).add(label)
+    return {repo: np.array(sorted(repo_labels), dtype="int64") for repo, repo_labels in labels.items()}
+
+
+def build_shards(
+    embeddings_file_path: Path,
+    data_file_path: Path,
+    registry: ShardRegistry,
+    index_factory: str = INDEX_FACTORY,
+    repos: Sequence[str] | None = None,
+) -> dict[str, int]:
+    """Строит шарды для выбранных репозиториев (по умолчанию всех), остальные не трогает"""
+    store = open_embedding_store(embeddings_file_path, dtype=EMBEDDINGS_STORE_DTYPE)
+    repo_labels = labels_by_repo(embeddings_file_path, data_file_path)
+    if not repos:
+        # Полная сборка убирает шарды репозиториев, которых больше нет в выгрузке
+        for stale in set(registry.repos()) - set(repo_labels):
+            registry.remove(stale)
+
+    sizes = {}
+    for repo, labels in sorted(repo_labels.items()):
+        if repos and repo not in repos:
+            continue
+        started = time.perf_counter()
+        index, params = build_index(store, factory=index_factory, labels=labels)
+        registry.save_shard(repo, index, params)
+        sizes[repo] = index.ntotal
+        print(f"Шард {repo}: {index.ntotal} векторов, {params['factory']}, {time.perf_counter() - started:.2f} с")
+    return sizes
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Сборка индексов FAISS по одному на репозиторий.")
+    parser.add_argument("--embeddings", default=os.getenv("EMBEDDINGS_PATH"), help="Путь к JSONL с эмбеддингами")
+    parser.add_argument("--functions", default=os.getenv("OUTPUT_FUNCTIONS_PATH"), help="Путь к JSONL с функциями")
+    parser.add_argument("--shards-dir", default=INDEX_SHARDS_DIR, help="Папка с шардами и реестром")
+    parser.add_argument("--factory", default=INDEX_FACTORY, help="Строка faiss.index_factory")
+    parser.add_argument("--repo", action="append", dest="repos",
+                        help="Пересобрать только этот репозиторий, можно указать несколько раз")
+    args = parser.parse_args()
+
+    build_shards(
+        Path(args.embeddings),
+        Path(args.functions),
+        ShardRegistry(Path(args.shards_dir)),
+        index_factory=args.factory,
+        repos=args.repos,
+    )
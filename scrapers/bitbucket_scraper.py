@@ -1,63 +1,163 @@
 import argparse
-import requests
-from requests_pkcs12 import Pkcs12Adapter
+import shutil
+import time
+from pathlib import Path
+from typing import Iterator
 
+from db.adapter import DBAdapter
+from mcp_apps.embedding_store import open_embedding_store
+from mcp_apps.groups import build_group_indexes
+from mcp_apps.repo_funcs_crawler import (
+    EMBEDDINGS_STORE_DTYPE,
+    OUTPUT_DIR_PATH,
+    PARSE_WORKERS,
+    create_embeddings_for_functions,
+    extract_repo,
+    get_repo_name,
+    make_parse_executor,
+    sync_repo,
+)
+from mcp_apps.shards import ShardRegistry, build_shards
+from scrapers.session import fetch_concurrently, get_json, make_session
+from util.fill_the_db import main as fill_the_db
+
+CLONE_WORKERS = 8
 
-# Функция для получения списка репозиториев
-def get_repositories(base_url, workspace, session, headers):
-    url = f"{base_url}/repositories/{workspace}"
-    all_repositories = []
 
+# Генератор репозиториев рабочего пространства, страницы запрашиваются по мере чтения
+def iter_repositories(base_url, workspace, session) -> Iterator[dict]:
+    url = f"{base_url}/repositories/{workspace}"
     while url:
-        response = session.get(url, headers=headers, verify=False)
-        if response.status_code == 200:
-            data = response.json()
-            all_repositories.extend(data.get("values", []))
-            url = data.get("next")  # Переход к следующей странице
-        else:
-            print(f"Ошибка: {response.status_code}")
-            print(response.text)
-            break
+        data = get_json(session, url, verify=False)
+        yield from data.get("values", [])
+        url = data.get("next")  # Переход к следующей странице
+
+
+def clone_url_of(repo: dict) -> str:
+    # Предпочитаем https: ssh требует отдельной настройки ключей
+    links = repo["links"]["clone"]
+    for link in links:
+        if link.get("name") == "https":
+            return link["href"]
+    return links[0]["href"]
+
+
+def sync_and_extract(clone_url: str, executor, parse_workers: int, force: bool = False) -> dict:
+    """
+    Клонирует или обновляет репозиторий и, если он изменился, сразу разбирает его функции.
+    Ошибка одного репозитория не останавливает остальные.
+    """
+    repo_name = get_repo_name(clone_url)
+    started = time.perf_counter()
+    try:
+        _, old_commit, new_commit = sync_repo(clone_url)
+        functions_path = OUTPUT_DIR_PATH / f"{repo_name}.jsonl"
+        updated = force or old_commit != new_commit or not functions_path.exists()
+        if updated:
+            extract_repo(repo_name, parse_workers, executor=executor)
+        status = "new" if old_commit is None else "updated" if updated else "unchanged"
+    except Exception as e:
+        print(f"{repo_name}: ошибка {e}")
+        status, new_commit = "failed", None
+    return {
+        "repo": repo_name,
+        "status": status,
+        "commit": new_commit,
+        "seconds": time.perf_counter() - started,
+    }
 
-    return all_repositories
+
+def merge_functions(repo_names: list[str], output_path: Path) -> Path:
+    # Общий JSONL рабочего пространства из файлов репозиториев, потоково
+    tmp_path = output_path.with_suffix(".tmp")
+    with open(tmp_path, "wb") as out:
+        for repo_name in sorted(repo_names):
+            path = OUTPUT_DIR_PATH / f"{repo_name}.jsonl"
+            if path.exists():
+                with open(path, "rb") as fd:
+                    shutil.copyfileobj(fd, out)
+    tmp_path.replace(output_path)
+    return output_path
+
+
+def build_workspace_index(workspace: str, repo_names: list[str], updated: list[str]) -> None:
+    """
+    Эмбеддинги, шарды, база и индексы групп для рабочего пространства.
+    Эмбеддинги считаются только для нового содержимого, шарды и группы пересобираются
+    только для изменившихся репозиториев. repo_names - все репозитории с файлом функций,
+    в том числе те, что не удалось обновить в этот раз.
+    """
+    functions_path = merge_functions(repo_names, OUTPUT_DIR_PATH / f"{workspace}.jsonl")
+    embeddings_path = create_embeddings_for_functions(functions_path, resume=True)
+    if updated:
+        build_shards(embeddings_path, functions_path, ShardRegistry(), repos=updated)
+    fill_the_db(embeddings_path, functions_path, batch_size=50_000, store_vectors=True)
+    if updated:
+        db_adapter = DBAdapter()
+        db_adapter.init_db()
+        try:
+            store = open_embedding_store(embeddings_path, dtype=EMBEDDINGS_STORE_DTYPE)
+            build_group_indexes(db_adapter, store, repos=updated)
+        finally:
+            db_adapter.close_db()
 
 
 # Основная функция
-def main(base_url, username, password, p12_cert_path, p12_password, workspace):
-    # Настройка сессии
-    session = requests.Session()
-
-    # Добавляем адаптер для работы с .p12 сертификатом
-    session.mount(
-        "https://",
-        Pkcs12Adapter(
-            pkcs12_filename=p12_cert_path,
-            pkcs12_password=p12_password
-        )
-    )
+def main(
+    base_url,
+    username,
+    password,
+    p12_cert_path,
+    p12_password,
+    workspace,
+    clone_workers=CLONE_WORKERS,
+    parse_workers=PARSE_WORKERS,
+    force=False,
+    build_index=False,
+):
+    """
+    Скачивает все репозитории рабочего пространства и разбирает изменившиеся.
 
-    # Аутентификация Basic Auth
-    session.auth = (username, password)
+    Клонирование и git fetch идут параллельно в clone_workers потоках,
+    разбор - в общем пуле из parse_workers процессов, поэтому сеть и ядра заняты одновременно.
+    Уже скачанные репозитории обновляются через git fetch, а не клонируются заново.
+    """
+    session = make_session(username, password, p12_cert_path, p12_password, pool_size=2)
+    clone_urls = (clone_url_of(repo) for repo in iter_repositories(base_url, workspace, session))
 
-    # Заголовки запроса
-    headers = {
-        "Accept": "application/json",
-        "Content-Type": "application/json"
-    }
+    started = time.perf_counter()
+    results = []
+    executor = make_parse_executor(parse_workers)
+    try:
+        def sync(clone_url: str) -> dict:
+            return sync_and_extract(clone_url, executor, parse_workers, force)
+
+        for result in fetch_concurrently(sync, clone_urls, clone_workers):
+            results.append(result)
+            print(f"Репозиторий {result['repo']}: {result['status']}, {result['seconds']:.1f} с")
+    finally:
+        executor.shutdown()
 
-    # Получаем список репозиториев
-    repositories = get_repositories(base_url, workspace, session, headers)
-    for repo in repositories:
-        repo_name = repo["name"]
-        repo_slug = repo["slug"]
-        clone_url = repo["links"]["clone"][0]["href"]  # URL для клонирования
-        print(f"Репозиторий: {repo_name} (Slug: {repo_slug})")
-        print(f"  URL для клонирования: {clone_url}")
+    by_status = {}
+    for result in results:
+        by_status.setdefault(result["status"], []).append(result["repo"])
+    counts = {status: len(repos) for status, repos in by_status.items()}
+    print(f"Рабочее пространство {workspace}: {counts} за {time.perf_counter() - started:.1f} с")
+
+    if build_index:
+        # Репозиторий, который не обновился, остается в индексе с функциями прошлой успешной синхронизации
+        indexed = [
+            r["repo"] for r in results
+            if r["status"] != "failed" or (OUTPUT_DIR_PATH / f"{r['repo']}.jsonl").exists()
+        ]
+        updated = by_status.get("new", []) + by_status.get("updated", [])
+        build_workspace_index(workspace, indexed, updated)
+    return results
 
 
 # Обработка аргументов командной строки
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Скрипт для скачивания репозиториев из Bitbucket.")
+    parser = argparse.ArgumentParser(description="Скрипт для скачивания и разбора репозиториев из Bitbucket.")
     parser.add_argument("--url", required=True,
                         help="Базовый URL до Bitbucket API (например, https://api.bitbucket.org/2.0)")
     parser.add_argument("--username", required=True, help="Имя пользователя Bitbucket")
@@ -65,6 +165,22 @@ if __name__ == "__main__":
     parser.add_argument("--p12_cert_path", required=True, help="Путь к .p12 сертификату")
     parser.add_argument("--p12_password", required=True, help="Пароль от .p12 сертификата")
     parser.add_argument("--workspace", required=True, help="Имя рабочего пространства (workspace)")
+    parser.add_argument("--clone-workers", type=int, default=CLONE_WORKERS, help="Параллельных git clone/fetch")
+    parser.add_argument("--parse-workers", type=int, default=PARSE_WORKERS, help="Процессов для разбора файлов")
+    parser.add_argument("--force", action="store_true", help="Разобрать все репозитории, даже без изменений")
+    parser.add_argument("--build-index", action="store_true",
+                        help="После разбора посчитать эмбеддинги, собрать шарды и заполнить базу")
     args = parser.parse_args()
 
-    main(args.url, args.username, args.password, args.p12_cert_path, args.p12_password, args.workspace)
+    main(
+        args.url,
+        args.username,
+        args.password,
+        args.p12_cert_path,
+        args.p12_password,
+        args.workspace,
+        clone_workers=args.clone_workers,
+        parse_workers=args.parse_workers,
+        force=args.force,
+        build_index=args.build_index,
+    )
@@ -1,130 +1,172 @@
 import argparse
-import os
-from requests_pkcs12 import get
-
-# Путь для сохранения результатов
-output_dir = "confluence_pages"
-os.makedirs(output_dir, exist_ok=True)
-
-# Функция для получения всех страниц в пространстве
-def get_pages_in_space(space_key, base_url, username, password):
-    url = f"{base_url}content"
-    params = {
-        "spaceKey": space_key,
-        "type": "page",  # Только страницы
-        "start": 0,
-        "limit": 100,  # Максимальное количество страниц за один запрос
-        "expand": "body.storage"  # Получаем содержимое страницы в формате HTML
-    }
-
-    all_pages = []
-
+import gzip
+import json
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Iterator
+
+from scrapers.session import fetch_concurrently, get_json, make_session
+
+PAGE_LIMIT = 100
+CONCURRENCY = 4
+# CQL сравнивает время с точностью до минуты, перекрытие не дает потерять страницы на границе
+WATERMARK_OVERLAP = timedelta(minutes=1)
+
+
+def iter_results(session, url: str, params: dict) -> Iterator[dict]:
+    """
+    Результаты постраничного API Confluence по одному.
+    В памяти только текущая страница ответа; идем по _links.next, а если его нет - по start.
+    """
+    params = dict(params)
     while True:
-        response = get(url, params=params, auth=(username, password), pkcs12_filename=p12_cert_path,
-                       pkcs12_password=p12_password, verify=False)
-
-        if response.status_code == 200:
-            data = response.json()
-            pages = data.get("results", [])
-            all_pages.extend(pages)
-
-            # Проверяем, есть ли еще страницы (пагинация)
-            if len(pages) < params["limit"]:
-                break
-
-            # Переходим к следующей странице
-            params["start"] += params["limit"]
+        data = get_json(session, url, params, verify=False)
+        results = data.get("results", [])
+        yield from results
+
+        links = data.get("_links", {})
+        if links.get("next") and links.get("base"):
+            url, params = links["base"] + links["next"], None
+        elif params is not None and len(results) >= params["limit"]:
+            params["start"] = params.get("start", 0) + len(results)
         else:
-            print(f"Ошибка при получении страниц для пространства {space_key}: {response.status_code}")
-            print(response.text)
             break
 
-    return all_pages
-
-
-# Функция для сохранения страниц в структурированном виде
-def save_page_to_file(page, space_key):
-    page_id = page["id"]
-    page_title = page["title"].replace("/", "_").replace("\\", "_")  # Заменяем недопустимые символы
-    page_content = page["body"]["storage"]["value"]
-
-    # Создаем поддиректорию для пространства
-    space_dir = os.path.join(output_dir, space_key)
-    os.makedirs(space_dir, exist_ok=True)
-
-    # Сохраняем страницу в файл
-    file_name = f"{page_title}_{page_id}.html"
-    file_path = os.path.join(space_dir, file_name)
-
-    with open(file_path, "w", encoding="utf-8") as file:
-        file.write(page_content)
 
-    print(f"Страница '{page_title}' сохранена в файл {file_path}")
+# Генератор всех пространств
+def iter_spaces(session, base_url: str) -> Iterator[dict]:
+    yield from iter_results(session, f"{base_url}space", {"limit": PAGE_LIMIT, "start": 0})
 
 
-# Основная функция
-def download_confluence_pages(base_url, username, password, p12_cert_path, p12_password):
-    # Получаем список пространств
-    spaces_url = f"{base_url}space"
-
+# Генератор страниц пространства, при инкрементальной выгрузке - измененных после last_sync
+def iter_pages_in_space(session, base_url: str, space_key: str, last_sync: str | None) -> Iterator[dict]:
+    cql = f'space = "{space_key}" AND type = page'
+    if last_sync:
+        cql += f' AND lastmodified >= "{last_sync}"'
     params = {
-        "limit": 10,  # Максимальное количество пространств за один запрос
-        "start": 0
+        "cql": cql,
+        "start": 0,
+        "limit": PAGE_LIMIT,
+        "expand": "body.storage,version",  # Содержимое в формате HTML и версия страницы
+    }
+    yield from iter_results(session, f"{base_url}content/search", params)
+
+
+def page_record(page: dict, space_key: str) -> dict:
+    version = page.get("version", {})
+    return {
+        "id": page["id"],
+        "space": space_key,
+        "title": page.get("title"),
+        "version": version.get("number"),
+        "when": version.get("when"),
+        "url": page.get("_links", {}).get("webui"),
+        "body": page.get("body", {}).get("storage", {}).get("value", ""),
     }
 
-    all_spaces = []
-
-    while True:
-        response = get(spaces_url, params=params, auth=(username, password), pkcs12_filename=p12_cert_path,
-                       pkcs12_password=p12_password, verify=False)
-
-        if response.status_code == 200:
-            data = response.json()
-            spaces = data.get("results", [])
-            all_spaces.extend(spaces)
-
-            # Проверяем, есть ли еще пространства (пагинация)
-            if len(spaces) < params["limit"]:
-                break
 
-            # Переходим к следующей странице
-            params["start"] += params["limit"]
-        else:
-            print(f"Ошибка при получении пространств: {response.status_code}")
-            print(response.text)
-            break
+def next_watermark(when: str | None, current: str | None) -> str | None:
+    # version.when приходит как 2024-05-01T10:22:33.000+03:00, CQL ждет yyyy/MM/dd HH:mm
+    try:
+        moment = datetime.fromisoformat(when.replace("Z", "+00:00"))
+    except (AttributeError, ValueError):
+        return current
+    candidate = (moment.replace(tzinfo=None) - WATERMARK_OVERLAP).strftime("%Y/%m/%d %H:%M")
+    return max(candidate, current) if current else candidate
+
+
+def sync_space(session, base_url: str, space_key: str, output_dir: Path, full: bool = False) -> int:
+    """
+    Выгружает страницы пространства в <space>.jsonl.gz по мере получения.
+
+    Состояние хранит водяной знак lastModified и номера версий страниц:
+    повторный запуск запрашивает только страницы, измененные после прошлой выгрузки,
+    и пропускает те, чья версия не изменилась.
+    """
+    output_path = output_dir / f"{space_key}.jsonl.gz"
+    state_path = output_dir / f"{space_key}.state.json"
+    state = json.loads(state_path.read_text()) if state_path.exists() and not full else {}
+    versions = state.get("versions", {})
+    watermark = state.get("last_sync")
+
+    written = 0
+    with gzip.open(output_path, "wt" if full else "at", encoding="utf-8") as out:
+        for page in iter_pages_in_space(session, base_url, space_key, state.get("last_sync")):
+            record = page_record(page, space_key)
+            watermark = next_watermark(record["when"], watermark)
+            if record["version"] is not None and versions.get(record["id"], -1) >= record["version"]:
+                continue
+            versions[record["id"]] = record["version"]
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            written += 1
+
+    # Состояние пишется только после успешной выгрузки пространства
+    tmp_path = state_path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps({"last_sync": watermark, "finished": time.time(), "versions": versions}))
+    tmp_path.replace(state_path)
+    return written
 
-    # Для каждого пространства получаем страницы
-    for space in all_spaces:
-        space_key = space["key"]
-        space_name = space["name"]
-        print(f"Обработка пространства: {space_name} ({space_key})")
 
-        pages = get_pages_in_space(space_key, base_url, username, password)
-        for page in pages:
-            save_page_to_file(page, space_key)
+# Основная функция
+def download_confluence_pages(
+    base_url,
+    username,
+    password,
+    p12_cert_path,
+    p12_password,
+    spaces=None,
+    output_dir="confluence_pages",
+    full=False,
+    concurrency=CONCURRENCY,
+):
+    """
+    Выгружает пространства Confluence параллельно через одну сессию с пулом соединений.
+    spaces - ключи пространств, по умолчанию все доступные.
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    base_url = base_url if base_url.endswith("/") else base_url + "/"
+    session = make_session(username, password, p12_cert_path, p12_password, pool_size=concurrency)
+
+    space_keys = iter(spaces) if spaces else (space["key"] for space in iter_spaces(session, base_url))
+
+    def sync(space_key: str) -> tuple[str, int, float]:
+        started = time.perf_counter()
+        written = sync_space(session, base_url, space_key, output_dir, full=full)
+        return space_key, written, time.perf_counter() - started
+
+    total = 0
+    for space_key, written, elapsed in fetch_concurrently(sync, space_keys, concurrency):
+        total += written
+        print(f"Пространство {space_key}: {written} страниц за {elapsed:.1f} с")
+    print(f"Сохранено {total} страниц в {output_dir}")
 
 
 # Вызов основной функции
 if __name__ == '__main__':
-    # Базовые параметры
-    base_url = "https://sberworks.ru/wiki/rest/api/"
-
-    # Настройки Confluence
-    space_key = "ABRAU"  # Ключ пространства Confluence
-
-    # Путь к .p12 сертификату и пароль от него
-    p12_cert_path = ""
-    p12_password = ""
-
     parser = argparse.ArgumentParser(description="Скрипт для скачивания Confluence.")
     parser.add_argument("--url", required=True,
-                        help="Базовый URL до Confluence API (например, https://api.bitbucket.org/2.0)")
+                        help="Базовый URL до Confluence API (например, https://sberworks.ru/wiki/rest/api/)")
     parser.add_argument("--username", required=True, help="Имя пользователя ")
     parser.add_argument("--password", required=True, help="Пароль ")
     parser.add_argument("--p12_cert_path", required=True, help="Путь к .p12 сертификату")
     parser.add_argument("--p12_password", required=True, help="Пароль от .p12 сертификата")
-    parser.add_argument("--workspace", required=True, help="Имя рабочего пространства (workspace)")
+    parser.add_argument("--workspace", action="append", dest="spaces",
+                        help="Ключ пространства, можно указать несколько раз; по умолчанию все пространства")
+    parser.add_argument("--output-dir", default="confluence_pages", help="Папка для выгрузки и состояния")
+    parser.add_argument("--full", action="store_true", help="Выгрузить пространства заново")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="Пространств параллельно")
     args = parser.parse_args()
 
-    download_confluence_pages(base_url, args.username, args.password, args.p12_cert_path, args.p12_password)
+    download_confluence_pages(
+        args.url,
+        args.username,
+        args.password,
+        args.p12_cert_path,
+        args.p12_password,
+        spaces=args.spaces,
+        output_dir=args.output_dir,
+        full=args.full,
+        concurrency=args.concurrency,
+    )
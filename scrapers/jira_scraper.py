@@ -1,90 +1,159 @@
 import argparse
-import requests
-from requests_pkcs12 import Pkcs12Adapter
-from urllib.parse import urljoin
-import os
+import gzip
 import json
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from urllib.parse import urljoin
 
+from scrapers.session import fetch_concurrently, get_json, make_session
 
-def main(url, username, password, p12_cert_path, p12_password, workspace):
-    """
-    Основная функция для выполнения скрапинга Jira и сохранения результатов в файлы.
-
-    :param url: Базовый URL Jira
-    :param username: Имя пользователя для аутентификации
-    :param password: Пароль пользователя
-    :param p12_cert_path: Путь к файлу сертификата P12
-    :param p12_password: Пароль для сертификата P12
-    :param workspace: Рабочее пространство (например, проект или доска)
-    """
-    # Создаем сессию для выполнения запросов
-    session = requests.Session()
-
-    # Добавляем адаптер для работы с сертификатом P12
-    session.mount('https://', Pkcs12Adapter(pkcs12_filename=p12_cert_path, pkcs12_password=p12_password))
+PAGE_SIZE = 100
+CONCURRENCY = 8
+# JQL сравнивает время с точностью до минуты, перекрытие не дает потерять задачи на границе
+WATERMARK_OVERLAP = timedelta(minutes=1)
+JIRA_TIME_FORMAT = "%Y-%m-%dT%H:%M:%S.%f%z"
 
-    # Аутентификация через Basic Auth
-    session.auth = (username, password)
 
-    # Формируем URL для API Jira
-    api_url = urljoin(url, f"/rest/api/3/search")
+def build_jql(workspace: str, last_sync: str | None) -> str:
+    """
+    Сортировка по дате создания стабильна во время выгрузки: новые задачи попадают
+    в конец выдачи и не сдвигают уже запрошенные страницы.
+    """
+    jql = f'project = "{workspace}"'
+    if last_sync:
+        jql += f' AND updated >= "{last_sync}"'
+    return jql + " ORDER BY created ASC, key ASC"
 
-    # Параметры запроса (фильтр по рабочему пространству)
-    params = {
-        "jql": f"project={workspace}",
-        "maxResults": 50,  # Количество результатов на странице
-        "startAt": 0,  # Начало пагинации
-    }
 
+def next_watermark(updated: str, current: str | None) -> str | None:
+    """
+    Водяной знак - самое позднее поле updated из выгрузки минус перекрытие,
+    в часовом поясе сервера, в формате JQL.
+    """
     try:
-        # Выполняем GET-запрос к API Jira
-        response = session.get(api_url, params=params)
+        moment = datetime.strptime(updated, JIRA_TIME_FORMAT)
+    except (TypeError, ValueError):
+        return current
+    candidate = (moment.replace(tzinfo=None) - WATERMARK_OVERLAP).strftime("%Y/%m/%d %H:%M")
+    return max(candidate, current) if current else candidate
 
-        # Проверяем статус ответа
-        if response.status_code == 200:
-            data = response.json()
-            issues = data.get("issues", [])
 
-            # Создаем директорию для сохранения файлов, если она не существует
-            output_dir = "jira_issues"
-            os.makedirs(output_dir, exist_ok=True)
+def iter_issues(session, api_url: str, jql: str, fields: str | None, page_size: int, concurrency: int):
+    """
+    Все задачи по JQL: первая страница дает total, остальные запрашиваются параллельно.
+    Страницы отдаются по порядку, в памяти одновременно не больше 2 * concurrency страниц.
+    """
+    params = {"jql": jql, "maxResults": page_size}
+    if fields:
+        params["fields"] = fields
+
+    def fetch_page(start_at: int) -> dict:
+        return get_json(session, api_url, {**params, "startAt": start_at})
+
+    first = fetch_page(0)
+    total = first.get("total", 0)
+    # Сервер может урезать maxResults, шаг пагинации берем из ответа
+    step = first.get("maxResults") or page_size
+    yield total, first.get("issues", [])
+    for page in fetch_concurrently(fetch_page, range(step, total, step), concurrency):
+        yield total, page.get("issues", [])
+
+
+def main(
+    url,
+    username,
+    password,
+    p12_cert_path,
+    p12_password,
+    workspace,
+    output_dir="jira_issues",
+    full=False,
+    fields=None,
+    page_size=PAGE_SIZE,
+    concurrency=CONCURRENCY,
+):
+    """
+    Выгружает задачи проекта Jira в сжатый JSONL: одна задача в строке.
 
-            print(f"Сохранение данных в директорию: {output_dir}")
+    Повторный запуск добавляет в тот же файл новым gzip-блоком только задачи,
+    обновленные после прошлой выгрузки. Задача может встретиться в файле несколько раз,
+    актуальна последняя запись с ее ключом.
 
+    :param url: Базовый URL Jira
+    :param username: Имя пользователя для аутентификации
+    :param password: Пароль пользователя
+    :param p12_cert_path: Путь к файлу сертификата P12
+    :param p12_password: Пароль для сертификата P12
+    :param workspace: Рабочее пространство (ключ проекта)
+    :param output_dir: Папка для <workspace>.jsonl.gz и состояния синхронизации
+    :param full: Игнорировать водяной знак и выгрузить проект целиком в новый файл
+    :param fields: Список полей через запятую, по умолчанию поля сервера
+    """
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    output_path = output_dir / f"{workspace}.jsonl.gz"
+    state_path = output_dir / f"{workspace}.state.json"
+    state = json.loads(state_path.read_text()) if state_path.exists() and not full else {}
+    last_sync = state.get("last_sync")
+
+    if fields and "updated" not in fields.split(","):
+        fields += ",updated"
+
+    session = make_session(username, password, p12_cert_path, p12_password, pool_size=concurrency)
+    api_url = urljoin(url, "/rest/api/3/search")
+    jql = build_jql(workspace, last_sync)
+    print(f"JQL: {jql}")
+
+    started = time.perf_counter()
+    written = 0
+    watermark = last_sync
+    with gzip.open(output_path, "wt" if full else "at", encoding="utf-8") as out:
+        for total, issues in iter_issues(session, api_url, jql, fields, page_size, concurrency):
             for issue in issues:
-                key = issue.get("key")
-                summary = issue.get("fields", {}).get("summary")
-
-                # Формируем имя файла
-                file_name = f"{key}.json"
-                file_path = os.path.join(output_dir, file_name)
-
-                # Сохраняем данные в файл
-                with open(file_path, "w", encoding="utf-8") as f:
-                    json.dump(issue, f, ensure_ascii=False, indent=4)
-
-                print(f"Сохранен файл: {file_path}, Summary: {summary}")
-
-        else:
-            print(f"Ошибка при выполнении запроса: {response.status_code}")
-            print(response.text)
+                out.write(json.dumps(issue, ensure_ascii=False) + "\n")
+                watermark = next_watermark(issue.get("fields", {}).get("updated"), watermark)
+            written += len(issues)
+            elapsed = time.perf_counter() - started
+            print(f"Выгружено {written}/{total} задач, {written / max(elapsed, 1e-9):.0f} задач/с")
 
-    except Exception as e:
-        print(f"Произошла ошибка: {e}")
+    # Состояние пишется только после успешной выгрузки, иначе следующий запуск повторит дельту
+    state = {"last_sync": watermark, "jql": jql, "issues": written, "finished": time.time()}
+    tmp_path = state_path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(state, ensure_ascii=False, indent=2))
+    tmp_path.replace(state_path)
+    print(f"Сохранено {written} задач в {output_path}, следующая выгрузка с {watermark}")
 
 
 if __name__ == "__main__":
     # Настройка парсера аргументов командной строки
-    parser = argparse.ArgumentParser(description="Скрипт для скрапинга данных из Jira и сохранения их в файлы.")
+    parser = argparse.ArgumentParser(description="Скрипт для выгрузки задач из Jira в сжатый JSONL.")
     parser.add_argument("--url", required=True, help="Базовый URL Jira (например, https://your-domain.atlassian.net)")
     parser.add_argument("--username", required=True, help="Имя пользователя Jira")
     parser.add_argument("--password", required=True, help="Пароль пользователя Jira")
     parser.add_argument("--p12-cert-path", required=True, help="Путь к файлу сертификата P12")
     parser.add_argument("--p12-password", required=True, help="Пароль для сертификата P12")
     parser.add_argument("--workspace", required=True, help="Рабочее пространство (например, проект)")
+    parser.add_argument("--output-dir", default="jira_issues", help="Папка для выгрузки и состояния синхронизации")
+    parser.add_argument("--full", action="store_true", help="Выгрузить проект целиком, не используя водяной знак")
+    parser.add_argument("--fields", help="Поля задач через запятую, по умолчанию поля сервера")
+    parser.add_argument("--page-size", type=int, default=PAGE_SIZE, help="Задач на странице")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="Параллельных запросов к Jira")
 
     # Парсинг аргументов
     args = parser.parse_args()
 
     # Вызов основной функции
-    main(args.url, args.username, args.password, args.p12_cert_path, args.p12_password, args.workspace)
\ No newline at end of file
+    main(
+        args.url,
+        args.username,
+        args.password,
+        args.p12_cert_path,
+        args.p12_password,
+        args.workspace,
+        output_dir=args.output_dir,
+        full=args.full,
+        fields=args.fields,
+        page_size=args.page_size,
+        concurrency=args.concurrency,
+    )
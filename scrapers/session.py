@@ -0,0 +1,70 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, TypeVar
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def make_session(
+    username: str,
+    password: str,
+    p12_cert_path: str | None = None,
+    p12_password: str | None = None,
+    pool_size: int = 8,
+    max_retries: int = 5,
+) -> requests.Session:
+    """
+    Одна сессия с пулом соединений на все потоки скрапера.
+
+    Ответы 429 и 5xx повторяются с экспоненциальной задержкой,
+    заголовок Retry-After учитывается.
+    """
+    retry = Retry(
+        total=max_retries,
+        backoff_factor=1,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=["GET"],
+        respect_retry_after_header=True,
+    )
+    adapter_kwargs = {"pool_connections": pool_size, "pool_maxsize": pool_size, "max_retries": retry}
+    if p12_cert_path:
+        from requests_pkcs12 import Pkcs12Adapter
+
+        adapter = Pkcs12Adapter(pkcs12_filename=p12_cert_path, pkcs12_password=p12_password, **adapter_kwargs)
+    else:
+        adapter = HTTPAdapter(**adapter_kwargs)
+
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.auth = (username, password)
+    session.headers.update({"Accept": "application/json"})
+    return session
+
+
+def get_json(session: requests.Session, url: str, params: dict | None = None, verify: bool = True) -> dict:
+    response = session.get(url, params=params, verify=verify)
+    response.raise_for_status()
+    return response.json()
+
+
+def fetch_concurrently(fetch: Callable[[T], R], items: Iterable[T], concurrency: int) -> Iterator[R]:
+    """
+    Отдает fetch(item) в порядке items, одновременно в работе не больше 2 * concurrency запросов.
+    Вход читается лениво, поэтому память не растет с числом страниц.
+    """
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        in_flight = deque()
+        for item in items:
+            in_flight.append(executor.submit(fetch, item))
+            if len(in_flight) >= 2 * concurrency:
+                yield in_flight.popleft().result()
+        while in_flight:
+            yield in_flight.popleft().result()
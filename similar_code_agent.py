@@ -1,11 +1,25 @@
 import os
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
 from enum import Enum
+from functools import cached_property, lru_cache
 from gigachat import GigaChat
 from dotenv import load_dotenv
 
+from db.adapter import DBAdapter
+from mcp_apps.groups import load_group_indexes
+from mcp_apps.repo_funcs_crawler import EMBEDDINGS_MODEL, embed_queries
+from mcp_apps.search import HybridSearcher, aggregate_chunks, filters_from_slots
+from mcp_apps.shards import load_search_index
+
 load_dotenv(override=True)
 
 GIGA_CREDS = os.getenv("GIGA_CREDS")
+CANDIDATES_K = int(os.getenv("CANDIDATES_K", "10"))
+# Искать по исходному запросу параллельно с его расширением в detail_query
+SPECULATIVE_SEARCH = os.getenv("SPECULATIVE_SEARCH", "1") == "1"
+# Лучший score по исходному запросу, при котором расширение не ждем; больше 1 - ждать всегда
+EARLY_RETURN_SCORE = float(os.getenv("EARLY_RETURN_SCORE", "0.8"))
 
 
 class QueryTypeEnum(Enum):
@@ -21,16 +35,61 @@ class TargetEnum(Enum):
     all = "all"
 
 
+@dataclass
 class Candidate:
-    ...
+    id: int
+    score: float
+    # function - функция, задача или страница из общего индекса; class, module, repository - группа
+    level: str
+    path: str | None
+    # Код функции или имя группы
+    content: str
+    # Вхождения функции или, у группы, ее функции и модули
+    occurrences: list[dict] = field(default_factory=list)
+
+
+@lru_cache(maxsize=1)
+def shared_searcher() -> HybridSearcher:
+    # Те же индекс, база и индексы групп, что у MCP сервера, загружаются один раз на процесс
+    db_adapter = DBAdapter()
+    db_adapter.init_db()
+    return HybridSearcher(load_search_index(), db_adapter, embed_queries, group_indexes=load_group_indexes())
+
+
+def merge_hits(
+    hit_lists: list[list[tuple[int, float]]], parent_of: dict[int, str | None], k: int
+) -> list[tuple[int, float]]:
+    """
+    Сливает выдачи по одному пространству эмбеддингов. Запросы могут попасть в разные части
+    одной функции, поэтому слияние идет по функции, у нее остается лучший score.
+    """
+    hits = [hit for hit_list in hit_lists for hit in hit_list]
+    return aggregate_chunks(hits, parent_of, "max")[:k]
 
 
 class SimilarCodeAgent:
-    def __init__(self, query: str, query_type: QueryTypeEnum, target_type: TargetEnum):
+    def __init__(
+        self,
+        query: str,
+        query_type: QueryTypeEnum,
+        target_type: TargetEnum,
+        k: int = CANDIDATES_K,
+        searcher: HybridSearcher | None = None,
+    ):
         self.query = query
         self.detailed_query = None
         self.query_type = query_type
         self.target_type = target_type
+        self.k = k
+        self.filters = filters_from_slots(query_type, target_type)
+        # Ответ отдан по исходному запросу, без ожидания расширения
+        self.early_returned = False
+        if searcher is not None:
+            self.searcher = searcher
+
+    @cached_property
+    def searcher(self) -> HybridSearcher:
+        return shared_searcher()
 
     def detail_query(self, giga_client: GigaChat) -> None:
         self.detailed_query = (
@@ -39,25 +98,80 @@ class SimilarCodeAgent:
             .message.content
         )
 
-    def get_vector(self, giga_client: GigaChat) -> list[float]:
-        response = giga_client.embeddings([self.detailed_query])
-        return response.data[0].embeddings
-
-    def find_candidates(self, get_candidates: list[float]) -> list[list[float]]: ...
+    def expand_query(self) -> None:
+        # Расширение в фоне идет со своим клиентом: после раннего ответа клиент поиска закрывается,
+        # а начатый запрос к GigaChat отменить нельзя
+        with GigaChat(credentials=GIGA_CREDS, verify_ssl_certs=False) as giga_client:
+            self.detail_query(giga_client)
 
-    def get_candidates(
-        self, vectorized_candidates: list[list[float]]
-    ) -> list[Candidate]: ...
-
-    def find_similar(self) -> (int, list[Candidate]):
+    def get_vector(self, giga_client: GigaChat) -> list[float]:
+        # Модель та же, что у эмбеддингов корпуса
+        response = giga_client.embeddings([self.detailed_query], model=EMBEDDINGS_MODEL)
+        return response.data[0].embedding
+
+    def find_candidates(self, query_vector: list[float]) -> list[tuple[int, float]]:
+        """
+        Пары (label, score) по общему индексу. Для TargetEnum.object и TargetEnum.repository,
+        если собраны индексы групп, label - номер класса или репозитория в своем индексе.
+        """
+        if self.searcher.group_kind(self.filters):
+            return self.searcher.search_groups_by_vectors([query_vector], self.k, filters=self.filters)[0]
+        return self.searcher.search_by_vectors([query_vector], self.k, filters=self.filters)[0]
+
+    def get_candidates(self, hits: list[tuple[int, float]]) -> list[Candidate]:
+        scores = dict(hits)
+        labels = [label for label, _ in hits]
+        db_adapter = self.searcher.db_adapter
+        group_kind = self.searcher.group_kind(self.filters)
+        if group_kind:
+            return [
+                Candidate(g["id"], scores[g["id"]], group_kind, g["url"], g["name"], g["members"])
+                for g in db_adapter.get_groups(group_kind, labels)
+            ]
+        return [
+            Candidate(c["id"], scores[c["id"]], "function", c["url"], c["code"], c["occurrences"])
+            for c in db_adapter.get_by_ids(labels)
+        ]
+
+    def search_speculatively(
+        self, giga_client: GigaChat, early_return_score: float = EARLY_RETURN_SCORE
+    ) -> list[tuple[int, float]]:
+        """
+        Исходный запрос эмбеддится и ищется, пока GigaChat расширяет его в detail_query.
+        Если лучший кандидат по исходному запросу набрал early_return_score, ответ отдается
+        без ожидания расширения, иначе выдачи по обоим запросам сливаются.
+        """
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            expansion = executor.submit(self.expand_query)
+            # Исходный запрос эмбеддится через кэш запросов и Embedder с повторами
+            raw_hits = self.find_candidates(embed_queries([self.query])[0])
+            if raw_hits and raw_hits[0][1] >= early_return_score:
+                self.early_returned = True
+                return raw_hits
+            expansion.result()
+            detailed_hits = self.find_candidates(self.get_vector(giga_client))
+            parent_of = {}
+            if not self.searcher.group_kind(self.filters):
+                # У групп частей нет, по функциям сливаются только выдачи общего индекса
+                parent_of = self.searcher.db_adapter.parents_of(label for label, _ in raw_hits + detailed_hits)
+            return merge_hits([raw_hits, detailed_hits], parent_of, self.k)
+        finally:
+            # Расширение, которое уже не нужно, не ждем
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def find_similar(
+        self, speculative: bool = SPECULATIVE_SEARCH, early_return_score: float = EARLY_RETURN_SCORE
+    ) -> (int, list[Candidate]):
         try:
             with GigaChat(credentials=GIGA_CREDS, verify_ssl_certs=False) as giga_client:
-                self.detail_query(giga_client)
-                query_vector = self.get_vector(giga_client)
-
-            vectorized_candidates = self.find_candidates(query_vector)
+                if speculative:
+                    hits = self.search_speculatively(giga_client, early_return_score)
+                else:
+                    self.detail_query(giga_client)
+                    hits = self.find_candidates(self.get_vector(giga_client))
 
-            candidates: list[Candidate] = self.get_candidates(vectorized_candidates)
+            candidates: list[Candidate] = self.get_candidates(hits)
 
             return 200, candidates
         except Exception:
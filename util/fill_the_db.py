@@ -1,26 +1,61 @@
+import argparse
 import json
-from collections import defaultdict
+from pathlib import Path
+from typing import Iterator
 
 from db.adapter import DBAdapter
+from mcp_apps.embedding_store import open_embedding_store
+from mcp_apps.repo_funcs_crawler import fn_metadata, parent_fields, vector_key
 
-a = DBAdapter()
-a.init_db()
-try:
-    vectors = defaultdict(dict)
-    with open("../static/embeddings.jsonl", "r") as embeddings, open(
-        "../static/functions.jsonl", "r"
-    ) as functions:
-        for line in embeddings:
-            embedding = json.loads(line)
-            vectors[embedding["id"]]["embedding"] = embedding["embedding"]
+
+def iter_joined_records(embeddings_path: Path, functions_path: Path, store_vectors: bool = True) -> Iterator[dict]:
+    """
+    Потоково соединяет functions.jsonl с бинарным хранилищем эмбеддингов.
+
+    Каждая функция - одно вхождение, номер записи - номер строки хранилища,
+    т.е. label в индексе FAISS. Одинаковые по содержимому функции делят один вектор.
+    В памяти держится только таблица ключ вектора -> номер строки.
+    """
+    store = open_embedding_store(embeddings_path)
+    key2label = {key: label for label, key in enumerate(store.ids)}
+
+    with open(functions_path, "r") as functions:
         for line in functions:
             function = json.loads(line)
-            vectors[function["id"]]["code"] = function["content"]
-            vectors[function["id"]]["url"] = function["path"]
-
-    for id, vector in vectors.items():
-        a.add_entity(vector["embedding"], vector["code"], vector["url"])
-except Exception as e:
-    raise (e)
-finally:
-    a.close_db()
+            label = key2label.get(vector_key(function))
+            if label is None:
+                continue
+            yield {
+                "id": label,
+                "fn_id": function["id"],
+                "code": function["content"],
+                "url": function["path"],
+                "name": function.get("name"),
+                "parameters": function.get("parameters"),
+                "start_line": function.get("start_line"),
+                "end_line": function.get("end_line"),
+                **fn_metadata(function),
+                **parent_fields(function),
+                "vector": store.vectors[label] if store_vectors else None,
+            }
+
+
+def main(embeddings_path: Path, functions_path: Path, batch_size: int, store_vectors: bool):
+    a = DBAdapter()
+    a.init_db()
+    try:
+        # Полная загрузка заменяет содержимое базы, только если прошла целиком
+        a.replace_all(iter_joined_records(embeddings_path, functions_path, store_vectors), batch_size=batch_size)
+    finally:
+        a.close_db()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Загрузка функций и эмбеддингов в базу.")
+    parser.add_argument("--embeddings", default="../static/embeddings.jsonl", help="Путь к файлу эмбеддингов")
+    parser.add_argument("--functions", default="../static/functions.jsonl", help="Путь к файлу функций")
+    parser.add_argument("--batch-size", type=int, default=50_000, help="Размер пачки в одной транзакции")
+    parser.add_argument("--no-vectors", action="store_true", help="Не сохранять векторы в базе")
+    args = parser.parse_args()
+
+    main(Path(args.embeddings), Path(args.functions), args.batch_size, not args.no_vectors)